@@ -1,22 +1,101 @@
 import argparse
+import asyncio
+import bisect
+import codecs
+import datetime
+import gzip
+import hashlib
 import json
+import re
 import requests
 import io
 import os
 import sys
+import time
+import sqlite3
+import subprocess
+import threading
+import zipfile
+import concurrent.futures
+import http_client
  
 
 CROMWELL_SERVER_URL = 'http://{ip}:{port}'
 API_VERSION = 'v1'
 QUERY = 'query'
+STATUS = 'status'
+WATCH = 'watch'
+METADATA = 'metadata'
+PROFILE = 'profile'
 SUBMIT = 'submit'
+SUBMIT_BATCH = 'submit-batch'
 ABORT = 'abort'
+ABORT_BATCH = 'abort-batch'
+BATCH_SIZE = 100 # how many sets of inputs are sent in one request to the batch endpoint
+DEFAULT_MAX_CONCURRENT = 8 # how many submissions are in flight at once without the batch endpoint
+DEFAULT_SUBMIT_RATE = 10 # submissions per second without the batch endpoint
+DEFAULT_SUBMISSION_MANIFEST = 'submitted_workflows.tsv'
+QUERY_PAGE_SIZE = 1000 # how many workflows are asked for in each call to the query endpoint
+TABLE = 'table'
+JSON_LINES = 'json'
+STATUS_TABLE_FIELDS = ['id', 'status', 'name', 'submission', 'start', 'end']
+TERMINAL_STATES = ('Succeeded', 'Failed', 'Aborted')
+DEFAULT_WATCH_CACHE = os.path.join(os.path.expanduser('~'), '.cromwell_watch.sqlite')
+WATCH_QUERY_CHUNK = 500 # how many workflow ids are checked in one call to the query endpoint
+DEFAULT_WATCH_CONCURRENCY = 4 # how many query calls are in flight at once while watching
+# seconds between polls of a workflow that just entered a state; the interval grows
+# by POLL_BACKOFF each time a poll finds no change, up to MAX_POLL_INTERVAL
+POLL_INTERVALS = {'Submitted': 15, 'Running': 30, 'Aborting': 15}
+DEFAULT_POLL_INTERVAL = 15
+POLL_BACKOFF = 1.5
+MAX_POLL_INTERVAL = 15*60
+DEFAULT_DISCOVER_INTERVAL = 5*60 # seconds between looking for new jobs matching the labels/statuses
+MAX_MISSING_POLLS = 5 # polls in a row a job can be missing from Cromwell's answers before watch gives up on it
+UNKNOWN_STATUS = 'Unknown' # what watch records for a job it gave up on; it is not polled again
+DEFAULT_METADATA_CACHE = os.path.join(os.path.expanduser('~'), '.cromwell_metadata_cache')
+METADATA_READ_SIZE = 1024*1024 # bytes of metadata read from the socket (or cache) at a time
+METADATA_TIMEOUT = 10*60 # seconds; Cromwell can take minutes to assemble a large workflow's metadata
+CALL_ID_FIELDS = ['shardIndex', 'attempt'] # always kept when selecting fields of a call
+PHASES = ['queued', 'localizing', 'running', 'delocalizing']
+# executionEvents descriptions (lowercased) mapped to a phase.  Events overlap (e.g. RunningJob spans
+# localization), so where they do, the time goes to the phase with the highest priority.
+PHASE_PATTERNS = [
+    ('delocaliz', 'delocalizing', 4),
+    ('localiz', 'localizing', 4),
+    ('pulling', 'queued', 3),
+    ('waiting for quota', 'queued', 3),
+    ('containersetup', 'queued', 3),
+    ('useraction', 'running', 2),
+    ('user action', 'running', 2),
+    ('runningjob', 'running', 2),
+]
+DEFAULT_PHASE = ('queued', 1)
+# Cromwell only expands the subworkflow of a call whose subWorkflowId is kept by includeKey
+PROFILE_METADATA_KEYS = ['start', 'end', 'executionEvents', 'shardIndex', 'attempt', 'subWorkflowId', 'subWorkflowMetadata']
+CRITICAL_PATH_TOLERANCE = 1 # seconds a call may start before its predecessor on the critical path ends
+DEFAULT_PROFILE_CONCURRENCY = 4 # how many workflows' metadata are read at once
+DEFAULT_PROFILE_TOP = 20 # how many tasks are listed in the report
+DEFAULT_DEPENDENCY_CACHE = os.path.join(os.path.expanduser('~'), '.cromwell_dependency_zips')
+WDL_IMPORT_PATTERN = re.compile(r'^\s*import\s+["\']([^"\']+)["\']', re.MULTILINE)
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0) # fixed, so the same files always give the same zip bytes
+ACTIVE_STATES = ['Submitted', 'Running', 'On Hold']
+DEFAULT_ABORT_RETRIES = 3 # how many times an abort is re-sent after a server or connection error
+RETRY_BACKOFF_BASE = 1 # seconds; retries wait a random time up to this, doubled per failure
+RETRY_BACKOFF_MAX = 30 # seconds; the most a retry waits
+# the query endpoint only reads, so its POSTs are safe to re-send
+QUERY_RETRY = http_client.RetryPolicy(backoff_base=RETRY_BACKOFF_BASE, backoff_max=RETRY_BACKOFF_MAX, methods=None)
+GS_URI_PATTERN = re.compile(r'^gs://[^/]+/.+')
+PREFLIGHT_LIST_CHUNK = 100 # how many gs:// folders are listed by one gsutil call
+TIMESTAMP_PATTERN = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
 
 
 # These parameters are unlikely to change often unless Cromwell spec changes.
 DEFAULT_CONFIG = {
     'submit_endpoint' : '/api/workflows/{api_version}',
+    'batch_endpoint' : '/api/workflows/{api_version}/batch',
     'status_endpoint' : '/api/workflows/{api_version}/{job_uuid}/status',
+    'query_endpoint' : '/api/workflows/{api_version}/query',
+    'metadata_endpoint' : '/api/workflows/{api_version}/{job_uuid}/metadata',
     'abort_endpoint': '/api/workflows/{api_version}/{job_uuid}/abort',
     'workflow_type' : 'WDL',
     'workflow_type_version' : 'draft-2'
@@ -29,6 +108,10 @@ def parse_cl_args():
     # args that are used regardless of subcommand:
     parser.add_argument('--ip', required=True, help='IP address of Cromwell server')
     parser.add_argument('--port', required=False, default=8000, type=int, help='Port where the Cromwell server listens')
+    parser.add_argument('--timeout', required=False, type=float, default=http_client.DEFAULT_TIMEOUT,
+        help='Seconds to wait on Cromwell before a request fails.  Default: %d' % http_client.DEFAULT_TIMEOUT)
+    parser.add_argument('--http-stats', required=False,
+        help='On exit, write request counts and latencies per endpoint as JSON to this file ("-" for stderr).')
 
     # Create multiple subparsers for submission, query, etc.
     subparsers = parser.add_subparsers(help='Subcommand help', dest='subcommand')
@@ -39,67 +122,402 @@ def parse_cl_args():
     submit_parser.add_argument('-i', '--input-json', required=True, help='JSON-format WDL inputs')
     submit_parser.add_argument('-zip', '--dependencies-zip', required=False, help='ZIP archive for other WDL files.')
     submit_parser.add_argument('-zone', required=False, default='us-east4-c', help='Zone in which to execute the job')
+    submit_parser.add_argument('--no-auto-zip', action='store_true',
+        help='Do not build a ZIP of the WDL files imported by the main WDL when -zip is not given')
+    submit_parser.add_argument('--dependency-cache-dir', default=DEFAULT_DEPENDENCY_CACHE,
+        help='Where automatically built ZIPs are kept between submissions.  Default: %s' % DEFAULT_DEPENDENCY_CACHE)
+    submit_parser.add_argument('--preflight', action='store_true',
+        help='Check that every gs:// path in the inputs exists before submitting')
     submit_parser.add_argument('main_wdl', help='The main WDL file')
 
+    # Options/args for submitting many jobs with the same WDL:
+    batch_parser = subparsers.add_parser(SUBMIT_BATCH, help="Submit one job per input JSON to Cromwell")
+    batch_parser.add_argument('-i', '--inputs', required=True,
+        help='A directory of JSON-format WDL inputs, or a file listing the paths of input JSONs, one per line')
+    batch_parser.add_argument('-zip', '--dependencies-zip', required=False, help='ZIP archive for other WDL files.')
+    batch_parser.add_argument('-zone', required=False, default='us-east4-c', help='Zone in which to execute the jobs')
+    batch_parser.add_argument('--no-auto-zip', action='store_true',
+        help='Do not build a ZIP of the WDL files imported by the main WDL when -zip is not given')
+    batch_parser.add_argument('--dependency-cache-dir', default=DEFAULT_DEPENDENCY_CACHE,
+        help='Where automatically built ZIPs are kept between submissions.  Default: %s' % DEFAULT_DEPENDENCY_CACHE)
+    batch_parser.add_argument('--preflight', action='store_true',
+        help='Check that every gs:// path in the inputs exists, and skip inputs with missing paths')
+    batch_parser.add_argument('-o', '--output-manifest', required=False, default=DEFAULT_SUBMISSION_MANIFEST,
+        help='Tab-delimited file mapping each input JSON to its Cromwell UUID.  Default: %s' % DEFAULT_SUBMISSION_MANIFEST)
+    batch_parser.add_argument('--max-concurrent', required=False, type=int, default=DEFAULT_MAX_CONCURRENT,
+        help='Submissions in flight at once if the batch endpoint is not used.  Default: %d' % DEFAULT_MAX_CONCURRENT)
+    batch_parser.add_argument('--rate', required=False, type=float, default=DEFAULT_SUBMIT_RATE,
+        help='Submissions per second if the batch endpoint is not used.  Default: %s' % DEFAULT_SUBMIT_RATE)
+    batch_parser.add_argument('--no-batch-endpoint', action='store_true',
+        help='Submit each input individually instead of through Cromwell\'s batch endpoint')
+    batch_parser.add_argument('main_wdl', help='The main WDL file')
+
     # Options/args for querying a job for its status:
     query_parser = subparsers.add_parser(QUERY, help="Query Cromwell for job status")
     query_parser.add_argument('-i', '--cromwell-id', required=True, help='The Cromwell UUID for the job')
 
+    # Options/args for querying many jobs at once:
+    status_parser = subparsers.add_parser(STATUS, help="Query Cromwell for the status of many jobs at once")
+    status_parser.add_argument('-i', '--cromwell-ids', nargs='+', default=[], help='Cromwell UUIDs of the jobs')
+    status_parser.add_argument('-f', '--ids-file', required=False,
+        help='A file of Cromwell UUIDs, one per line, or a manifest written by %s' % SUBMIT_BATCH)
+    status_parser.add_argument('-l', '--label', action='append', default=[],
+        help='Only jobs with this label, given as key:value.  May be repeated; all must match.')
+    status_parser.add_argument('-s', '--status', action='append', default=[],
+        help='Only jobs in this state (e.g. Running, Failed).  May be repeated; any may match.')
+    status_parser.add_argument('--format', choices=[TABLE, JSON_LINES], default=TABLE,
+        help='Print a table, or one JSON object per line.  Default: %s' % TABLE)
+
+    # Options/args for watching jobs until they finish:
+    watch_parser = subparsers.add_parser(WATCH, help="Watch jobs and report each change of state")
+    watch_parser.add_argument('-i', '--cromwell-ids', nargs='+', default=[], help='Cromwell UUIDs of the jobs')
+    watch_parser.add_argument('-f', '--ids-file', required=False,
+        help='A file of Cromwell UUIDs, one per line, or a manifest written by %s' % SUBMIT_BATCH)
+    watch_parser.add_argument('-l', '--label', action='append', default=[],
+        help='Also watch jobs with this label, given as key:value.  May be repeated; all must match.')
+    watch_parser.add_argument('-s', '--status', action='append', default=[],
+        help='Also watch jobs in this state.  May be repeated; any may match.')
+    watch_parser.add_argument('-e', '--events', default='-',
+        help='Append state changes to this file as JSON lines ("-" for stdout).  Default: stdout')
+    watch_parser.add_argument('--hook', required=False,
+        help='A shell command run for each state change, with the event as JSON on stdin')
+    watch_parser.add_argument('--cache', default=DEFAULT_WATCH_CACHE,
+        help='SQLite file holding the last known state of each job.  Default: %s' % DEFAULT_WATCH_CACHE)
+    watch_parser.add_argument('--concurrency', type=int, default=DEFAULT_WATCH_CONCURRENCY,
+        help='Query calls in flight at once.  Default: %d' % DEFAULT_WATCH_CONCURRENCY)
+    watch_parser.add_argument('--discover-interval', type=float, default=DEFAULT_DISCOVER_INTERVAL,
+        help='Seconds between looking for new jobs matching --label/--status.  Default: %d' % DEFAULT_DISCOVER_INTERVAL)
+
+    # Options/args for fetching job metadata:
+    metadata_parser = subparsers.add_parser(METADATA, help="Fetch job metadata, optionally only selected fields")
+    metadata_parser.add_argument('-i', '--cromwell-id', required=True, help='The Cromwell UUID for the job')
+    metadata_parser.add_argument('--include-key', action='append', default=[],
+        help='Only return metadata under this key (Cromwell includeKey).  May be repeated.')
+    metadata_parser.add_argument('--exclude-key', action='append', default=[],
+        help='Leave out metadata under this key (Cromwell excludeKey).  May be repeated.')
+    metadata_parser.add_argument('--expand-subworkflows', action='store_true',
+        help='Include the metadata of subworkflows within their calls')
+    metadata_parser.add_argument('--fields', nargs='+', required=False,
+        help='Print only these fields of the job and of each call (e.g. outputs failures)')
+    metadata_parser.add_argument('--cache-dir', default=DEFAULT_METADATA_CACHE,
+        help='Where metadata of finished jobs is kept.  Default: %s' % DEFAULT_METADATA_CACHE)
+    metadata_parser.add_argument('--no-cache', action='store_true', help='Neither read nor write the metadata cache')
+
+    # Options/args for profiling where jobs spend their time:
+    profile_parser = subparsers.add_parser(PROFILE, help="Report where jobs spend their time, per task")
+    profile_parser.add_argument('-i', '--cromwell-ids', nargs='+', default=[], help='Cromwell UUIDs of the jobs')
+    profile_parser.add_argument('-f', '--ids-file', required=False,
+        help='A file of Cromwell UUIDs, one per line, or a manifest written by %s' % SUBMIT_BATCH)
+    profile_parser.add_argument('-l', '--label', action='append', default=[],
+        help='Profile jobs with this label, given as key:value.  May be repeated; all must match.')
+    profile_parser.add_argument('-s', '--status', action='append', default=[],
+        help='Profile jobs in this state.  May be repeated; any may match.')
+    profile_parser.add_argument('--top', type=int, default=DEFAULT_PROFILE_TOP,
+        help='How many tasks to list.  Default: %d' % DEFAULT_PROFILE_TOP)
+    profile_parser.add_argument('--format', choices=[TABLE, JSON_LINES], default=TABLE,
+        help='Print tables, or the report as JSON.  Default: %s' % TABLE)
+    profile_parser.add_argument('--concurrency', type=int, default=DEFAULT_PROFILE_CONCURRENCY,
+        help='Jobs whose metadata is read at once.  Default: %d' % DEFAULT_PROFILE_CONCURRENCY)
+    profile_parser.add_argument('--cache-dir', default=DEFAULT_METADATA_CACHE,
+        help='Where metadata of finished jobs is kept.  Default: %s' % DEFAULT_METADATA_CACHE)
+    profile_parser.add_argument('--no-cache', action='store_true', help='Neither read nor write the metadata cache')
+
     # Options/args for aborting jobs:
     query_parser = subparsers.add_parser(ABORT, help="Abort a job")
     query_parser.add_argument('-i', '--cromwell-id', required=True, help='The Cromwell UUID for the job')
+
+    # Options/args for aborting many jobs at once:
+    abort_batch_parser = subparsers.add_parser(ABORT_BATCH, help="Abort every unfinished job matching UUIDs, labels or a time window")
+    abort_batch_parser.add_argument('-i', '--cromwell-ids', nargs='+', default=[], help='Cromwell UUIDs of the jobs')
+    abort_batch_parser.add_argument('-f', '--ids-file', required=False,
+        help='A file of Cromwell UUIDs, one per line, or a manifest written by %s' % SUBMIT_BATCH)
+    abort_batch_parser.add_argument('-l', '--label', action='append', default=[],
+        help='Only jobs with this label, given as key:value.  May be repeated; all must match.')
+    abort_batch_parser.add_argument('--submitted-after', required=False,
+        help='Only jobs submitted at or after this time (e.g. 2019-05-01T12:00:00Z)')
+    abort_batch_parser.add_argument('--submitted-before', required=False,
+        help='Only jobs submitted before this time (e.g. 2019-05-01T18:00:00Z)')
+    abort_batch_parser.add_argument('--max-concurrent', type=int, default=DEFAULT_MAX_CONCURRENT,
+        help='Abort requests in flight at once.  Default: %d' % DEFAULT_MAX_CONCURRENT)
+    abort_batch_parser.add_argument('--retries', type=int, default=DEFAULT_ABORT_RETRIES,
+        help='Times an abort is re-sent after a server or connection error.  Default: %d' % DEFAULT_ABORT_RETRIES)
+    abort_batch_parser.add_argument('--dry-run', action='store_true', help='List the jobs that would be aborted, and stop')
     
     args = parser.parse_args()
     return vars(args)
 
 
-def submit_job(args):
+def get_server_url(args):
+    return CROMWELL_SERVER_URL.format(ip=args['ip'], port=args['port'])
+
+
+def load_inputs(input_json):
     '''
-    input_json is a dict
+    Loads a JSON-format WDL inputs file as a dict
     '''
-
-    # load the inputs as a dict:
     try:
-        j = json.load(open(args['input_json']))
+        return json.load(open(input_json))
     except FileNotFoundError:
-        print('Could not locate %s.  Check the path.' % args['input_json'])
+        print('Could not locate %s.  Check the path.' % input_json)
         sys.exit(1)
     except json.decoder.JSONDecodeError as ex:
         print('JSON was not properly formatted.  Error was:')
         print(ex)    
         sys.exit(1)
 
-    # pull together the components of the POST request to the Cromwell server
-    submission_endpoint = DEFAULT_CONFIG['submit_endpoint'].format(api_version = API_VERSION)
-    submission_url = CROMWELL_SERVER_URL.format(ip=args['ip'], port=args['port']) + submission_endpoint
 
-    payload = {}
-    payload = {'workflowType': DEFAULT_CONFIG['workflow_type'], \
+def get_submission_payload():
+    return {'workflowType': DEFAULT_CONFIG['workflow_type'], \
         'workflowTypeVersion': DEFAULT_CONFIG['workflow_type_version']
     }
 
+
+def get_submission_files(args):
+    '''
+    Reads the parts of a submission that do not depend on the inputs: the main WDL,
+    the dependencies zip and the workflow options.  They are kept as bytes so the
+    same dict can be re-sent for any number of submissions.
+    '''
     # Create an options dict so we can specify the zones and possibly other configuration params:
     options_json = {}
     options_json['default_runtime_attributes'] = {'zones': args['zone']}
 
-    # Give these file-like handles with the BytesIO interface:
-    options_io = io.BytesIO(json.dumps(options_json).encode('utf-8'))
-    json_inputs_io = io.BytesIO(json.dumps(j).encode('utf-8'))
     files = {
-        'workflowOptions': options_io, 
-        'workflowInputs': json_inputs_io
+        'workflowOptions': json.dumps(options_json).encode('utf-8')
     }
 
     # Load-in the main WDL script:
-    files['workflowSource'] =  open(args['main_wdl'], 'rb')
+    with open(args['main_wdl'], 'rb') as fin:
+        files['workflowSource'] = fin.read()
 
     # Check if there were other WDL files, packaged as a zip:
     if args['dependencies_zip'] and os.path.exists(args['dependencies_zip']):
-        files['workflowDependencies'] = open(args['dependencies_zip'], 'rb')
+        with open(args['dependencies_zip'], 'rb') as fin:
+            files['workflowDependencies'] = fin.read()
+    elif not args['dependencies_zip'] and not args['no_auto_zip']:
+        # otherwise package whatever the main WDL imports
+        dependencies = get_dependency_zip(args['main_wdl'], args['dependency_cache_dir'])
+        if dependencies is not None:
+            files['workflowDependencies'] = dependencies
+    return files
+
+
+def collect_gs_uris(value):
+    '''
+    Yields every gs:// object path in a WDL inputs value, looking inside lists and maps
+    '''
+    if isinstance(value, dict):
+        for item in value.values():
+            for uri in collect_gs_uris(item):
+                yield uri
+    elif isinstance(value, list):
+        for item in value:
+            for uri in collect_gs_uris(item):
+                yield uri
+    elif isinstance(value, str) and GS_URI_PATTERN.match(value):
+        yield value
+
+
+def get_gs_parent(uri):
+    return uri.rstrip('/').rsplit('/', 1)[0] + '/'
+
+
+class GsutilStorage(object):
+    '''
+    Lists Google storage folders with gsutil, many folders per call.  Any object
+    with a list_folders(folders) method returning the paths found in them can
+    stand in for this one.
+    '''
+    def list_folders(self, folders):
+        found = set()
+        for start in range(0, len(folders), PREFLIGHT_LIST_CHUNK):
+            cmd = ['gsutil', 'ls'] + folders[start:start + PREFLIGHT_LIST_CHUNK]
+            try:
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            except FileNotFoundError:
+                print('Could not find gsutil, which is needed to check the inputs.')
+                sys.exit(1)
+            # folders that do not exist make gsutil exit non-zero, but the rest are still listed
+            for line in p.stdout:
+                line = line.decode('utf-8').strip()
+                if line.startswith('gs://') and not line.endswith(':'):
+                    found.add(line)
+            p.wait()
+        return found
+
+
+class InputPreflight(object):
+    '''
+    Checks that the gs:// paths in WDL inputs exist by listing their folders, with
+    one listing per folder no matter how many inputs (or how many calls to
+    find_missing) refer to it.
+    '''
+    def __init__(self, storage):
+        self.storage = storage
+        self.listings = {}
+
+    def find_missing(self, inputs_list):
+        '''
+        Returns, for each inputs dict, the sorted gs:// paths it refers to that do not exist
+        '''
+        uris_per_input = [set(collect_gs_uris(x)) for x in inputs_list]
+        folders = set(get_gs_parent(x) for uris in uris_per_input for x in uris) - set(self.listings)
+        if len(folders) > 0:
+            for folder in folders:
+                self.listings[folder] = set()
+            for path in self.storage.list_folders(sorted(folders)):
+                self.listings.setdefault(get_gs_parent(path), set()).add(path)
+        return [sorted(x for x in uris if x not in self.listings[get_gs_parent(x)]) for uris in uris_per_input]
+
+
+def find_wdl_imports(main_wdl):
+    '''
+    Follows the import statements of the main WDL, and of everything it imports.
+    Returns a dict mapping each import, as Cromwell will look it up in the zip,
+    to the local file.  Imports are looked for next to the main WDL, then next to
+    the importing file.  URL imports are left for Cromwell to fetch.  An import
+    that would sit outside the zip (an absolute path, or one climbing out with "..")
+    cannot be packaged, so it is reported and we exit.
+    '''
+    main_dir = os.path.dirname(os.path.abspath(main_wdl))
+    imports = {}
+    to_read = [os.path.abspath(main_wdl)]
+    while len(to_read) > 0:
+        wdl_path = to_read.pop()
+        with open(wdl_path) as fin:
+            wdl_text = fin.read()
+        for imported in WDL_IMPORT_PATTERN.findall(wdl_text):
+            if '://' in imported:
+                continue
+            zip_path = os.path.normpath(imported)
+            if os.path.isabs(zip_path) or zip_path.split(os.sep)[0] == os.pardir:
+                print('Cannot package %s, imported by %s, since it is outside the folder of the main WDL.  '
+                    'Use an import path within that folder, or give a -zip.' % (imported, wdl_path))
+                sys.exit(1)
+            if zip_path in imports:
+                continue
+            candidates = [os.path.join(main_dir, zip_path), os.path.normpath(os.path.join(os.path.dirname(wdl_path), imported))]
+            local_paths = [x for x in candidates if os.path.isfile(x)]
+            if len(local_paths) == 0:
+                print('Could not locate %s, imported by %s.  Check the path.' % (imported, wdl_path))
+                sys.exit(1)
+            imports[zip_path] = os.path.abspath(local_paths[0])
+            to_read.append(imports[zip_path])
+    return imports
+
+
+def get_file_stamp(path):
+    info = os.stat(path)
+    return [info.st_size, info.st_mtime_ns]
+
+
+def get_dependency_hash(imports):
+    '''
+    A hash of the content of every imported file and where it goes in the zip
+    '''
+    digest = hashlib.sha256()
+    for zip_path in sorted(imports):
+        with open(imports[zip_path], 'rb') as fin:
+            file_hash = hashlib.sha256(fin.read()).hexdigest()
+        digest.update(('%s\0%s\n' % (zip_path, file_hash)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_dependency_zip(imports):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for zip_path in sorted(imports):
+            info = zipfile.ZipInfo(zip_path, ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(imports[zip_path], 'rb') as fin:
+                archive.writestr(info, fin.read())
+    return buffer.getvalue()
+
+
+def get_dependency_zip(main_wdl, cache_dir=DEFAULT_DEPENDENCY_CACHE):
+    '''
+    Returns the bytes of a zip holding every WDL the main WDL imports (directly or
+    not), or None if it imports nothing local.  Zips are stored in `cache_dir` under
+    the hash of their contents.  An index there records the size and modification
+    time of each file in the import tree of a main WDL, so while none of them
+    change, the stored zip is returned without reading or compressing anything.
+    '''
+    main_wdl = os.path.abspath(main_wdl)
+    index_path = os.path.join(cache_dir, 'index.json')
+    try:
+        index = json.load(open(index_path))
+    except (FileNotFoundError, ValueError):
+        index = {}
+
+    entry = index.get(main_wdl)
+    if entry is not None:
+        try:
+            unchanged = all(get_file_stamp(x) == stamp for x, stamp in entry['stamps'].items())
+        except FileNotFoundError:
+            unchanged = False
+        if unchanged:
+            if entry['hash'] is None:
+                return None
+            zip_path = os.path.join(cache_dir, '%s.zip' % entry['hash'])
+            if os.path.exists(zip_path):
+                with open(zip_path, 'rb') as fin:
+                    return fin.read()
+
+    imports = find_wdl_imports(main_wdl)
+    stamps = dict((x, get_file_stamp(x)) for x in [main_wdl] + list(imports.values()))
+    dependency_hash = None
+    dependencies = None
+    if len(imports) > 0:
+        dependency_hash = get_dependency_hash(imports)
+        zip_path = os.path.join(cache_dir, '%s.zip' % dependency_hash)
+        if os.path.exists(zip_path):
+            with open(zip_path, 'rb') as fin:
+                dependencies = fin.read()
+        else:
+            dependencies = build_dependency_zip(imports)
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (zip_path, os.getpid())
+            with open(tmp_path, 'wb') as fout:
+                fout.write(dependencies)
+            os.replace(tmp_path, zip_path)
+            print('Packaged %d imported WDL files into %s' % (len(imports), zip_path))
+
+    index[main_wdl] = {'hash': dependency_hash, 'stamps': stamps}
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (index_path, os.getpid())
+    with open(tmp_path, 'w') as fout:
+        json.dump(index, fout)
+    os.replace(tmp_path, index_path)
+    return dependencies
+
+
+def submit_job(args):
+    '''
+    input_json is a dict
+    '''
+
+    # load the inputs as a dict:
+    j = load_inputs(args['input_json'])
+
+    if args['preflight']:
+        missing = InputPreflight(GsutilStorage()).find_missing([j])[0]
+        if len(missing) > 0:
+            print('Did not submit job-- these inputs do not exist:\n%s' % '\n'.join(missing))
+            sys.exit(1)
+
+    # pull together the components of the POST request to the Cromwell server
+    submission_endpoint = DEFAULT_CONFIG['submit_endpoint'].format(api_version = API_VERSION)
+    submission_url = get_server_url(args) + submission_endpoint
+
+    payload = get_submission_payload()
+    files = get_submission_files(args)
+
+    # Give the inputs a file-like handle with the BytesIO interface:
+    files['workflowInputs'] = io.BytesIO(json.dumps(j).encode('utf-8'))
 
     # start the job:
     try:
-        response = requests.post(submission_url, data=payload, files=files)
+        response = make_session(1).post(submission_url, data=payload, files=files)
     except Exception as ex:
         print('An exception was raised when requesting Cromwell server:')
         print(ex)
@@ -124,36 +542,1066 @@ def submit_job(args):
         return None
 
 
+def collect_input_jsons(inputs_path):
+    '''
+    Returns the input JSON paths given either a directory (every *.json file in it)
+    or a manifest listing one path per line.  Relative paths in a manifest are
+    taken relative to the manifest's directory.
+    '''
+    if os.path.isdir(inputs_path):
+        return sorted(os.path.join(inputs_path, x) for x in os.listdir(inputs_path) if x.endswith('.json'))
+    if not os.path.exists(inputs_path):
+        print('Could not locate %s.  Check the path.' % inputs_path)
+        sys.exit(1)
+    manifest_dir = os.path.dirname(os.path.abspath(inputs_path))
+    input_jsons = []
+    for line in open(inputs_path):
+        line = line.strip()
+        if len(line) > 0 and not line.startswith('#'):
+            input_jsons.append(os.path.join(manifest_dir, line))
+    return input_jsons
+
+
+def make_session(pool_size):
+    '''
+    Returns a session (see http_client.Client) that keeps up to `pool_size` connections
+    to Cromwell open for re-use.  Only idempotent requests are retried by default.
+    '''
+    return http_client.Client(pool_size=pool_size,
+        retry=http_client.RetryPolicy(backoff_base=RETRY_BACKOFF_BASE, backoff_max=RETRY_BACKOFF_MAX))
+
+
+class RateLimiter(object):
+    '''
+    Spaces out calls to wait() so that at most `rate` return per second, across threads.
+    '''
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            start_time = max(now, self.next_time)
+            self.next_time = start_time + self.interval
+        time.sleep(start_time - now)
+
+
+def submit_through_batch_endpoint(session, server_url, shared_files, inputs_list):
+    '''
+    Submits one workflow per dict in `inputs_list` in a single request.  Returns
+    Cromwell's list of {'id':..., 'status':...}, in the same order as the inputs, or
+    None if the server does not offer the batch endpoint.
+    '''
+    url = server_url + DEFAULT_CONFIG['batch_endpoint'].format(api_version = API_VERSION)
+    files = dict(shared_files)
+    files['workflowInputs'] = json.dumps(inputs_list).encode('utf-8')
+    response = session.post(url, data=get_submission_payload(), files=files)
+    if response.status_code in (404, 405):
+        return None
+    if response.status_code != 201:
+        raise IOError('Batch submission failed-- status code was %d, and response text was: %s'
+            % (response.status_code, response.text))
+    return response.json()
+
+
+def submit_single(session, server_url, shared_files, inputs, limiter):
+    '''
+    Submits one workflow, waiting on `limiter` first.  Returns Cromwell's {'id':..., 'status':...}
+    '''
+    url = server_url + DEFAULT_CONFIG['submit_endpoint'].format(api_version = API_VERSION)
+    files = dict(shared_files)
+    files['workflowInputs'] = json.dumps(inputs).encode('utf-8')
+    limiter.wait()
+    response = session.post(url, data=get_submission_payload(), files=files)
+    if response.status_code != 201:
+        raise IOError('Did not submit job-- status code was %d, and response text was: %s'
+            % (response.status_code, response.text))
+    return response.json()
+
+
+def write_submission_manifest(output_path, results):
+    '''
+    Writes a tab-delimited file of input JSON, Cromwell UUID and status.  Inputs that
+    failed to submit have an empty UUID and the error as their status.
+    '''
+    with open(output_path, 'w') as fout:
+        fout.write('input_json\tworkflow_id\tstatus\n')
+        for input_json, workflow_id, status in results:
+            fout.write('%s\t%s\t%s\n' % (input_json, workflow_id or '', status))
+
+
+def submit_batch(args):
+    '''
+    Submits one workflow per input JSON, all sharing the same WDL, zip and options.
+    Uses Cromwell's batch endpoint if it is available; otherwise submits individually,
+    several at once and rate-limited.  Writes the input -> UUID manifest and
+    returns the list of (input_json, workflow_id, status).
+    '''
+    input_jsons = collect_input_jsons(args['inputs'])
+    if len(input_jsons) == 0:
+        print('No input JSONs were found in %s' % args['inputs'])
+        sys.exit(1)
+
+    # load everything up-front so a malformed file stops us before anything is submitted
+    all_inputs = [load_inputs(x) for x in input_jsons]
+    shared_files = get_submission_files(args)
+    server_url = get_server_url(args)
+    session = make_session(args['max_concurrent'])
+
+    outcomes = [None] * len(input_jsons)
+    if args['preflight']:
+        # one set of listings covers every input of the batch
+        for i, missing in enumerate(InputPreflight(GsutilStorage()).find_missing(all_inputs)):
+            if len(missing) > 0:
+                print('ERROR: Not submitting %s.  These inputs do not exist: %s' % (input_jsons[i], ', '.join(missing)))
+                outcomes[i] = (None, 'Missing inputs: %s' % ' '.join(missing))
+
+    pending = [i for i in range(len(input_jsons)) if outcomes[i] is None]
+    if not args['no_batch_endpoint']:
+        for start in range(0, len(pending), BATCH_SIZE):
+            indices = pending[start:start + BATCH_SIZE]
+            try:
+                submitted = submit_through_batch_endpoint(session, server_url, shared_files,
+                    [all_inputs[i] for i in indices])
+            except (IOError, requests.exceptions.RequestException) as ex:
+                # the batch may have been partly accepted, so these are not re-sent individually
+                print('ERROR: %s' % ex)
+                for i in indices:
+                    outcomes[i] = (None, str(ex))
+                continue
+            if submitted is None:
+                print('Cromwell does not offer the batch endpoint.  Submitting individually.')
+                break
+            for i, response_json in zip(indices, submitted):
+                outcomes[i] = (response_json['id'], response_json['status'])
+        pending = [i for i in pending if outcomes[i] is None]
+
+    limiter = RateLimiter(args['rate'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args['max_concurrent']) as executor:
+        future_to_index = {}
+        for i in pending:
+            future = executor.submit(submit_single, session, server_url, shared_files, all_inputs[i], limiter)
+            future_to_index[future] = i
+        for future in concurrent.futures.as_completed(future_to_index):
+            i = future_to_index[future]
+            try:
+                response_json = future.result()
+                outcomes[i] = (response_json['id'], response_json['status'])
+            except (IOError, requests.exceptions.RequestException) as ex:
+                print('ERROR: Could not submit %s: %s' % (input_jsons[i], ex))
+                outcomes[i] = (None, str(ex))
+
+    results = [(input_jsons[i],) + outcomes[i] for i in range(len(input_jsons))]
+    write_submission_manifest(args['output_manifest'], results)
+    submitted_count = len([x for x in results if x[1] is not None])
+    print('Submitted %d of %d jobs.  Wrote the job IDs to %s' % (submitted_count, len(results), args['output_manifest']))
+    return results
+
+
 def query_job_status(args):
     # pull together the components of the GET request to the Cromwell server
     endpoint = DEFAULT_CONFIG['status_endpoint'].format(api_version = API_VERSION, job_uuid=args['cromwell_id'])
     request_url = CROMWELL_SERVER_URL.format(ip=args['ip'], port=args['port']) + endpoint
-    response = requests.get(request_url)
+    response = make_session(1).get(request_url)
     if response.status_code == 200:
         print(response.text)
     else:
         print('Status request was not successful.  Received status code %d' % response.status_code)
 
 
+def read_workflow_ids(ids_path):
+    '''
+    Reads Cromwell UUIDs from a file with one per line, or from the workflow_id
+    column of a manifest written by submit_batch.
+    '''
+    workflow_ids = []
+    with open(ids_path) as fin:
+        column = 0
+        for i, line in enumerate(fin):
+            fields = line.rstrip('\n').split('\t')
+            if i == 0 and 'workflow_id' in fields:
+                column = fields.index('workflow_id')
+                continue
+            value = fields[column].strip() if len(fields) > column else ''
+            if len(value) > 0 and not value.startswith('#'):
+                workflow_ids.append(value)
+    return workflow_ids
+
+
+def build_query_criteria(workflow_ids=(), labels=(), statuses=(), submitted_after=None):
+    '''
+    Returns the body of a POST to the query endpoint.  Cromwell matches any of
+    the ids, any of the statuses, and all of the labels.
+    '''
+    criteria = [{'id': x} for x in workflow_ids]
+    criteria.extend({'label': x} for x in labels)
+    criteria.extend({'status': x} for x in statuses)
+    if submitted_after:
+        criteria.append({'submission': submitted_after})
+    return criteria
+
+
+def query_workflows(session, server_url, criteria, page_size=QUERY_PAGE_SIZE):
+    '''
+    Yields the summary dict of every workflow matching `criteria`, a page at a time,
+    so the caller can start on the first page before the last one is fetched.
+    '''
+    url = server_url + DEFAULT_CONFIG['query_endpoint'].format(api_version = API_VERSION)
+    page = 1
+    seen = 0
+    while True:
+        body = criteria + [{'page': str(page)}, {'pageSize': str(page_size)}]
+        response = session.post(url, json=body, retry=QUERY_RETRY)
+        if response.status_code != 200:
+            raise IOError('Query request was not successful.  Received status code %d: %s'
+                % (response.status_code, response.text))
+        response_json = response.json()
+        results = response_json.get('results', [])
+        for result in results:
+            yield result
+        seen += len(results)
+        if len(results) == 0 or seen >= response_json.get('totalResultsCount', 0):
+            return
+        page += 1
+
+
+def query_bulk_status(args):
+    '''
+    Prints the status of every job selected by UUID, label or status, using
+    the query endpoint rather than one status request per job.
+    '''
+    workflow_ids = list(args['cromwell_ids'])
+    if args['ids_file']:
+        workflow_ids.extend(read_workflow_ids(args['ids_file']))
+    if len(workflow_ids) == 0 and len(args['label']) == 0 and len(args['status']) == 0:
+        print('Give job UUIDs, labels or statuses to select the jobs to query.')
+        sys.exit(1)
+
+    criteria = build_query_criteria(workflow_ids, args['label'], args['status'])
+    session = make_session(1)
+    if args['format'] == TABLE:
+        print('\t'.join(STATUS_TABLE_FIELDS))
+
+    found = set()
+    try:
+        for result in query_workflows(session, get_server_url(args), criteria):
+            found.add(result['id'])
+            if args['format'] == TABLE:
+                print('\t'.join(str(result.get(x, '-')) for x in STATUS_TABLE_FIELDS))
+            else:
+                print(json.dumps(result))
+    except (IOError, requests.exceptions.RequestException) as ex:
+        print(ex)
+        sys.exit(1)
+
+    missing = [x for x in workflow_ids if x not in found]
+    if len(missing) > 0:
+        sys.stderr.write('Cromwell did not return %d of the requested jobs: %s\n' % (len(missing), ', '.join(missing)))
+
+
+class WorkflowStateCache(object):
+    '''
+    The last known state of each watched workflow, and when to next poll it, kept
+    in SQLite so a restarted watcher picks up where it left off.  Workflows that
+    have reached a terminal state (or UNKNOWN_STATUS) are kept but never returned by due().
+    '''
+    DONE_STATES = TERMINAL_STATES + (UNKNOWN_STATUS,)
+
+    def __init__(self, cache_path):
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS workflows (
+            id TEXT PRIMARY KEY,
+            status TEXT,
+            name TEXT,
+            last_change REAL,
+            next_poll REAL,
+            interval REAL
+        )''')
+        self.connection.commit()
+
+    def add(self, workflow_ids):
+        self.connection.executemany('INSERT OR IGNORE INTO workflows (id, next_poll) VALUES (?, 0)',
+            [(x,) for x in workflow_ids])
+        self.connection.commit()
+
+    def get(self, workflow_id):
+        return self.connection.execute('SELECT status, name, interval FROM workflows WHERE id = ?',
+            (workflow_id,)).fetchone()
+
+    def update(self, workflow_id, status, name, changed, next_poll, interval):
+        if changed:
+            self.connection.execute('UPDATE workflows SET status = ?, name = ?, last_change = ? WHERE id = ?',
+                (status, name, time.time(), workflow_id))
+        self.connection.execute('UPDATE workflows SET next_poll = ?, interval = ? WHERE id = ?',
+            (next_poll, interval, workflow_id))
+
+    def commit(self):
+        self.connection.commit()
+
+    def due(self, now):
+        return [x[0] for x in self.connection.execute(self._active_query('AND next_poll <= ?'), self.DONE_STATES + (now,))]
+
+    def next_poll(self):
+        '''
+        The earliest time any non-terminal workflow is due, or None if there are none.
+        '''
+        return self.connection.execute(self._active_query('', 'MIN(next_poll)'), self.DONE_STATES).fetchone()[0]
+
+    def _active_query(self, condition, columns='id'):
+        placeholders = ', '.join('?' * len(self.DONE_STATES))
+        return 'SELECT %s FROM workflows WHERE (status IS NULL OR status NOT IN (%s)) %s' % (columns, placeholders, condition)
+
+
+def next_poll_interval(status, interval, changed):
+    '''
+    Seconds until a workflow is polled again: short just after a change of state,
+    then backing off for as long as it stays put.
+    '''
+    if changed or interval is None:
+        return POLL_INTERVALS.get(status, DEFAULT_POLL_INTERVAL)
+    return min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
+
+
+class WorkflowWatcher(object):
+    '''
+    Polls workflows until they reach a terminal state, calling each of `callbacks`
+    with an event dict whenever one changes state.  Due workflows are checked in
+    chunks of WATCH_QUERY_CHUNK through the query endpoint, with up to `concurrency`
+    calls in flight, driven from an asyncio loop.  If `criteria` is given, workflows
+    matching it are added every `discover_interval` seconds and the watcher runs
+    until stopped; otherwise it returns once every workflow is finished.
+
+    A workflow Cromwell does not return in MAX_MISSING_POLLS polls in a row (e.g. a
+    mistyped UUID) is marked UNKNOWN_STATUS, with an event, and no longer polled.
+    Callbacks run on a thread of their own, one event at a time, so a slow --hook
+    command does not hold up polling; close() waits for them to finish.
+    '''
+    def __init__(self, server_url, cache, callbacks, criteria=None, concurrency=DEFAULT_WATCH_CONCURRENCY,
+            discover_interval=DEFAULT_DISCOVER_INTERVAL):
+        self.server_url = server_url
+        self.cache = cache
+        self.callbacks = callbacks
+        self.criteria = criteria
+        self.discover_interval = discover_interval
+        self.session = make_session(concurrency)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.callback_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.missing_polls = {}
+
+    def fetch(self, criteria):
+        return list(query_workflows(self.session, self.server_url, criteria))
+
+    def emit(self, event):
+        self.callback_executor.submit(self.run_callbacks, event)
+
+    def run_callbacks(self, event):
+        for callback in self.callbacks:
+            try:
+                callback(event)
+            except Exception as ex:
+                print('ERROR: A state-change callback failed: %s' % ex)
+
+    def close(self):
+        self.callback_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+
+    def record(self, result, now):
+        previous = self.cache.get(result['id'])
+        if previous is None:
+            return
+        self.missing_polls.pop(result['id'], None)
+        previous_status, _, interval = previous
+        changed = result['status'] != previous_status
+        interval = next_poll_interval(result['status'], interval, changed)
+        self.cache.update(result['id'], result['status'], result.get('name'), changed, now + interval, interval)
+        if changed:
+            self.emit({
+                'timestamp': now,
+                'id': result['id'],
+                'name': result.get('name'),
+                'previous_status': previous_status,
+                'status': result['status']
+            })
+
+    def record_missing(self, workflow_id, now):
+        '''
+        Notes a poll that did not return `workflow_id`: it may not be known to Cromwell
+        yet, so it is polled again later, up to MAX_MISSING_POLLS times in a row.
+        '''
+        previous_status, name, interval = self.cache.get(workflow_id)
+        missing = self.missing_polls.get(workflow_id, 0) + 1
+        if missing < MAX_MISSING_POLLS:
+            self.missing_polls[workflow_id] = missing
+            self.poll_later(workflow_id, interval, now)
+            return
+        self.missing_polls.pop(workflow_id, None)
+        self.cache.update(workflow_id, UNKNOWN_STATUS, name, True, None, None)
+        self.emit({
+            'timestamp': now,
+            'id': workflow_id,
+            'name': name,
+            'previous_status': previous_status,
+            'status': UNKNOWN_STATUS
+        })
+
+    def poll_later(self, workflow_id, interval, now):
+        interval = next_poll_interval(None, interval, False)
+        self.cache.update(workflow_id, None, None, False, now + interval, interval)
+
+    async def discover(self, loop):
+        try:
+            results = await loop.run_in_executor(self.executor, self.fetch, self.criteria)
+        except (IOError, requests.exceptions.RequestException) as ex:
+            print('ERROR: Could not look for new jobs: %s' % ex)
+            return
+        self.cache.add([x['id'] for x in results])
+
+    async def poll(self, loop, now):
+        due = self.cache.due(now)
+        chunks = [due[i:i + WATCH_QUERY_CHUNK] for i in range(0, len(due), WATCH_QUERY_CHUNK)]
+        responses = await asyncio.gather(
+            *[loop.run_in_executor(self.executor, self.fetch, build_query_criteria(x)) for x in chunks],
+            return_exceptions=True
+        )
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, Exception):
+                # says nothing about the jobs themselves: try them all again later
+                print('ERROR: Could not poll %d jobs: %s' % (len(chunk), response))
+                for workflow_id in chunk:
+                    self.poll_later(workflow_id, self.cache.get(workflow_id)[2], now)
+                continue
+            returned = set()
+            for result in response:
+                returned.add(result['id'])
+                self.record(result, now)
+            for workflow_id in chunk:
+                if workflow_id not in returned:
+                    self.record_missing(workflow_id, now)
+        self.cache.commit()
+
+    async def run(self, loop):
+        next_discovery = 0
+        while True:
+            now = time.time()
+            if self.criteria and now >= next_discovery:
+                await self.discover(loop)
+                next_discovery = now + self.discover_interval
+            await self.poll(loop, now)
+
+            next_poll = self.cache.next_poll()
+            if next_poll is None and not self.criteria:
+                return
+            wake_time = next_discovery if self.criteria else next_poll
+            if next_poll is not None:
+                wake_time = min(wake_time, next_poll)
+            await asyncio.sleep(max(1, wake_time - time.time()))
+
+
+def make_event_writer(events_path):
+    '''
+    Returns a callback that appends each event as a line of JSON to `events_path` ("-" for stdout)
+    '''
+    fout = sys.stdout if events_path == '-' else open(events_path, 'a')
+
+    def write_event(event):
+        fout.write(json.dumps(event) + '\n')
+        fout.flush()
+    return write_event
+
+
+def make_hook(command):
+    '''
+    Returns a callback that runs a shell command with each event as JSON on stdin
+    '''
+    def run_hook(event):
+        subprocess.run(command, shell=True, input=json.dumps(event).encode('utf-8'))
+    return run_hook
+
+
+def watch_jobs(args):
+    workflow_ids = list(args['cromwell_ids'])
+    if args['ids_file']:
+        workflow_ids.extend(read_workflow_ids(args['ids_file']))
+    criteria = None
+    if len(args['label']) > 0 or len(args['status']) > 0:
+        criteria = build_query_criteria(labels=args['label'], statuses=args['status'])
+
+    cache = WorkflowStateCache(args['cache'])
+    cache.add(workflow_ids)
+    if cache.next_poll() is None and criteria is None:
+        print('No unfinished jobs to watch.  Give job UUIDs, labels or statuses.')
+        sys.exit(1)
+
+    callbacks = [make_event_writer(args['events'])]
+    if args['hook']:
+        callbacks.append(make_hook(args['hook']))
+    watcher = WorkflowWatcher(get_server_url(args), cache, callbacks, criteria,
+        concurrency=args['concurrency'],
+        discover_interval=args['discover_interval']
+    )
+    # a loop of our own, since asyncio.get_event_loop() with none running is deprecated
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(watcher.run(loop))
+    except KeyboardInterrupt:
+        cache.commit()
+    finally:
+        watcher.close()
+        loop.close()
+
+
+class MetadataStreamParser(object):
+    '''
+    Splits a workflow metadata document into pieces as its text arrives, so only one
+    top-level field or one call attempt is held in memory at a time, however large
+    the whole document is.  feed() returns the pieces completed so far, each either
+    ('workflow', key, value) for a top-level field or ('call', call_name, call) for
+    one entry of the "calls" lists.
+
+    Only the outline of the document (the top-level object, "calls" and its lists)
+    is walked here; each value within it is handed to the json module whole.
+    Invalid JSON raises ValueError, at the latest once the last block is fed.
+    '''
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    DELIMITERS = ',}]'
+    DOCUMENT, FIELD, FIELD_VALUE, CALLS, CALL_NAME, CALL_LIST, CALL, DONE = range(8)
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.state = self.DOCUMENT
+        self.key = None
+        self.call_name = None
+        self.retry_length = 0
+        self.final = False
+
+    @property
+    def finished(self):
+        return self.state == self.DONE
+
+    def feed(self, data, final=False):
+        self.buffer += self.decoder.decode(data, final)
+        self.final = final
+        # a value cut off by the end of the buffer is re-tried once the buffer
+        # has doubled, so very large values are not re-parsed for every block
+        if len(self.buffer) < self.retry_length and not final:
+            return []
+        pieces = []
+        pos = 0
+        while True:
+            pos = self.WHITESPACE.match(self.buffer, pos).end()
+            if pos >= len(self.buffer) or self.state == self.DONE:
+                break
+            try:
+                pos = self._step(pos, pieces)
+            except IndexError:
+                break
+        self.buffer = self.buffer[pos:]
+        self.retry_length = 2 * len(self.buffer)
+        return pieces
+
+    def close(self):
+        '''
+        Returns any pieces still held back once the whole document has been fed.
+        '''
+        return self.feed(b'', final=True)
+
+    def _step(self, pos, pieces):
+        '''
+        Consumes one token or value starting at `pos` and returns the position after it.
+        Raises IndexError if the buffer does not yet hold all of it, or ValueError
+        if it is not valid.
+        '''
+        c = self.buffer[pos]
+        if self.state in (self.DOCUMENT, self.CALLS, self.CALL_LIST):
+            expected = '[' if self.state == self.CALL_LIST else '{'
+            if c != expected:
+                raise ValueError('Unexpected "%s" in metadata; expected "%s"' % (c, expected))
+            self.state = {self.DOCUMENT: self.FIELD, self.CALLS: self.CALL_NAME, self.CALL_LIST: self.CALL}[self.state]
+            return pos + 1
+        if self.state in (self.FIELD, self.CALL_NAME):
+            if c == ',':
+                return pos + 1
+            if c == '}':
+                self.state = self.DONE if self.state == self.FIELD else self.FIELD
+                return pos + 1
+            key, end = self._decode(pos, ':')
+            colon = self.WHITESPACE.match(self.buffer, end).end()
+            if self.buffer[colon] != ':':
+                raise ValueError('Unexpected "%s" in metadata; expected ":"' % self.buffer[colon])
+            if self.state == self.CALL_NAME:
+                self.call_name = key
+                self.state = self.CALL_LIST
+            else:
+                self.key = key
+                self.state = self.CALLS if key == 'calls' else self.FIELD_VALUE
+            return colon + 1
+        if self.state == self.CALL:
+            if c == ',':
+                return pos + 1
+            if c == ']':
+                self.state = self.CALL_NAME
+                return pos + 1
+            value, end = self._decode(pos)
+            pieces.append(('call', self.call_name, value))
+            return end
+        value, end = self._decode(pos)
+        pieces.append(('workflow', self.key, value))
+        self.state = self.FIELD
+        return end
+
+    def _decode(self, pos, delimiters=DELIMITERS):
+        try:
+            value, end = self.json_decoder.raw_decode(self.buffer, pos)
+        except json.decoder.JSONDecodeError:
+            if self.final:
+                raise
+            raise IndexError()
+        # every value here is followed by a delimiter.  Until one is seen the value
+        # may be incomplete: a number cut off at "12." or "1.5e" decodes as 12 or 1.5
+        after = self.WHITESPACE.match(self.buffer, end).end()
+        if after >= len(self.buffer) or self.buffer[after] not in delimiters:
+            if self.final:
+                raise ValueError('Unexpected end of metadata after a value' if after >= len(self.buffer)
+                    else 'Unexpected "%s" in metadata after a value' % self.buffer[after])
+            raise IndexError()
+        return value, end
+
+
+def get_metadata_params(include_keys=(), exclude_keys=(), expand_subworkflows=False):
+    include_keys = list(include_keys)
+    if len(include_keys) > 0 and 'status' not in include_keys:
+        # the status says whether the response can be cached
+        include_keys.append('status')
+    params = [('includeKey', x) for x in include_keys]
+    params.extend(('excludeKey', x) for x in exclude_keys)
+    if expand_subworkflows:
+        params.append(('expandSubWorkflows', 'true'))
+    return params
+
+
+def get_metadata_cache_path(cache_dir, workflow_id, params):
+    '''
+    Cached metadata is keyed by the workflow and by the query, since different
+    include/exclude keys give different documents.
+    '''
+    params_hash = hashlib.sha1(json.dumps(params).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, '%s-%s.json.gz' % (workflow_id, params_hash))
+
+
+def iter_metadata(session, server_url, workflow_id, params, cache_dir=None):
+    '''
+    Yields the pieces of a workflow's metadata (see MetadataStreamParser) as they are
+    parsed.  If `cache_dir` is given, finished workflows are read from there, and
+    the compressed response of a newly finished workflow is saved there on the way
+    through, so a repeat lookup makes no request at all.  Only a response that was
+    read and parsed to the end is saved; a cached copy that turns out to be
+    incomplete is removed and an IOError raised, so the next lookup fetches it again.
+    '''
+    parser = MetadataStreamParser()
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = get_metadata_cache_path(cache_dir, workflow_id, params)
+        if os.path.exists(cache_path):
+            try:
+                with gzip.open(cache_path, 'rb') as fin:
+                    for block in iter(lambda: fin.read(METADATA_READ_SIZE), b''):
+                        for piece in parser.feed(block):
+                            yield piece
+                for piece in parser.close():
+                    yield piece
+            except (EOFError, OSError, ValueError):
+                # a truncated or corrupt file; reported below since the parser is not finished
+                pass
+            if not parser.finished:
+                os.remove(cache_path)
+                raise IOError('The cached metadata for %s (%s) was incomplete and has been removed.  Run again to fetch it from Cromwell.'
+                    % (workflow_id, cache_path))
+            return
+
+    url = server_url + DEFAULT_CONFIG['metadata_endpoint'].format(api_version = API_VERSION, job_uuid=workflow_id)
+    response = session.get(url, params=params, stream=True,
+        timeout=max(METADATA_TIMEOUT, http_client.default_timeout))
+    if response.status_code != 200:
+        raise IOError('Metadata request for %s was not successful.  Received status code %d: %s'
+            % (workflow_id, response.status_code, response.text))
+
+    cache_out = None
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        cache_out = gzip.open(tmp_path, 'wb')
+    status = None
+    complete = False
+    try:
+        try:
+            for block in response.iter_content(METADATA_READ_SIZE):
+                if cache_out is not None:
+                    cache_out.write(block)
+                for piece in parser.feed(block):
+                    if piece[0] == 'workflow' and piece[1] == 'status':
+                        status = piece[2]
+                    yield piece
+            for piece in parser.close():
+                yield piece
+        except ValueError as ex:
+            raise IOError('The metadata for %s was not valid JSON: %s' % (workflow_id, ex))
+        if not parser.finished:
+            raise IOError('The metadata for %s ended early or was not valid JSON' % workflow_id)
+        complete = True
+    finally:
+        response.close()
+        if cache_out is not None:
+            cache_out.close()
+            # the generator may also stop here because the caller stopped reading it,
+            # in which case the file does not hold the whole document
+            if complete and status in TERMINAL_STATES:
+                os.replace(tmp_path, cache_path)
+            else:
+                os.remove(tmp_path)
+
+
+def iter_call_records(call_name, call, fields=None):
+    '''
+    Yields a record for a call attempt, and for each call of its subworkflow if
+    the metadata was expanded.  With `fields`, a record keeps only those fields.
+    '''
+    record = {'call': call_name}
+    for key, value in call.items():
+        if key != 'subWorkflowMetadata' and (fields is None or key in fields or key in CALL_ID_FIELDS):
+            record[key] = value
+    yield record
+    subworkflow = call.get('subWorkflowMetadata', {})
+    for sub_call_name, sub_calls in subworkflow.get('calls', {}).items():
+        for sub_call in sub_calls:
+            for sub_record in iter_call_records(sub_call_name, sub_call, fields):
+                yield sub_record
+
+
+def print_metadata(args):
+    '''
+    Prints a job's metadata as JSON lines: one line per top-level field and one
+    per call attempt, keeping only --fields if given.
+    '''
+    params = get_metadata_params(args['include_key'], args['exclude_key'], args['expand_subworkflows'])
+    cache_dir = None if args['no_cache'] else args['cache_dir']
+    fields = args['fields']
+    session = make_session(1)
+    try:
+        for kind, key, value in iter_metadata(session, get_server_url(args), args['cromwell_id'], params, cache_dir):
+            if kind == 'workflow':
+                if fields is None or key in fields:
+                    print(json.dumps({key: value}))
+            else:
+                for record in iter_call_records(key, value, fields):
+                    print(json.dumps(record))
+    except (IOError, requests.exceptions.RequestException) as ex:
+        print(ex)
+        sys.exit(1)
+
+
+def parse_timestamp(text):
+    '''
+    Converts one of Cromwell's ISO-8601 timestamps to seconds since the epoch
+    '''
+    m = TIMESTAMP_PATTERN.match(text)
+    if m is None:
+        raise ValueError('Could not parse the timestamp %s' % text)
+    seconds = datetime.datetime.strptime(m.group(1), '%Y-%m-%dT%H:%M:%S').replace(
+        tzinfo=datetime.timezone.utc).timestamp()
+    seconds += float(m.group(2) or 0)
+    offset = m.group(3)
+    if offset and offset != 'Z':
+        offset = offset.replace(':', '')
+        sign = -1 if offset[0] == '-' else 1
+        seconds -= sign * (int(offset[1:3])*3600 + int(offset[3:5])*60)
+    return seconds
+
+
+def classify_event(description):
+    description = description.lower()
+    for pattern, phase, priority in PHASE_PATTERNS:
+        if pattern in description:
+            return phase, priority
+    return DEFAULT_PHASE
+
+
+def get_phase_times(events):
+    '''
+    Returns the seconds a call spent in each of PHASES, from its executionEvents.
+    Where events overlap, each moment is counted once, for the highest-priority phase.
+    '''
+    boundaries = []
+    for event in events:
+        if 'startTime' not in event or 'endTime' not in event:
+            continue
+        phase, priority = classify_event(event.get('description', ''))
+        start = parse_timestamp(event['startTime'])
+        end = parse_timestamp(event['endTime'])
+        if end > start:
+            boundaries.append((start, 1, priority, phase))
+            boundaries.append((end, -1, priority, phase))
+    boundaries.sort()
+
+    phase_times = dict((x, 0.0) for x in PHASES)
+    active = {}
+    last_time = None
+    for timestamp, change, priority, phase in boundaries:
+        if last_time is not None and len(active) > 0:
+            phase_times[max(active)[1]] += timestamp - last_time
+        key = (priority, phase)
+        active[key] = active.get(key, 0) + change
+        if active[key] == 0:
+            del active[key]
+        last_time = timestamp
+    return phase_times
+
+
+def iter_task_calls(call_name, call):
+    '''
+    Yields (call_name, call) for a call attempt, or for each task call inside it
+    if it ran a subworkflow.
+    '''
+    subworkflow = call.get('subWorkflowMetadata')
+    if subworkflow is None:
+        yield call_name, call
+        return
+    for sub_call_name, sub_calls in subworkflow.get('calls', {}).items():
+        for sub_call in sub_calls:
+            for task_call in iter_task_calls(sub_call_name, sub_call):
+                yield task_call
+
+
+def find_critical_path(spans):
+    '''
+    Given (call_name, shard, start, end) for each call, returns the chain that
+    decided when the workflow finished: the last call to end, then the last call to
+    end before that one started, and so on back to the beginning.
+    '''
+    spans = sorted(spans, key=lambda x: x[3])
+    ends = [x[3] for x in spans]
+    path = []
+    i = len(spans) - 1
+    while i >= 0:
+        path.append(spans[i])
+        # step back to the last call that had ended by the time this one started
+        i = min(bisect.bisect_right(ends, spans[i][2] + CRITICAL_PATH_TOLERANCE), i) - 1
+    path.reverse()
+    return path
+
+
+def new_task_profile():
+    profile = {'calls': 0, 'wall': 0.0, 'critical_path_calls': 0, 'critical_path_time': 0.0}
+    profile.update((x, 0.0) for x in PHASES)
+    return profile
+
+
+def profile_workflow(session, server_url, workflow_id, cache_dir=None):
+    '''
+    Reads one workflow's timing metadata a call at a time.  Returns a dict of per-task
+    profiles and the workflow's critical path.  Only a small tuple per call is kept.
+    '''
+    params = get_metadata_params(PROFILE_METADATA_KEYS, expand_subworkflows=True)
+    tasks = {}
+    spans = []
+    for kind, key, value in iter_metadata(session, server_url, workflow_id, params, cache_dir):
+        if kind != 'call':
+            continue
+        for call_name, call in iter_task_calls(key, value):
+            if 'start' not in call or 'end' not in call:
+                continue
+            start = parse_timestamp(call['start'])
+            end = parse_timestamp(call['end'])
+            profile = tasks.setdefault(call_name, new_task_profile())
+            profile['calls'] += 1
+            profile['wall'] += end - start
+            for phase, seconds in get_phase_times(call.get('executionEvents', [])).items():
+                profile[phase] += seconds
+            spans.append((call_name, call.get('shardIndex', -1), start, end))
+
+    critical_path = find_critical_path(spans)
+    for call_name, shard, start, end in critical_path:
+        tasks[call_name]['critical_path_calls'] += 1
+        tasks[call_name]['critical_path_time'] += end - start
+    return {'id': workflow_id, 'tasks': tasks, 'critical_path': critical_path}
+
+
+def merge_task_profiles(total, tasks):
+    for call_name, profile in tasks.items():
+        merged = total.setdefault(call_name, new_task_profile())
+        for key, value in profile.items():
+            merged[key] += value
+
+
+def print_profile_report(report, top):
+    tasks = report['tasks']
+    total_wall = sum(x['wall'] for x in tasks.values()) or 1
+    print('Profiled %d jobs (%d could not be read)' % (report['workflows'], len(report['failed'])))
+    print('')
+    print('\t'.join(['task', 'calls', 'wall_hours', 'pct_wall'] + ['mean_%s_min' % x for x in PHASES]
+        + ['critical_path_calls', 'critical_path_hours']))
+    ranked = sorted(tasks.items(), key=lambda x: x[1]['wall'], reverse=True)
+    for call_name, profile in ranked[:top]:
+        calls = profile['calls'] or 1
+        print('\t'.join([call_name, str(profile['calls']),
+            '%.2f' % (profile['wall'] / 3600), '%.1f' % (100.0 * profile['wall'] / total_wall)]
+            + ['%.1f' % (profile[x] / calls / 60) for x in PHASES]
+            + [str(profile['critical_path_calls']), '%.2f' % (profile['critical_path_time'] / 3600)]))
+
+    if len(report['critical_paths']) == 1:
+        workflow_id, path = list(report['critical_paths'].items())[0]
+        print('')
+        print('Critical path of %s:' % workflow_id)
+        for call_name, shard, start, end in path:
+            print('\t'.join([call_name, str(shard), '%.1f min' % ((end - start) / 60)]))
+
+
+def profile_jobs(args):
+    '''
+    Profiles each selected job and aggregates the per-task breakdown across all of them.
+    Jobs are read `concurrency` at a time and only their summaries are kept.
+    '''
+    workflow_ids = list(args['cromwell_ids'])
+    if args['ids_file']:
+        workflow_ids.extend(read_workflow_ids(args['ids_file']))
+    server_url = get_server_url(args)
+    session = make_session(args['concurrency'])
+    if len(args['label']) > 0 or len(args['status']) > 0:
+        criteria = build_query_criteria(labels=args['label'], statuses=args['status'])
+        workflow_ids.extend(x['id'] for x in query_workflows(session, server_url, criteria))
+    if len(workflow_ids) == 0:
+        print('No jobs to profile.  Give job UUIDs, labels or statuses.')
+        sys.exit(1)
+
+    cache_dir = None if args['no_cache'] else args['cache_dir']
+    report = {'workflows': 0, 'failed': [], 'tasks': {}, 'critical_paths': {}}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args['concurrency']) as executor:
+        future_to_id = {}
+        for workflow_id in workflow_ids:
+            future = executor.submit(profile_workflow, session, server_url, workflow_id, cache_dir)
+            future_to_id[future] = workflow_id
+        for future in concurrent.futures.as_completed(future_to_id):
+            workflow_id = future_to_id[future]
+            try:
+                result = future.result()
+            except (IOError, ValueError, requests.exceptions.RequestException) as ex:
+                print('ERROR: Could not profile %s: %s' % (workflow_id, ex))
+                report['failed'].append(workflow_id)
+                continue
+            report['workflows'] += 1
+            merge_task_profiles(report['tasks'], result['tasks'])
+            report['critical_paths'][workflow_id] = result['critical_path']
+
+    if args['format'] == TABLE:
+        print_profile_report(report, args['top'])
+    else:
+        print(json.dumps(report))
+
+
 def abort_job(args):
     # pull together the components of the POST request to the Cromwell server
     endpoint = DEFAULT_CONFIG['abort_endpoint'].format(api_version = API_VERSION, job_uuid=args['cromwell_id'])
     request_url = CROMWELL_SERVER_URL.format(ip=args['ip'], port=args['port']) + endpoint
-    response = requests.post(request_url)
+    response = make_session(1).post(request_url)
     if response.status_code == 200:
         print(response.text)
     else:
         print('Abort request was not successful.  Received status code %d' % response.status_code)
 
 
+def abort_workflow(session, server_url, workflow_id, retries=DEFAULT_ABORT_RETRIES):
+    '''
+    Asks Cromwell to abort one workflow, re-sending after server or connection errors.
+    Returns (took_effect, detail): detail is the new status if it took effect, and
+    otherwise the reason it did not.
+    '''
+    endpoint = DEFAULT_CONFIG['abort_endpoint'].format(api_version = API_VERSION, job_uuid=workflow_id)
+    # aborting twice is harmless, so the POST may be re-sent
+    retry = http_client.RetryPolicy(retries, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX,
+        statuses=range(500, 600), methods=None)
+    try:
+        response = session.post(server_url + endpoint, retry=retry)
+    except requests.exceptions.RequestException as ex:
+        return False, str(ex)
+    if response.status_code == 200:
+        return True, response.json().get('status', 'Aborting')
+    if response.status_code < 500:
+        # e.g. 403 if it already finished, 404 if Cromwell does not know it
+        return False, 'status code %d: %s' % (response.status_code, response.text.strip())
+    return False, 'status code %d' % response.status_code
+
+
+def abort_batch(args):
+    '''
+    Aborts every unfinished job selected by UUID, label and submission time, found
+    through the query endpoint, with up to --max-concurrent aborts in flight.
+    Prints whether each abort took effect and returns the list of (id, took_effect, detail).
+    '''
+    workflow_ids = list(args['cromwell_ids'])
+    if args['ids_file']:
+        workflow_ids.extend(read_workflow_ids(args['ids_file']))
+    if len(workflow_ids) == 0 and len(args['label']) == 0 and not args['submitted_after'] and not args['submitted_before']:
+        print('Give job UUIDs, labels or a submission time window to select the jobs to abort.')
+        sys.exit(1)
+
+    server_url = get_server_url(args)
+    session = make_session(args['max_concurrent'])
+    criteria = build_query_criteria(workflow_ids, args['label'], ACTIVE_STATES, args['submitted_after'])
+    submitted_before = parse_timestamp(args['submitted_before']) if args['submitted_before'] else None
+    try:
+        selected = [x['id'] for x in query_workflows(session, server_url, criteria)
+            if submitted_before is None or ('submission' in x and parse_timestamp(x['submission']) < submitted_before)]
+    except (IOError, requests.exceptions.RequestException) as ex:
+        print(ex)
+        sys.exit(1)
+
+    if args['dry_run'] or len(selected) == 0:
+        print('%d unfinished jobs matched:' % len(selected))
+        for workflow_id in selected:
+            print(workflow_id)
+        return []
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args['max_concurrent']) as executor:
+        future_to_id = {}
+        for workflow_id in selected:
+            future = executor.submit(abort_workflow, session, server_url, workflow_id, args['retries'])
+            future_to_id[future] = workflow_id
+        for future in concurrent.futures.as_completed(future_to_id):
+            took_effect, detail = future.result()
+            results.append((future_to_id[future], took_effect, detail))
+
+    for workflow_id, took_effect, detail in sorted(results):
+        print('%s\t%s\t%s' % (workflow_id, 'aborted' if took_effect else 'FAILED', detail))
+    aborted = len([x for x in results if x[1]])
+    print('Abort took effect for %d of %d jobs.' % (aborted, len(results)))
+    return results
+
+
 if __name__ == '__main__':
     args = parse_cl_args()
+    http_client.configure(timeout=args['timeout'], stats_path=args['http_stats'])
 
     if args['subcommand'] == QUERY:
         query_job_status(args)
+    elif args['subcommand'] == STATUS:
+        query_bulk_status(args)
+    elif args['subcommand'] == WATCH:
+        watch_jobs(args)
+    elif args['subcommand'] == METADATA:
+        print_metadata(args)
+    elif args['subcommand'] == PROFILE:
+        profile_jobs(args)
     elif args['subcommand'] == SUBMIT:
         submit_job(args)
+    elif args['subcommand'] == SUBMIT_BATCH:
+        submit_batch(args)
     elif args['subcommand'] == ABORT:
         abort_job(args)
+    elif args['subcommand'] == ABORT_BATCH:
+        abort_batch(args)
     else:
         print('Unrecognized subcommand.')
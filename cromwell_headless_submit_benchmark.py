@@ -0,0 +1,432 @@
+'''
+Measures how cromwell_headless_submit.py scales, and how much load it puts on
+Cromwell, against a local, fake Cromwell server.
+
+The fake server speaks enough of the Cromwell REST API (submission, batch
+submission, query, status, metadata and abort) for the submit, query and abort code paths
+to run unmodified.  A fixed latency is added to every request, and a fraction of
+requests can be made to fail with a 503, to mimic a loaded server.
+
+For each scenario we record throughput, the number of requests the server saw,
+client-side latency percentiles and peak Python memory.  Results are written as
+JSON lines, one per scenario run, so runs of different versions can be compared.
+'''
+import os
+import io
+import json
+import time
+import uuid
+import email
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import tracemalloc
+import http.server
+import urllib.parse
+import cromwell_headless_submit
+
+DEFAULT_LATENCY = 20 # milliseconds added to each request
+DEFAULT_ERROR_RATE = 0.0 # fraction of requests answered with a 503
+DEFAULT_NUM_WORKFLOWS = 500
+DEFAULT_OUTPUT = 'cromwell_headless_submit_benchmark.jsonl'
+API_PREFIX = '/api/workflows/%s' % cromwell_headless_submit.API_VERSION
+TIMESTAMP = '2020-01-01T00:00:00.000Z'
+BENCHMARK_WDL = 'workflow benchmark {}\n'
+
+
+class FakeCromwellStore(object):
+    '''
+    The workflows known to the fake server, by id, the dependencies zip (if any)
+    each was submitted with, and the "calls" of the metadata of any that have them.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.workflows = {}
+        self.dependencies = {}
+        self.calls = {}
+
+    def submit(self, dependencies=None):
+        workflow_id = str(uuid.uuid4())
+        with self.lock:
+            self.workflows[workflow_id] = {'id': workflow_id, 'name': 'benchmark', 'status': 'Submitted', 'submission': TIMESTAMP}
+            if dependencies is not None:
+                self.dependencies[workflow_id] = dependencies
+        return workflow_id
+
+    def query(self, criteria):
+        '''
+        Applies the id and status criteria of a query; labels and times match everything.
+        '''
+        ids = set(x['id'] for x in criteria if 'id' in x)
+        statuses = set(x['status'] for x in criteria if 'status' in x)
+        with self.lock:
+            return [dict(x) for x in self.workflows.values()
+                if (len(ids) == 0 or x['id'] in ids) and (len(statuses) == 0 or x['status'] in statuses)]
+
+    def set_all(self, status):
+        with self.lock:
+            for workflow in self.workflows.values():
+                workflow['status'] = status
+
+
+def filter_metadata(document, include_keys, expand_subworkflows):
+    '''
+    Applies includeKey and expandSubWorkflows the way Cromwell does: only the included
+    keys are kept, at the top level and in each call, and a call's subworkflow is
+    expanded only if its subWorkflowId is one of them.
+    '''
+    if len(include_keys) > 0:
+        document = dict((k, v) for k, v in document.items() if k in include_keys or k in ('id', 'calls'))
+    calls = {}
+    for call_name, attempts in document.get('calls', {}).items():
+        calls[call_name] = []
+        for call in attempts:
+            subworkflow = call.get('subWorkflowMetadata')
+            if len(include_keys) > 0:
+                call = dict((k, v) for k, v in call.items() if k in include_keys and k != 'subWorkflowMetadata')
+            else:
+                call = dict((k, v) for k, v in call.items() if k != 'subWorkflowMetadata')
+            if subworkflow is not None and expand_subworkflows and 'subWorkflowId' in call:
+                call['subWorkflowMetadata'] = filter_metadata(subworkflow, include_keys, expand_subworkflows)
+            calls[call_name].append(call)
+    return dict(document, calls=calls)
+
+
+class FakeCromwellHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Handles the Cromwell API routes used by cromwell_headless_submit.py.
+    '''
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes; without this, delayed ACKs add ~40ms to each response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.latency)
+        path = self.path.split('?')[0]
+        if not path.startswith(API_PREFIX):
+            self.send_json(404, {'status': 'fail', 'message': 'unknown route %s' % path})
+            return
+        parts = [x for x in path[len(API_PREFIX):].split('/') if x]
+        route = '%s %s' % (method, parts[-1] if len(parts) > 0 else 'submit')
+        self.server.count(route)
+        if random.random() < self.server.error_rate:
+            self.send_json(503, {'status': 'fail', 'message': 'injected error'})
+            return
+
+        if route == 'POST submit':
+            dependencies = self.get_form_field(body, 'workflowDependencies')
+            self.send_json(201, {'id': self.server.store.submit(dependencies), 'status': 'Submitted'})
+        elif route == 'POST batch':
+            if not self.server.batch_enabled:
+                self.send_json(404, {'status': 'fail', 'message': 'no batch endpoint'})
+                return
+            inputs = json.loads(self.get_form_field(body, 'workflowInputs'))
+            dependencies = self.get_form_field(body, 'workflowDependencies')
+            self.send_json(201, [{'id': self.server.store.submit(dependencies), 'status': 'Submitted'} for x in inputs])
+        elif route == 'POST query':
+            self.route_query(json.loads(body.decode('utf-8')))
+        elif route == 'GET status':
+            workflow = self.server.store.workflows.get(parts[0])
+            if workflow is None:
+                self.send_json(404, {'status': 'fail', 'message': 'unknown workflow'})
+            else:
+                self.send_json(200, {'id': workflow['id'], 'status': workflow['status']})
+        elif route == 'GET metadata':
+            workflow = self.server.store.workflows.get(parts[0])
+            if workflow is None:
+                self.send_json(404, {'status': 'fail', 'message': 'unknown workflow'})
+            else:
+                query = urllib.parse.parse_qs(self.path.partition('?')[2])
+                document = dict(workflow, calls=self.server.store.calls.get(parts[0], {}))
+                self.send_json(200, filter_metadata(document, query.get('includeKey', []),
+                    query.get('expandSubWorkflows') == ['true']))
+        elif route == 'POST abort':
+            self.route_abort(parts[0])
+        else:
+            self.send_json(404, {'status': 'fail', 'message': 'unknown route %s' % path})
+
+    def route_query(self, criteria):
+        page = int(next((x['page'] for x in criteria if 'page' in x), 1))
+        page_size = int(next((x['pageSize'] for x in criteria if 'pageSize' in x), 1000))
+        results = self.server.store.query(criteria)
+        self.send_json(200, {
+            'results': results[(page - 1) * page_size:page * page_size],
+            'totalResultsCount': len(results)
+        })
+
+    def route_abort(self, workflow_id):
+        with self.server.store.lock:
+            workflow = self.server.store.workflows.get(workflow_id)
+            if workflow is None:
+                self.send_json(404, {'status': 'fail', 'message': 'unknown workflow'})
+                return
+            if workflow['status'] in cromwell_headless_submit.TERMINAL_STATES:
+                self.send_json(403, {'status': 'fail', 'message': 'workflow is %s' % workflow['status']})
+                return
+            workflow['status'] = 'Aborting'
+        self.send_json(200, {'id': workflow_id, 'status': 'Aborting'})
+
+    def get_form_field(self, body, name):
+        message = email.message_from_bytes(
+            ('Content-Type: %s\r\n\r\n' % self.headers['Content-Type']).encode('utf-8') + body)
+        for part in message.get_payload():
+            if part.get_param('name', header='content-disposition') == name:
+                return part.get_payload(decode=True)
+        return None
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeCromwellServer(http.server.ThreadingHTTPServer):
+    '''
+    A local stand-in for a Cromwell server.  `latency` is in seconds and
+    `error_rate` is the fraction of requests that fail with a 503.
+    '''
+    daemon_threads = True
+
+    def __init__(self, latency, error_rate, batch_enabled=True):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), FakeCromwellHandler)
+        self.store = FakeCromwellStore()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.batch_enabled = batch_enabled
+        self.counts_lock = threading.Lock()
+        self.request_counts = {}
+
+    def count(self, route):
+        with self.counts_lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+
+    def reset_counts(self):
+        with self.counts_lock:
+            counts = self.request_counts
+            self.request_counts = {}
+        return counts
+
+
+class LatencyRecorder(object):
+    '''
+    Records how long each response took to arrive, by hooking the sessions that
+    cromwell_headless_submit.make_session hands out.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.original_make_session = cromwell_headless_submit.make_session
+
+    def install(self):
+        cromwell_headless_submit.make_session = self.make_session
+
+    def make_session(self, pool_size):
+        session = self.original_make_session(pool_size)
+        session.hooks['response'].append(self.record)
+        return session
+
+    def record(self, response, *args, **kwargs):
+        with self.lock:
+            self.latencies.append(response.elapsed.total_seconds())
+
+    def reset(self):
+        with self.lock:
+            latencies = self.latencies
+            self.latencies = []
+        return latencies
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def run_scenario(output, scenario, server, recorder, num_workflows, func, trace_memory=True, **settings):
+    '''
+    Times func(), which returns how many workflows it handled successfully, and writes
+    the result along with the server's request counts and the client's latencies.
+    Anything the code under test prints is discarded.
+    '''
+    server.reset_counts()
+    recorder.reset()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            succeeded = func()
+        except SystemExit:
+            # the code under test gave up, e.g. on an injected error
+            succeeded = 0
+    seconds = time.time() - started
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    counts = server.reset_counts()
+    latencies = recorder.reset()
+    requests_made = sum(counts.values())
+    result = {
+        'scenario': scenario,
+        'workflows': num_workflows,
+        'succeeded': succeeded,
+        'seconds': seconds,
+        'workflows_per_second': num_workflows / seconds,
+        'requests': requests_made,
+        'requests_per_workflow': requests_made / float(num_workflows),
+        'request_counts': counts,
+        'latency_p50_ms': None if not latencies else 1000 * percentile(latencies, 0.5),
+        'latency_p90_ms': None if not latencies else 1000 * percentile(latencies, 0.9),
+        'latency_p99_ms': None if not latencies else 1000 * percentile(latencies, 0.99),
+        'latency_max_ms': None if not latencies else 1000 * max(latencies),
+        'peak_memory_mb': None if peak_memory is None else peak_memory / (1024*1024.0),
+        'latency_ms': server.latency * 1000,
+        'error_rate': server.error_rate
+    }
+    result.update(settings)
+    output.write(json.dumps(result, sort_keys=True) + '\n')
+    output.flush()
+    print('%s %s: %.1f workflows/s, %d requests, %d/%d succeeded' % (scenario, json.dumps(settings, sort_keys=True),
+        result['workflows_per_second'], requests_made, succeeded, num_workflows))
+    return result
+
+
+def count_printed_ids(func, workflow_ids):
+    '''
+    Runs func() and returns how many of `workflow_ids` it printed a JSON status for.
+    Only a successful (200) response is printed as JSON, so this counts the jobs
+    Cromwell actually answered for.
+    '''
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        func()
+    found = set()
+    for line in output.getvalue().splitlines():
+        try:
+            found.add(json.loads(line)['id'])
+        except (ValueError, KeyError, TypeError):
+            pass
+    return len(found.intersection(workflow_ids))
+
+
+def parse_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark cromwell_headless_submit.py against a local fake Cromwell server.')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+        help='Latency added to each request, in milliseconds.  Default: %s' % DEFAULT_LATENCY)
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_ERROR_RATE,
+        help='Fraction of requests the server fails with a 503.  Default: %s' % DEFAULT_ERROR_RATE)
+    parser.add_argument('--num-workflows', type=int, default=DEFAULT_NUM_WORKFLOWS,
+        help='Number of workflows submitted, queried and aborted.  Default: %s' % DEFAULT_NUM_WORKFLOWS)
+    parser.add_argument('--max-concurrent', type=parse_list, default=[1, 8],
+        help='Comma-separated numbers of concurrent requests to try.  Default: 1,8')
+    parser.add_argument('--no-memory', action='store_true',
+        help='Do not trace peak memory (tracing slows the client down a little)')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT,
+        help='Where to write the results, as JSON lines.  Default: %s' % DEFAULT_OUTPUT)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    workdir = tempfile.mkdtemp()
+    inputs_dir = os.path.join(workdir, 'inputs')
+    os.makedirs(inputs_dir)
+    for i in range(args.num_workflows):
+        with open(os.path.join(inputs_dir, 'sample_%05d.json' % i), 'w') as fout:
+            json.dump({'benchmark.sample': 'sample_%05d' % i}, fout)
+    main_wdl = os.path.join(workdir, 'benchmark.wdl')
+    with open(main_wdl, 'w') as fout:
+        fout.write(BENCHMARK_WDL)
+    manifest = os.path.join(workdir, 'submitted.tsv')
+
+    server = FakeCromwellServer(args.latency / 1000.0, args.error_rate)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    recorder = LatencyRecorder()
+    recorder.install()
+    output = open(args.output, 'a')
+    trace_memory = not args.no_memory
+    common_args = {'ip': server.server_address[0], 'port': server.server_address[1]}
+    submit_args = dict(common_args,
+        inputs=inputs_dir,
+        dependencies_zip=None,
+        zone='us-east4-c',
+        output_manifest=manifest,
+        rate=0,
+        no_auto_zip=True,
+        preflight=False,
+        main_wdl=main_wdl
+    )
+
+    def count_submitted():
+        return len(cromwell_headless_submit.read_workflow_ids(manifest))
+
+    try:
+        def submit_batch_endpoint():
+            server.batch_enabled = True
+            cromwell_headless_submit.submit_batch(dict(submit_args, max_concurrent=1, no_batch_endpoint=False))
+            return count_submitted()
+        run_scenario(output, 'submit_batch_endpoint', server, recorder, args.num_workflows, submit_batch_endpoint,
+            trace_memory=trace_memory, max_concurrent=1)
+
+        for max_concurrent in args.max_concurrent:
+            def submit_individually():
+                cromwell_headless_submit.submit_batch(dict(submit_args, max_concurrent=max_concurrent, no_batch_endpoint=True))
+                return count_submitted()
+            run_scenario(output, 'submit_individually', server, recorder, args.num_workflows, submit_individually,
+                trace_memory=trace_memory, max_concurrent=max_concurrent)
+
+        workflow_ids = cromwell_headless_submit.read_workflow_ids(manifest)
+        server.store.set_all('Running')
+
+        def status_one_by_one():
+            def query_each():
+                for workflow_id in workflow_ids:
+                    cromwell_headless_submit.query_job_status(dict(common_args, cromwell_id=workflow_id))
+            return count_printed_ids(query_each, workflow_ids)
+        run_scenario(output, 'status_one_by_one', server, recorder, len(workflow_ids), status_one_by_one,
+            trace_memory=trace_memory, max_concurrent=1)
+
+        def status_bulk():
+            return count_printed_ids(lambda: cromwell_headless_submit.query_bulk_status(dict(common_args,
+                cromwell_ids=[], ids_file=manifest, label=[], status=[], format=cromwell_headless_submit.JSON_LINES)),
+                workflow_ids)
+        run_scenario(output, 'status_bulk', server, recorder, len(workflow_ids), status_bulk,
+            trace_memory=trace_memory, max_concurrent=1)
+
+        for max_concurrent in args.max_concurrent:
+            def abort_batch():
+                server.store.set_all('Running')
+                results = cromwell_headless_submit.abort_batch(dict(common_args, cromwell_ids=[], ids_file=manifest,
+                    label=[], submitted_after=None, submitted_before=None, max_concurrent=max_concurrent,
+                    retries=cromwell_headless_submit.DEFAULT_ABORT_RETRIES, dry_run=False))
+                return len([x for x in results if x[1]])
+            run_scenario(output, 'abort_batch', server, recorder, len(workflow_ids), abort_batch,
+                trace_memory=trace_memory, max_concurrent=max_concurrent)
+    finally:
+        output.close()
+        server.shutdown()
+        shutil.rmtree(workdir)
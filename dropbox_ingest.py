@@ -0,0 +1,295 @@
+'''
+Copies files from Dropbox straight into Google storage and registers them with CNAP,
+without staging them on local disk.
+
+Each Dropbox download stream is piped into a resumable Google storage upload, a
+buffer at a time, with several files in flight at once.  Once the copies are done,
+the new objects are registered through register_files.register_files.
+
+The storage and registration sides are plain objects/callables (see GCSSink and
+make_cnap_registrar), so either can be replaced by a local stand-in.
+'''
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+import concurrent.futures
+import dropbox
+import requests
+import dropbox_transfer
+import register_files
+
+GCS_UPLOAD_URL = 'https://storage.googleapis.com/upload/storage/v1/b/{bucket}/o'
+GCS_CHUNK_SIZE = 8*1024*1024 # bytes per resumable upload request; must be a multiple of 256KB
+GCS_CHUNK_RETRIES = 5 # how many times a single chunk is attempted before giving up
+GCS_TOKEN_LIFETIME = 45*60 # seconds before we fetch a fresh access token (they last an hour)
+DEFAULT_FILE_WORKERS = 4 # how many files are copied at once
+
+
+def split_gs_path(gs_path):
+    '''
+    Splits gs://bucket/some/object into ('bucket', 'some/object')
+    '''
+    bucket, _, name = gs_path[len(register_files.GS_PREFIX):].partition('/')
+    return bucket, name
+
+
+def get_gcs_token():
+    '''
+    Gets an OAuth access token for Google storage from the gcloud CLI.
+    '''
+    cmd = 'gcloud auth print-access-token'
+    p = subprocess.Popen(cmd, shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        print('Could not get an access token for Google storage.  Command was: %s' % cmd)
+        sys.exit(1)
+    return stdout.decode('utf-8').strip()
+
+
+class GCSSink(object):
+    '''
+    Opens resumable uploads into Google storage, sharing one pooled HTTP session.
+    The access token comes from `token_provider` and is refreshed every GCS_TOKEN_LIFETIME seconds.
+    '''
+    def __init__(self, token_provider=get_gcs_token, upload_url=GCS_UPLOAD_URL, pool_size=DEFAULT_FILE_WORKERS):
+        self.token_provider = token_provider
+        self.upload_url = upload_url
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._token = None
+        self._token_time = 0
+        self._lock = threading.Lock()
+
+    def auth_header(self):
+        with self._lock:
+            if self._token is None or time.time() - self._token_time > GCS_TOKEN_LIFETIME:
+                self._token = self.token_provider()
+                self._token_time = time.time()
+            return {'Authorization': 'Bearer %s' % self._token}
+
+    def open(self, gs_path):
+        return GCSResumableUpload(self, gs_path)
+
+
+class GCSResumableUpload(object):
+    '''
+    A file-like writer for a single object, using the Google storage resumable upload protocol.
+
+    Written data is buffered and sent in GCS_CHUNK_SIZE requests, so at most one chunk
+    is held in memory.  A chunk that fails is re-sent from the buffer, starting after
+    whatever the server reports it has already persisted.  close() sends the remainder
+    and finalizes the object.
+    '''
+    def __init__(self, sink, gs_path):
+        self.sink = sink
+        self.gs_path = gs_path
+        self.offset = 0
+        self._buffer = bytearray()
+        bucket, name = split_gs_path(gs_path)
+        url = sink.upload_url.format(bucket=bucket)
+        params = {'uploadType': 'resumable', 'name': name}
+        headers = sink.auth_header()
+        headers['X-Upload-Content-Type'] = 'application/octet-stream'
+        response = sink.session.post(url, params=params, headers=headers, timeout=dropbox_transfer.DEFAULT_TIMEOUT)
+        if response.status_code != 200:
+            raise IOError('Could not start an upload to %s.  Received status code %d: %s'
+                % (gs_path, response.status_code, response.text))
+        self.session_url = response.headers['Location']
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= GCS_CHUNK_SIZE:
+            self._send(GCS_CHUNK_SIZE, final=False)
+
+    def close(self):
+        self._send(len(self._buffer), final=True)
+
+    def _send(self, length, final):
+        '''
+        Sends the first `length` bytes of the buffer.  If `final`, the total size is
+        declared so Google storage completes the object.
+        '''
+        target = self.offset + length
+        failures = 0
+        while True:
+            try:
+                # a failed request may have been partly kept; ask where to carry on from
+                if failures > 0 and self._put(0, 'bytes */*'):
+                    return
+                if self.offset < target:
+                    total = str(target) if final else '*'
+                    content_range = 'bytes %d-%d/%s' % (self.offset, target - 1, total)
+                elif final:
+                    content_range = 'bytes */%d' % target
+                else:
+                    return
+                if self._put(target - self.offset, content_range):
+                    return
+            except requests.exceptions.RequestException as ex:
+                failures += 1
+                if failures >= GCS_CHUNK_RETRIES:
+                    raise
+                delay = dropbox_transfer.backoff_delay(failures)
+                print('ERROR: Sending %s at offset %d failed (%s).  Retrying in %.1f seconds' % (self.gs_path, self.offset, ex, delay))
+                time.sleep(delay)
+
+    def _put(self, length, content_range):
+        '''
+        Sends the first `length` bytes of the buffer, then drops whatever the server
+        says it has persisted.  Returns True once the object is complete.
+        '''
+        headers = self.sink.auth_header()
+        headers['Content-Range'] = content_range
+        response = self.sink.session.put(self.session_url,
+            data=bytes(self._buffer[:length]),
+            headers=headers,
+            timeout=dropbox_transfer.DEFAULT_TIMEOUT
+        )
+        if response.status_code in (200, 201):
+            return True
+        if response.status_code == 308:
+            # the Range header covers what the server has; absent means nothing yet
+            persisted = 0
+            if 'Range' in response.headers:
+                persisted = int(response.headers['Range'].split('-')[1]) + 1
+            del self._buffer[:persisted - self.offset]
+            self.offset = persisted
+            return False
+        if response.status_code >= 500 or response.status_code == 429:
+            raise requests.exceptions.HTTPError('Received status code %d' % response.status_code)
+        raise IOError('Upload to %s failed.  Received status code %d: %s'
+            % (self.gs_path, response.status_code, response.text))
+
+
+def make_cnap_registrar(username, password, cnap_user=None, expiry=None):
+    '''
+    Returns a function that registers a list of (gs:// path, size) pairs with CNAP,
+    owned by `cnap_user` (or the admin `username`, if not given), and returns a dict
+    of path -> error for those that were not registered.  Since the sizes are given,
+    nothing is listed with gsutil.  The token and owner are looked up once, here.
+    '''
+    token = register_files.get_token(username, password)
+    owner_pk = register_files.get_owner_pk(cnap_user or username, token)
+
+    def register(files):
+        args = {
+            register_files.TOKEN: token,
+            register_files.FILES: [(path, size, None, None) for path, size in files],
+            register_files.EXPIRY: expiry
+        }
+        registered, failed = register_files.register_files(args, owner_pk)
+        return failed
+    return register
+
+
+def ingest_file(dropbox_path, gs_path, client, sink):
+    '''
+    Streams a single file from Dropbox into the object at `gs_path`.
+    '''
+    metadata, response = client.files_download(dropbox_path)
+    started = time.time()
+    try:
+        writer = sink.open(gs_path)
+        for block in response.iter_content(dropbox_transfer.READ_BLOCK_SIZE):
+            writer.write(block)
+        writer.close()
+    finally:
+        response.close()
+    dropbox_transfer.record_metric('file',
+        file=gs_path,
+        direction='ingest',
+        bytes=metadata.size,
+        seconds=time.time() - started
+    )
+
+
+def ingest(dropbox_path, gs_prefix, client, sink, registrar, file_workers=DEFAULT_FILE_WORKERS):
+    '''
+    Copies everything under `dropbox_path` (a folder, or a single file) to Google storage
+    under `gs_prefix`, keeping the relative paths, with `file_workers` files in flight at once.
+    The objects that were copied successfully are then passed to `registrar`, as
+    (gs:// path, size) pairs with the sizes Dropbox listed, and it returns a dict of
+    path -> error for those it could not register.
+
+    Returns a dict mapping each gs:// path to None on success or an error message.
+    '''
+    gs_prefix = gs_prefix.rstrip('/')
+    metadata = client.files_get_metadata(dropbox_path)
+    if isinstance(metadata, dropbox.files.FileMetadata):
+        entries = [metadata]
+        prefix_length = len(os.path.dirname(metadata.path_display))
+    else:
+        entries = [x for x in dropbox_transfer.list_folder_recursive(dropbox_path, client)
+            if isinstance(x, dropbox.files.FileMetadata)]
+        prefix_length = len(dropbox_path.rstrip('/'))
+
+    results = {}
+    sizes = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=file_workers) as executor:
+        future_to_path = {}
+        for entry in entries:
+            gs_path = '%s/%s' % (gs_prefix, entry.path_display[prefix_length:].lstrip('/'))
+            sizes[gs_path] = entry.size
+            future = executor.submit(ingest_file, entry.path_lower, gs_path, client, sink)
+            future_to_path[future] = gs_path
+
+        for future in concurrent.futures.as_completed(future_to_path):
+            gs_path = future_to_path[future]
+            try:
+                future.result()
+                results[gs_path] = None
+            except Exception as ex:
+                print('ERROR: Failed to copy %s' % gs_path)
+                results[gs_path] = '%s: %s' % (type(ex).__name__, ex)
+
+    copied = sorted((x, sizes[x]) for x in results if results[x] is None)
+    if len(copied) > 0:
+        print('Registering %d files with CNAP' % len(copied))
+        failed = registrar(copied) or {}
+        for gs_path, error in failed.items():
+            results[gs_path] = 'Copied, but not registered with CNAP: %s' % error
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='''Copy files from Dropbox into Google storage
+        and register them with CNAP, without staging them on local disk.''')
+    parser.add_argument('-t', '--token', required=True, dest='access_token', help='The access token for Dropbox')
+    parser.add_argument('-s', '--source', required=True, help='The folder or file in Dropbox')
+    parser.add_argument('-g', '--gs-prefix', required=True,
+        help='The gs:// folder the files are copied into.  Relative paths under the Dropbox folder are kept.')
+    parser.add_argument('-u', '--username', required=True, help='Username of CNAP admin user')
+    parser.add_argument('-p', '--password', required=True, help='Password of CNAP admin user')
+    parser.add_argument('-c', '--cnap_user', required=False, help='''The username (email) of the user
+        who will own the files.  If blank, will assign the files to the admin user.''')
+    parser.add_argument('-e', '--expiration', required=False, help='The expiration date for the files.')
+    parser.add_argument('-n', '--parallel-files', type=int, default=DEFAULT_FILE_WORKERS, dest='file_workers',
+        help='The number of files copied at once.  Default: %d' % DEFAULT_FILE_WORKERS)
+    parser.add_argument('--metrics', help='Write per-file metrics as JSON lines to this file ("-" for stdout).')
+    args = parser.parse_args()
+
+    if not args.gs_prefix.startswith(register_files.GS_PREFIX):
+        print('The destination must start with "%s".' % register_files.GS_PREFIX)
+        sys.exit(1)
+    if args.expiration:
+        register_files.validate_datestring(args.expiration)
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.metrics:
+        dropbox_transfer.configure_metrics(args.metrics)
+
+    client = dropbox.dropbox.Dropbox(args.access_token, timeout=dropbox_transfer.DEFAULT_TIMEOUT)
+    registrar = make_cnap_registrar(args.username, args.password, args.cnap_user, args.expiration)
+    sink = GCSSink(pool_size=args.file_workers)
+    results = ingest(args.source, args.gs_prefix, client, sink, registrar, file_workers=args.file_workers)
+    failed = dropbox_transfer.report_transfer_results(results, action='copied')
+    if len(failed) > 0:
+        sys.exit(1)
@@ -1,15 +1,369 @@
 import os
 import sys
+import json
+import time
+import random
+import hashlib
 import argparse
+import threading
+import collections
+import concurrent.futures
 import dropbox
+import requests
 
 DEFAULT_TIMEOUT = 60 # how many seconds until we abandon trying to connect with Dropbox
 DEFAULT_CHUNK_SIZE = 150*1024*1024 # dropbox says ideally <150MB per chunk
+MAX_CHUNK_SIZE = 150*1024*1024 # dropbox will not accept more than 150MB in a single request
+READ_BLOCK_SIZE = 1024*1024 # how many bytes are written at a time when streaming a download to disk
+DEFAULT_MEMORY_CAP = 4*DEFAULT_CHUNK_SIZE # the most bytes of chunk data held in memory at once across all uploads
+DEFAULT_WORKERS = 1 # how many chunks of a single file are sent at once
+DEFAULT_FILE_WORKERS = 4 # how many files are sent at once when uploading a tree
+BATCH_FINISH_LIMIT = 1000 # dropbox allows at most 1000 sessions to be committed in one batch
+BATCH_POLL_INTERVAL = 1 # seconds between checks on a batch commit
+CONCURRENT_CHUNK_ALIGNMENT = 4*1024*1024 # concurrent upload sessions require chunks that are multiples of 4MB
+CONTENT_HASH_BLOCK_SIZE = 4*1024*1024 # dropbox's content_hash is computed over 4MB blocks
+DEFAULT_HASH_CACHE = os.path.join(os.path.expanduser('~'), '.dropbox_transfer_hash_cache.json')
+DEFAULT_SESSION_JOURNAL = os.path.join(os.path.expanduser('~'), '.dropbox_transfer_sessions.json')
+SESSION_MAX_AGE = 7*24*60*60 - 60*60 # dropbox upload sessions last 7 days; give up on them an hour early
+SERIAL_SESSION = 'serial'
+CONCURRENT_SESSION = 'concurrent'
+DOWNLOAD_URL = 'https://content.dropboxapi.com/2/files/download'
+DEFAULT_RANGE_SIZE = 64*1024*1024 # bytes requested per connection for ranged downloads
+RANGE_RETRIES = 5 # how many times a single byte range is attempted before giving up
+MIN_CHUNK_SIZE = 4*1024*1024 # the smallest chunk the adaptive chunk sizer will choose
+TARGET_CHUNK_SECONDS = 10 # the adaptive chunk sizer aims for chunks that take about this long to send
+ADAPTIVE_WINDOW = 4 # how many recent chunks the adaptive chunk sizer looks at
+BACKOFF_BASE = 1 # seconds; retries wait a random time up to BACKOFF_BASE * 2^(failures - 1)
+BACKOFF_MAX = 60 # seconds; the longest a retry will wait
 UPLOAD = 'upload'
 DOWNLOAD = 'download'
+SYNC = 'sync'
 ZIP = '.zip'
 
-def send_to_dropbox(local_filepath, dropbox_directory, client, root=None):
+metrics_output = None # a file that per-chunk and per-file metrics are written to (see configure_metrics)
+metrics_lock = threading.Lock()
+
+
+def backoff_delay(failures):
+    '''
+    Returns how long to wait before retrying after `failures` consecutive failures:
+    a random time up to an exponentially growing limit ("full jitter"), so that
+    many workers retrying at once do not all hit Dropbox at the same moment.
+    '''
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** max(0, failures - 1)))
+
+
+def configure_metrics(path):
+    '''
+    Directs transfer metrics to `path` as JSON lines (appending).  A path of "-" writes them to stdout.
+    '''
+    global metrics_output
+    metrics_output = sys.stdout if path == '-' else open(path, 'a')
+
+
+def record_metric(event, **fields):
+    '''
+    Writes one JSON line describing a transfer event (e.g. a "chunk" or "file").
+    Throughput in MB/s is added when the `bytes` and `seconds` fields are given.
+    Does nothing unless configure_metrics was called.
+    '''
+    if metrics_output is None:
+        return
+    fields['event'] = event
+    fields['timestamp'] = time.time()
+    if fields.get('bytes') is not None and fields.get('seconds'):
+        fields['mb_per_second'] = fields['bytes'] / fields['seconds'] / (1024*1024)
+    line = json.dumps(fields, sort_keys=True)
+    with metrics_lock:
+        metrics_output.write(line + '\n')
+        metrics_output.flush()
+
+
+class TransferStats(object):
+    '''
+    Counts retries and offset corrections over a single file transfer, which may
+    be spread over several worker threads.  Reported in the "file" metric.
+    '''
+    def __init__(self):
+        self.retries = 0
+        self.offset_corrections = 0
+        self._lock = threading.Lock()
+
+    def add(self, retries=0, offset_corrections=0):
+        with self._lock:
+            self.retries += retries
+            self.offset_corrections += offset_corrections
+
+
+class AdaptiveChunkSizer(object):
+    '''
+    Chooses the size of the next chunk of a serial upload from the throughput and
+    error rate of the last ADAPTIVE_WINDOW chunks.
+
+    The size aims for chunks that take about TARGET_CHUNK_SECONDS at the observed
+    throughput, so fast links send large chunks, and is halved for each recent error,
+    so a rewind on a flaky link costs little.  It grows at most 2x per chunk and stays a
+    multiple of 4MB between MIN_CHUNK_SIZE and `max_chunk_size`.
+
+    If `adaptive` is False, the chunk size never changes.
+    '''
+    def __init__(self, chunk_size, max_chunk_size=MAX_CHUNK_SIZE, adaptive=True):
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.adaptive = adaptive
+        self._recent = collections.deque(maxlen=ADAPTIVE_WINDOW)
+
+    def record(self, nbytes, seconds, ok):
+        '''
+        Records the outcome of sending a chunk and updates `chunk_size`.
+        '''
+        self._recent.append((nbytes, seconds, ok))
+        if not self.adaptive:
+            return
+        errors = len([x for x in self._recent if not x[2]])
+        sent_bytes = sum(x[0] for x in self._recent if x[2])
+        sent_seconds = sum(x[1] for x in self._recent if x[2])
+        if sent_seconds > 0:
+            target = sent_bytes / sent_seconds * TARGET_CHUNK_SECONDS
+        else:
+            target = self.chunk_size
+        target = min(target / (2 ** errors), self.chunk_size * 2)
+        target = int(target) - int(target) % CONCURRENT_CHUNK_ALIGNMENT
+        target = max(MIN_CHUNK_SIZE, min(target, self.max_chunk_size))
+        if target != self.chunk_size:
+            print('Adjusting chunk size from %d to %d bytes' % (self.chunk_size, target))
+            record_metric('chunk_size', previous=self.chunk_size, chunk_size=target, recent_errors=errors)
+            self.chunk_size = target
+
+
+class MemoryBudget(object):
+    '''
+    Limits the total size of the chunks held in memory at once, across every upload
+    in the process (all workers and all files).  The Dropbox client only accepts
+    bytes objects, so each chunk in flight costs its full size; readers wait here
+    until enough of the budget has been released by finished requests.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self._available = limit
+        self._condition = threading.Condition()
+
+    def acquire(self, n):
+        '''
+        Blocks until `n` bytes are available and reserves them.  Returns the amount
+        reserved, which is what should later be released.  A request for more than
+        the whole budget could never be held within it, so it is refused.
+        '''
+        if n > self.limit:
+            raise ValueError('Cannot hold a %d byte chunk in memory with a memory cap of %d bytes.  ' 
+                'Use a smaller chunk size or a larger memory cap.' % (n, self.limit))
+        with self._condition:
+            self._condition.wait_for(lambda: self._available >= n)
+            self._available -= n
+        return n
+
+    def release(self, n):
+        with self._condition:
+            self._available += n
+            self._condition.notify_all()
+
+
+UPLOAD_MEMORY = MemoryBudget(DEFAULT_MEMORY_CAP)
+
+
+class UploadChunk(object):
+    '''
+    Reads the next `length` bytes of `stream` (advancing it, like stream.read) while
+    holding that many bytes of the UPLOAD_MEMORY budget.  The bytes are available as
+    `data` inside the with-block and are dropped when it exits:
+
+        with UploadChunk(stream, chunk_size) as chunk:
+            client.files_upload_session_append_v2(chunk.data, cursor)
+
+    A "chunk" metric is recorded on exit, splitting the time into waiting for
+    memory, reading from disk, and the request itself (the body of the with-block).
+    '''
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.offset = stream.tell()
+        self.length = max(0, min(length, os.fstat(stream.fileno()).st_size - self.offset))
+        self.data = None
+        self._reserved = 0
+
+    def __enter__(self):
+        started = time.time()
+        self._reserved = UPLOAD_MEMORY.acquire(self.length)
+        self._read_started = time.time()
+        try:
+            self.data = self.stream.read(self.length)
+        except Exception:
+            UPLOAD_MEMORY.release(self._reserved)
+            raise
+        self._memory_wait_seconds = self._read_started - started
+        self._sent_started = time.time()
+        self.seconds = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        finished = time.time()
+        self.data = None
+        UPLOAD_MEMORY.release(self._reserved)
+        disk_seconds = self._sent_started - self._read_started
+        network_seconds = finished - self._sent_started
+        self.seconds = disk_seconds + network_seconds
+        record_metric('chunk', 
+            file=self.stream.name, 
+            offset=self.offset, 
+            bytes=self.length, 
+            seconds=disk_seconds + network_seconds,
+            disk_seconds=disk_seconds, 
+            network_seconds=network_seconds,
+            memory_wait_seconds=self._memory_wait_seconds, 
+            ok=exc_type is None,
+            error=None if exc_type is None else exc_type.__name__
+        )
+        return False
+
+
+def get_path_in_dropbox(local_filepath, dropbox_directory, root=None):
+    '''
+    Returns the path a local file will have in Dropbox.  See send_to_dropbox
+    for how `root` determines the relative path.
+    '''
+    if root is None:
+        relpath = os.path.basename(local_filepath)
+    else:
+        relpath = os.path.relpath(local_filepath, root)
+    return '%s/%s' % (dropbox_directory, relpath)
+
+
+def get_commit_info(path_in_dropbox, overwrite=False):
+    '''
+    Returns the dropbox.files.CommitInfo for a file.  By default Dropbox will not
+    replace an existing file (it is renamed instead); `overwrite` replaces it.
+    '''
+    if overwrite:
+        return dropbox.files.CommitInfo(path=path_in_dropbox, mode=dropbox.files.WriteMode.overwrite)
+    return dropbox.files.CommitInfo(path=path_in_dropbox)
+
+
+def load_json_file(path):
+    '''
+    Loads local state (e.g. the hash cache or session journal) saved with save_json_file.
+    A missing or unreadable file is treated as empty.
+    '''
+    try:
+        with open(path) as fin:
+            return json.load(fin)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_json_file(contents, path):
+    '''
+    Saves local state as JSON.  Written to a temporary file first so an
+    interrupted run does not leave a corrupt file behind.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fout:
+        json.dump(contents, fout)
+    os.replace(tmp_path, path)
+
+
+def get_file_identity(local_filepath):
+    '''
+    Returns a dict of the size, mtime and inode of a file.  If these are unchanged,
+    we assume the contents are too.
+    '''
+    st = os.stat(local_filepath)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'inode': st.st_ino}
+
+
+class SessionJournal(object):
+    '''
+    An on-disk record of the chunked uploads that are in progress, so that a
+    restarted run can continue an upload session rather than starting the file over.
+
+    Entries are keyed by the local path and its destination in Dropbox, and hold the
+    session ID, the file identity (see get_file_identity) when the session started,
+    and how much Dropbox has acknowledged:
+    - for serial sessions, the committed `offset`
+    - for concurrent sessions, the `chunk_size` and the offsets of `completed` chunks
+
+    The journal is saved after every change and is safe to share between threads.
+    Sessions older than SESSION_MAX_AGE are dropped when the journal is loaded.
+    '''
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+        self._entries = load_json_file(journal_path)
+        self.expire_stale_sessions()
+
+    def _key(self, local_filepath, path_in_dropbox):
+        return '%s -> %s' % (local_filepath, path_in_dropbox)
+
+    def _save(self):
+        save_json_file(self._entries, self.journal_path)
+
+    def expire_stale_sessions(self):
+        with self._lock:
+            now = time.time()
+            for key in list(self._entries):
+                if now - self._entries[key]['started'] > SESSION_MAX_AGE:
+                    print('Upload session for %s has expired.  Removing it from the journal.' % key)
+                    del self._entries[key]
+            self._save()
+
+    def lookup(self, local_filepath, path_in_dropbox, session_type, chunk_size=None):
+        '''
+        Returns the journal entry for a resumable upload of this file, or None.
+        Entries for a file that has changed since its session started are removed.
+        '''
+        key = self._key(local_filepath, path_in_dropbox)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if (entry['identity'] != get_file_identity(local_filepath)
+                    or entry['session_type'] != session_type
+                    or entry.get('chunk_size') != chunk_size):
+                print('%s has changed since its upload session started.  Starting over.' % local_filepath)
+                del self._entries[key]
+                self._save()
+                return None
+            return dict(entry)
+
+    def start(self, local_filepath, path_in_dropbox, session_id, session_type, offset=0, chunk_size=None):
+        entry = {
+            'session_id': session_id,
+            'session_type': session_type,
+            'identity': get_file_identity(local_filepath),
+            'started': time.time(),
+            'offset': offset,
+            'chunk_size': chunk_size,
+            'completed': []
+        }
+        with self._lock:
+            self._entries[self._key(local_filepath, path_in_dropbox)] = entry
+            self._save()
+
+    def update_offset(self, local_filepath, path_in_dropbox, offset):
+        with self._lock:
+            self._entries[self._key(local_filepath, path_in_dropbox)]['offset'] = offset
+            self._save()
+
+    def complete_chunk(self, local_filepath, path_in_dropbox, offset):
+        with self._lock:
+            self._entries[self._key(local_filepath, path_in_dropbox)]['completed'].append(offset)
+            self._save()
+
+    def remove(self, local_filepath, path_in_dropbox):
+        with self._lock:
+            self._entries.pop(self._key(local_filepath, path_in_dropbox), None)
+            self._save()
+
+
+def send_to_dropbox(local_filepath, dropbox_directory, client, root=None, workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE, overwrite=False, journal=None, adaptive=False):
     '''
     Sends a single file to Dropbox.  See behavior below.
 
@@ -37,69 +391,529 @@ def send_to_dropbox(local_filepath, dropbox_directory, client, root=None):
     `local_filepath` is the path on the VM/container.  Should be absolute.
     `dropbox_directory` is the folder where the files are deposited (in Dropbox)
     `client` is an instance of dropbox.Dropbox, which has already done the token exchange.
+    `workers` is the number of chunks sent at once for large files.  If >1, a concurrent
+        upload session is used (see send_chunks_concurrently).
+    `chunk_size` is the number of bytes sent per request.  Files no larger than this
+        are sent in a single request.  Chunks count against the process-wide
+        UPLOAD_MEMORY budget while they are in flight (see UploadChunk).
+    `overwrite` replaces an existing file in Dropbox of the same name.
+    `journal` is an optional SessionJournal.  If given, chunked uploads are recorded
+        there as they progress, and an upload of the same file that was interrupted
+        is resumed from the last offset Dropbox acknowledged.
+    `adaptive` lets the chunk size of a serial upload change as it goes, starting
+        from `chunk_size` (see AdaptiveChunkSizer).
     '''
 
     file_size = os.path.getsize(local_filepath)
     stream = open(local_filepath, 'rb')
+    started = time.time()
+    stats = TransferStats()
     
     # setup the paths in dropbox
-    if root is None:
-        relpath = os.path.basename(local_filepath)
-    else:
-        relpath = os.path.relpath(local_filepath, root)
-    path_in_dropbox = '%s/%s' % (dropbox_directory, relpath)
+    path_in_dropbox = get_path_in_dropbox(local_filepath, dropbox_directory, root)
 
     # if the file is smaller than the chunk size, just do a simple upload
-    if file_size <= DEFAULT_CHUNK_SIZE:
+    if file_size <= chunk_size:
         print('Performing upload in a single chunk.')
-        client.files_upload(stream.read(), path_in_dropbox)
+        commit = get_commit_info(path_in_dropbox, overwrite)
+        with UploadChunk(stream, file_size) as chunk:
+            client.files_upload(chunk.data, path_in_dropbox, mode=commit.mode)
+        print('Completed upload for %s' % local_filepath)
+    # if the file is larger and we have multiple workers, send chunks in parallel
+    elif workers > 1:
+        send_chunks_concurrently(local_filepath, file_size, path_in_dropbox, client, workers, chunk_size, overwrite, journal, stats)
         print('Completed upload for %s' % local_filepath)
     # if the file is larger, we have to send it in multiple chunks
     else:
         i = 1
-        session_start_result = client.files_upload_session_start(stream.read(DEFAULT_CHUNK_SIZE))
-        cursor=dropbox.files.UploadSessionCursor(session_start_result.session_id, offset=stream.tell())
-        commit=dropbox.files.CommitInfo(path=path_in_dropbox)
+        failures = 0
+        sizer = AdaptiveChunkSizer(chunk_size, max_chunk_size=min(MAX_CHUNK_SIZE, UPLOAD_MEMORY.limit), adaptive=adaptive)
+        entry = None
+        if journal is not None:
+            entry = journal.lookup(local_filepath, path_in_dropbox, SERIAL_SESSION)
+        if entry is not None:
+            print('Resuming upload session for %s at offset %d' % (local_filepath, entry['offset']))
+            cursor=dropbox.files.UploadSessionCursor(entry['session_id'], offset=entry['offset'])
+            stream.seek(entry['offset'])
+        else:
+            cursor = start_serial_session(local_filepath, path_in_dropbox, stream, client, chunk_size, journal)
+        commit=get_commit_info(path_in_dropbox, overwrite)
         while stream.tell() < file_size:
             print('Sending chunk %s' % i)
             try:
-                if (file_size-stream.tell()) <= DEFAULT_CHUNK_SIZE:
+                if (file_size-stream.tell()) <= sizer.chunk_size:
                     print('Finishing transfer and committing')
-                    client.files_upload_session_finish(stream.read(DEFAULT_CHUNK_SIZE), cursor, commit)
+                    with UploadChunk(stream, sizer.chunk_size) as chunk:
+                        client.files_upload_session_finish(chunk.data, cursor, commit)
+                    if journal is not None:
+                        journal.remove(local_filepath, path_in_dropbox)
                 else:
                     print('About to send chunk')
                     print('Prior to chunk transfer, cursor=%d, stream=%d' % (cursor.offset, stream.tell()))
-                    client.files_upload_session_append_v2(stream.read(DEFAULT_CHUNK_SIZE), cursor)
+                    with UploadChunk(stream, sizer.chunk_size) as chunk:
+                        client.files_upload_session_append_v2(chunk.data, cursor)
+                    sizer.record(chunk.length, chunk.seconds, True)
+                    failures = 0
                     cursor.offset = stream.tell()
+                    if journal is not None:
+                        journal.update_offset(local_filepath, path_in_dropbox, cursor.offset)
                     print('Done with sending chunk %s' % i)
             except dropbox.exceptions.ApiError as ex:
                 print('ERROR: Raised ApiError!')
-                if ex.error.is_incorrect_offset():
+                lookup_error = get_session_lookup_error(ex.error)
+                if lookup_error is not None and lookup_error.is_incorrect_offset():
                     print('ERROR: The error raised was an offset error.  Correcting the cursor and stream offset')
-                    correct_offset = ex.error.get_incorrect_offset().correct_offset
+                    correct_offset = lookup_error.get_incorrect_offset().correct_offset
+                    stats.add(offset_corrections=1)
                     cursor.offset = correct_offset
                     stream.seek(correct_offset)
+                    if journal is not None:
+                        journal.update_offset(local_filepath, path_in_dropbox, cursor.offset)
+                elif entry is not None and lookup_error is not None and lookup_error.is_not_found():
+                    print('ERROR: The resumed upload session no longer exists.  Starting the file over.')
+                    entry = None
+                    stream.seek(0)
+                    cursor = start_serial_session(local_filepath, path_in_dropbox, stream, client, chunk_size, journal)
                 else:
                     print('ERROR: API error was raised, but was not offset error')
                     raise ex
 
             except requests.exceptions.ConnectionError as ex:
                 print('ERROR: Caught a ConnectionError exception')
+                stats.add(retries=1)
+                sizer.record(0, 0, False)
+                failures += 1
                 # need to rewind the stream
                 print('At this point, cursor=%d, stream=%d' % (cursor.offset, stream.tell()))
                 cursor_offset = cursor.offset
                 stream.seek(cursor_offset)
                 print('After rewind, cursor=%d, stream=%d' % (cursor.offset, stream.tell()))
-                print('Go try that chunk again')
+                delay = backoff_delay(failures)
+                print('Go try that chunk again in %.1f seconds' % delay)
+                time.sleep(delay)
             except requests.exceptions.RequestException as ex:
                 print('ERROR: Caught an exception during chunk transfer')
                 print('ERROR: Following FAILED chunk transfer, cursor=%d, stream=%d' % (cursor.offset, stream.tell()))
                 raise ex
             i += 1
     stream.close()
+    record_metric('file', 
+        file=local_filepath, 
+        direction=UPLOAD, 
+        bytes=file_size, 
+        seconds=time.time() - started,
+        retries=stats.retries, 
+        offset_corrections=stats.offset_corrections
+    )
+
+
+def get_session_lookup_error(error):
+    '''
+    Returns the dropbox.files.UploadSessionLookupError behind the error of an upload
+    session call, or None if the session lookup was not what failed.  Appends raise
+    one directly, while a finish wraps it in an UploadSessionFinishError.
+    '''
+    if isinstance(error, dropbox.files.UploadSessionLookupError):
+        return error
+    if isinstance(error, dropbox.files.UploadSessionFinishError) and error.is_lookup_failed():
+        return error.get_lookup_failed()
+    return None
+
+
+def start_serial_session(local_filepath, path_in_dropbox, stream, client, chunk_size, journal=None):
+    '''
+    Starts an upload session with the first chunk of `stream` and returns the
+    dropbox.files.UploadSessionCursor following that chunk.  The session is
+    recorded in `journal`, if given.
+    '''
+    with UploadChunk(stream, chunk_size) as chunk:
+        session_start_result = client.files_upload_session_start(chunk.data)
+    cursor=dropbox.files.UploadSessionCursor(session_start_result.session_id, offset=stream.tell())
+    if journal is not None:
+        journal.start(local_filepath, path_in_dropbox, cursor.session_id, SERIAL_SESSION, offset=cursor.offset)
+    return cursor
+
+
+def send_chunks_concurrently(local_filepath, file_size, path_in_dropbox, client, workers, chunk_size=DEFAULT_CHUNK_SIZE, overwrite=False, journal=None, stats=None):
+    '''
+    Sends a large file to Dropbox using a "concurrent" upload session, which allows
+    chunks at different offsets to be appended at the same time.
+
+    Dropbox requires that every chunk except the last is a multiple of 4MB, so the
+    chunk size is rounded down to that boundary.  Once all the chunks are appended
+    (the last one closes the session), the session is finished with an empty request.
+
+    `local_filepath` is the path on the VM/container.
+    `file_size` is the size of that file, in bytes
+    `path_in_dropbox` is the final path of the file in Dropbox
+    `client` is an instance of dropbox.Dropbox, which has already done the token exchange.
+    `workers` is the number of chunks that are sent at once
+    `chunk_size` is the requested number of bytes per chunk
+    `overwrite` replaces an existing file in Dropbox of the same name.
+    `journal` is an optional SessionJournal.  Chunks recorded there as completed
+        in an interrupted upload of the same file are not sent again.
+    `stats` is an optional TransferStats that counts retries and offset corrections.
+    '''
+    chunk_size = max(CONCURRENT_CHUNK_ALIGNMENT, chunk_size - (chunk_size % CONCURRENT_CHUNK_ALIGNMENT))
+    entry = None
+    if journal is not None:
+        entry = journal.lookup(local_filepath, path_in_dropbox, CONCURRENT_SESSION, chunk_size)
+    if entry is not None:
+        session_id = entry['session_id']
+        completed = set(entry['completed'])
+        print('Resuming upload session for %s; %d chunks already sent' % (local_filepath, len(completed)))
+    else:
+        session_start_result = client.files_upload_session_start(b'', 
+            session_type=dropbox.files.UploadSessionType.concurrent
+        )
+        session_id = session_start_result.session_id
+        completed = set()
+        if journal is not None:
+            journal.start(local_filepath, path_in_dropbox, session_id, CONCURRENT_SESSION, chunk_size=chunk_size)
+
+    print('Sending %s in chunks of %d bytes using %d workers' % (local_filepath, chunk_size, workers))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for i, offset in enumerate(range(0, file_size, chunk_size)):
+            if offset in completed:
+                continue
+            length = min(chunk_size, file_size - offset)
+            is_last = (offset + length) == file_size
+            futures.append(executor.submit(send_chunk, 
+                local_filepath, session_id, offset, length, is_last, client, i + 1,
+                journal=journal, path_in_dropbox=path_in_dropbox, stats=stats
+            ))
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except Exception:
+            # don't bother sending the rest if one chunk failed for good
+            for future in futures:
+                future.cancel()
+            raise
+
+    print('Finishing transfer and committing')
+    cursor = dropbox.files.UploadSessionCursor(session_id, offset=file_size)
+    commit = get_commit_info(path_in_dropbox, overwrite)
+    client.files_upload_session_finish(b'', cursor, commit)
+    if journal is not None:
+        journal.remove(local_filepath, path_in_dropbox)
+
+
+def send_chunk(local_filepath, session_id, offset, length, is_last, client, chunk_number, journal=None, path_in_dropbox=None, stats=None):
+    '''
+    Appends the byte range [offset, offset + length) of a file to an upload session.
+    Runs in a worker thread, so it opens its own handle on the file.
+
+    Errors are handled the same way as the serial upload in send_to_dropbox:
+    offset errors move the cursor to the offset Dropbox reports (if that lies within
+    this chunk), and connection errors rewind to the cursor and try again.
+
+    Once the chunk is sent, it is marked complete in `journal` (if given) under `path_in_dropbox`.
+    Retries and offset corrections are counted in `stats`, if given.
+    '''
+    if stats is None:
+        stats = TransferStats()
+    failures = 0
+    end = offset + length
+    stream = open(local_filepath, 'rb')
+    cursor = dropbox.files.UploadSessionCursor(session_id, offset=offset)
+    try:
+        while cursor.offset < end:
+            print('Sending chunk %s' % chunk_number)
+            try:
+                stream.seek(cursor.offset)
+                with UploadChunk(stream, end - cursor.offset) as chunk:
+                    client.files_upload_session_append_v2(chunk.data, cursor, close=is_last)
+                cursor.offset = end
+                if journal is not None:
+                    journal.complete_chunk(local_filepath, path_in_dropbox, offset)
+                print('Done with sending chunk %s' % chunk_number)
+            except dropbox.exceptions.ApiError as ex:
+                print('ERROR: Raised ApiError on chunk %s!' % chunk_number)
+                if ex.error.is_incorrect_offset():
+                    correct_offset = ex.error.get_incorrect_offset().correct_offset
+                    if offset < correct_offset <= end:
+                        stats.add(offset_corrections=1)
+                        print('ERROR: The error raised was an offset error.  Correcting the cursor for chunk %s to %d' % (chunk_number, correct_offset))
+                        cursor.offset = correct_offset
+                    else:
+                        print('ERROR: Dropbox reported an offset (%d) outside of chunk %s' % (correct_offset, chunk_number))
+                        raise ex
+                else:
+                    print('ERROR: API error was raised, but was not offset error')
+                    raise ex
+            except requests.exceptions.ConnectionError as ex:
+                print('ERROR: Caught a ConnectionError exception on chunk %s' % chunk_number)
+                stats.add(retries=1)
+                failures += 1
+                delay = backoff_delay(failures)
+                print('Rewinding to cursor=%d.  Go try that chunk again in %.1f seconds' % (cursor.offset, delay))
+                time.sleep(delay)
+            except requests.exceptions.RequestException as ex:
+                print('ERROR: Caught an exception during transfer of chunk %s' % chunk_number)
+                print('ERROR: Following FAILED chunk transfer, cursor=%d' % cursor.offset)
+                raise ex
+    finally:
+        stream.close()
+
+
+def collect_upload_targets(local_filepaths):
+    '''
+    Expands the paths given on the commandline into the files to upload.
+
+    Returns a tuple of:
+    - a list of (local_filepath, root) pairs, where root is what should be passed to
+      send_to_dropbox (None for files given directly, the parent of the directory otherwise)
+    - a list of the paths that were skipped since they did not exist or were not files/directories
+    '''
+    targets = []
+    skipped_paths = []
+    for local_filepath in local_filepaths:
+        local_filepath = os.path.abspath(local_filepath)
+        if os.path.exists(local_filepath):
+            if os.path.isfile(local_filepath):
+                targets.append((local_filepath, None))
+            elif os.path.isdir(local_filepath):
+                # handle a directory.  Will not do anything with empty dirs
+                for root, dirs, files in os.walk(local_filepath):
+                    for f in files:
+                        full_path = os.path.join(root, f)
+                        targets.append((full_path, os.path.dirname(local_filepath)))
+            else:
+                print('WARN: the following path was not determined to be a file or a directory: %s' % local_filepath)
+                skipped_paths.append(local_filepath)
+        else: # a path did not exist
+            skipped_paths.append(local_filepath)
+    return targets, skipped_paths
+
+
+def stage_file_for_batch(local_filepath, path_in_dropbox, client, overwrite=False):
+    '''
+    Sends the entire contents of a (small) file in a single, closed upload session,
+    but does not commit it.  Returns the dropbox.files.UploadSessionFinishArg
+    that commits the file as part of a batch (see finish_upload_batch).
+    '''
+    file_size = os.path.getsize(local_filepath)
+    stream = open(local_filepath, 'rb')
+    try:
+        with UploadChunk(stream, file_size) as chunk:
+            session_start_result = client.files_upload_session_start(chunk.data, close=True)
+    finally:
+        stream.close()
+    cursor = dropbox.files.UploadSessionCursor(session_start_result.session_id, offset=file_size)
+    commit = get_commit_info(path_in_dropbox, overwrite)
+    return dropbox.files.UploadSessionFinishArg(cursor, commit)
+
+
+def finish_upload_batch(finish_args, client):
+    '''
+    Commits many staged upload sessions with a single files_upload_session_finish_batch
+    call, then waits on the asynchronous job Dropbox starts for it.
+
+    `finish_args` is a list of (local_filepath, dropbox.files.UploadSessionFinishArg) tuples,
+        with at most BATCH_FINISH_LIMIT items.
+
+    Returns a dict mapping each local path to None on success or an error message.
+    '''
+    results = {}
+    started = time.time()
+    launch = client.files_upload_session_finish_batch([x[1] for x in finish_args])
+    if launch.is_async_job_id():
+        async_job_id = launch.get_async_job_id()
+        job_status = client.files_upload_session_finish_batch_check(async_job_id)
+        while job_status.is_in_progress():
+            time.sleep(BATCH_POLL_INTERVAL)
+            job_status = client.files_upload_session_finish_batch_check(async_job_id)
+        batch_result = job_status.get_complete()
+    elif launch.is_complete():
+        batch_result = launch.get_complete()
+    else:
+        for local_filepath, finish_arg in finish_args:
+            results[local_filepath] = 'Unexpected response when committing batch: %s' % launch
+        return results
+
+    for (local_filepath, finish_arg), entry in zip(finish_args, batch_result.entries):
+        if entry.is_success():
+            results[local_filepath] = None
+        else:
+            results[local_filepath] = str(entry.get_failure())
+    record_metric('batch_commit', 
+        files=len(finish_args), 
+        failures=len([x for x in results.values() if x is not None]), 
+        seconds=time.time() - started
+    )
+    return results
+
+
+def upload_tree(targets, dropbox_directory, client, file_workers=DEFAULT_FILE_WORKERS, 
+    workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE, overwrite=False, journal=None, adaptive=False):
+    '''
+    Uploads many files at once using a pool of `file_workers` threads.
+
+    Files no larger than `chunk_size` are each sent in a single upload session and then
+    committed together, BATCH_FINISH_LIMIT at a time, rather than each paying for its own commit.
+    Larger files are sent (and committed) individually with send_to_dropbox.
+
+    `targets` is a list of (local_filepath, root) pairs, as returned by collect_upload_targets.
+    `workers` and `chunk_size` are passed along to send_to_dropbox for large files.
+    `overwrite` replaces existing files in Dropbox of the same name.
+    `journal` is an optional SessionJournal, used for large files (see send_to_dropbox).
+    `adaptive` adjusts the chunk size of large files as they are sent (see send_to_dropbox).
+
+    Returns a dict mapping each local path to None on success or an error message.
+    '''
+    results = {}
+    staged = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=file_workers) as executor:
+        future_to_path = {}
+        for local_filepath, root in targets:
+            path_in_dropbox = get_path_in_dropbox(local_filepath, dropbox_directory, root)
+            if os.path.getsize(local_filepath) <= chunk_size:
+                future = executor.submit(stage_file_for_batch, local_filepath, path_in_dropbox, client, overwrite)
+            else:
+                future = executor.submit(send_to_dropbox, local_filepath, dropbox_directory, client, 
+                    root=root, workers=workers, chunk_size=chunk_size, overwrite=overwrite, journal=journal, adaptive=adaptive
+                )
+            future_to_path[future] = local_filepath
+
+        for future in concurrent.futures.as_completed(future_to_path):
+            local_filepath = future_to_path[future]
+            try:
+                finish_arg = future.result()
+            except Exception as ex:
+                print('ERROR: Failed to upload %s' % local_filepath)
+                results[local_filepath] = '%s: %s' % (type(ex).__name__, ex)
+                continue
+            if finish_arg is None:
+                results[local_filepath] = None
+            else:
+                staged.append((local_filepath, finish_arg))
+
+    for i in range(0, len(staged), BATCH_FINISH_LIMIT):
+        batch = staged[i:i + BATCH_FINISH_LIMIT]
+        print('Committing batch of %d files' % len(batch))
+        try:
+            results.update(finish_upload_batch(batch, client))
+        except dropbox.exceptions.ApiError as ex:
+            for local_filepath, finish_arg in batch:
+                results[local_filepath] = str(ex)
+    return results
+
+
+def report_transfer_results(results, action='uploaded'):
+    '''
+    Prints the per-file outcome of upload_tree or download_tree.  Returns the list of paths that failed.
+    '''
+    failed_paths = []
+    for local_filepath in sorted(results):
+        error = results[local_filepath]
+        if error is None:
+            print('%s: %s' % (action.capitalize(), local_filepath))
+        else:
+            print('FAILED: %s (%s)' % (local_filepath, error))
+            failed_paths.append(local_filepath)
+    print('%d of %d files %s successfully.' % (len(results) - len(failed_paths), len(results), action))
+    return failed_paths
+
+
+def compute_content_hash(local_filepath):
+    '''
+    Computes the Dropbox content_hash of a local file: the SHA-256 of the concatenated
+    SHA-256 digests of each 4MB block.  The file is streamed through a single reused
+    buffer, so only one block is in memory at a time.
+
+    See https://www.dropbox.com/developers/reference/content-hash
+    '''
+    overall_hash = hashlib.sha256()
+    buffer = bytearray(CONTENT_HASH_BLOCK_SIZE)
+    view = memoryview(buffer)
+    with open(local_filepath, 'rb') as stream:
+        while True:
+            n = stream.readinto(buffer)
+            if n == 0:
+                break
+            overall_hash.update(hashlib.sha256(view[:n]).digest())
+    return overall_hash.hexdigest()
+
+
+def get_content_hash(local_filepath, hash_cache):
+    '''
+    Returns the Dropbox content_hash of a local file, using `hash_cache` (a dict
+    keyed by path) if the file's size, mtime and inode are unchanged since it was hashed.
+    Otherwise the file is read, and the cache is updated.
+    '''
+    identity = get_file_identity(local_filepath)
+    cached = hash_cache.get(local_filepath)
+    if cached is not None and all(cached.get(k) == v for k, v in identity.items()):
+        return cached['content_hash']
+    content_hash = compute_content_hash(local_filepath)
+    identity['content_hash'] = content_hash
+    hash_cache[local_filepath] = identity
+    return content_hash
 
 
-def pull_folder_from_dropbox(dropbox_path, local_path, client):
+def list_folder_recursive(dropbox_path, client):
+    '''
+    Yields the metadata of everything under `dropbox_path`, recursively,
+    following the listing cursor until Dropbox reports there is no more.
+    '''
+    result = client.files_list_folder(dropbox_path, recursive=True)
+    while True:
+        for entry in result.entries:
+            yield entry
+        if not result.has_more:
+            break
+        result = client.files_list_folder_continue(result.cursor)
+
+
+def list_remote_hashes(dropbox_directory, client):
+    '''
+    Lists everything under `dropbox_directory` (recursively, following pagination)
+    and returns a dict mapping the lowercased path of each file to its content_hash.
+    A folder that does not exist yet is treated as empty.
+    '''
+    remote_hashes = {}
+    try:
+        for entry in list_folder_recursive(dropbox_directory, client):
+            if isinstance(entry, dropbox.files.FileMetadata):
+                remote_hashes[entry.path_lower] = entry.content_hash
+    except dropbox.exceptions.ApiError as ex:
+        if ex.error.is_path() and ex.error.get_path().is_not_found():
+            return remote_hashes
+        raise ex
+    return remote_hashes
+
+
+def select_changed_targets(targets, dropbox_directory, client, hash_cache, file_workers=DEFAULT_FILE_WORKERS):
+    '''
+    Filters the (local_filepath, root) pairs from collect_upload_targets down to
+    those that are missing from Dropbox or whose content differs.  Local hashes are
+    computed with `file_workers` threads (and taken from `hash_cache` where possible).
+    '''
+    remote_hashes = list_remote_hashes(dropbox_directory, client)
+    print('Found %d files in Dropbox under %s' % (len(remote_hashes), dropbox_directory))
+
+    # only hash files that already exist remotely; everything else is uploaded regardless
+    candidates = []
+    changed = []
+    for local_filepath, root in targets:
+        path_in_dropbox = get_path_in_dropbox(local_filepath, dropbox_directory, root).lower()
+        remote_hash = remote_hashes.get(path_in_dropbox)
+        if remote_hash is None:
+            changed.append((local_filepath, root))
+        else:
+            candidates.append((local_filepath, root, remote_hash))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=file_workers) as executor:
+        local_hashes = executor.map(lambda x: get_content_hash(x[0], hash_cache), candidates)
+        for (local_filepath, root, remote_hash), local_hash in zip(candidates, local_hashes):
+            if local_hash != remote_hash:
+                changed.append((local_filepath, root))
+    return changed
+
+
+def pull_folder_from_dropbox(dropbox_path, local_path, client, file_workers=DEFAULT_FILE_WORKERS):
     '''
     Downloads a folder as a ZIP archive
 
@@ -109,6 +923,10 @@ def pull_folder_from_dropbox(dropbox_path, local_path, client):
     `dropbox_path` is the resource we are trying to download
     `local_path` is where the ZIP will be downloaded locally (e.g. /home/user/foo.zip)
     `client` is an instance of dropbox.Dropbox, the authenticated Dropbox API client
+    `file_workers` is the number of files downloaded at once if the folder is too large for a ZIP
+
+    If the folder is too large, it is downloaded file-by-file into a directory named
+    like the ZIP archive, without the extension (see download_tree).
     '''
 
     try:
@@ -123,25 +941,71 @@ def pull_folder_from_dropbox(dropbox_path, local_path, client):
         err = ex.error
         if err.too_large:
             print('The folder was too large to download as a ZIP.  Resorting to individual downloads...')
-            fallback_to_individual_downoads(dropbox_path, local_path, client)
+            local_dir = os.path.splitext(local_path)[0]
+            results = download_tree(dropbox_path, local_dir, client, file_workers=file_workers)
+            report_transfer_results(results, action='downloaded')
         else:
             print('There was an error downloading the folder from Dropbox (%s) to local path: %s' % (dropbox_path, local_path))
             print(ex)
             sys.exit(1)
 
 
-def fallback_to_individual_downoads(dropbox_path, local_path, client):
+def download_tree(dropbox_path, local_dir, client, file_workers=DEFAULT_FILE_WORKERS, hash_cache=None):
     '''
-    This is used if the folder is too large and we need to resort to individually downloading the files
+    Downloads the contents of a Dropbox folder into `local_dir`, recreating its
+    directory tree.  This is used if the folder is too large for a ZIP archive, or
+    if a ZIP was not wanted.
+
+    The folder is listed recursively (following pagination) and the files are
+    downloaded with a pool of `file_workers` threads.  Files that already exist locally
+    with the same size and content_hash are skipped, so an interrupted download
+    can simply be run again.  `hash_cache` is an optional dict of local content
+    hashes (see get_content_hash).
+
+    Returns a dict mapping each local path to None on success or an error message.
     '''
-    all_files = client.files_list_folder(dropbox_path)
-    # we initially had requested a zip archive be downloaded.
-    # Now, we assume they want the files in the same directory
+    if hash_cache is None:
+        hash_cache = {}
+    results = {}
+    prefix_length = len(dropbox_path.rstrip('/'))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=file_workers) as executor:
+        future_to_path = {}
+        for entry in list_folder_recursive(dropbox_path, client):
+            relpath = entry.path_display[prefix_length:].lstrip('/')
+            local_path = os.path.join(local_dir, relpath)
+            if isinstance(entry, dropbox.files.FolderMetadata):
+                os.makedirs(local_path, exist_ok=True)
+            elif isinstance(entry, dropbox.files.FileMetadata):
+                future = executor.submit(download_file_if_changed, entry, local_path, client, hash_cache)
+                future_to_path[future] = local_path
+
+        for future in concurrent.futures.as_completed(future_to_path):
+            local_path = future_to_path[future]
+            try:
+                future.result()
+                results[local_path] = None
+            except Exception as ex:
+                print('ERROR: Failed to download %s' % local_path)
+                results[local_path] = '%s: %s' % (type(ex).__name__, ex)
+    return results
+
+
+def download_file_if_changed(entry, local_path, client, hash_cache):
+    '''
+    Downloads the file described by `entry` (a dropbox.files.FileMetadata) to
+    `local_path`, unless an identical copy is already there.
+    '''
+    if (os.path.isfile(local_path) 
+            and os.path.getsize(local_path) == entry.size 
+            and get_content_hash(local_path, hash_cache) == entry.content_hash):
+        print('Skipping %s, which is already up to date.' % local_path)
+        return
     local_dir = os.path.dirname(local_path)
-    for f in all_files.entries:
-        p = f.path_lower
-        local_path = os.path.join(local_dir, os.path.basename(p))
-        pull_file_from_dropbox(p, local_path, client)
+    if local_dir:
+        os.makedirs(local_dir, exist_ok=True)
+    started = time.time()
+    client.files_download_to_file(local_path, entry.path_lower)
+    record_metric('file', file=local_path, direction=DOWNLOAD, bytes=entry.size, seconds=time.time() - started)
 
 
 def pull_file_from_dropbox(dropbox_path, local_path, client):
@@ -154,7 +1018,9 @@ def pull_file_from_dropbox(dropbox_path, local_path, client):
     '''
     try:
         print('Starting file download...')
-        client.files_download_to_file(local_path, dropbox_path)
+        started = time.time()
+        metadata = client.files_download_to_file(local_path, dropbox_path)
+        record_metric('file', file=local_path, direction=DOWNLOAD, bytes=metadata.size, seconds=time.time() - started)
         print('Completed file download.  File is available at %s' % local_path)
     except dropbox.exceptions.ApiError as ex:
         print('There was an error downloading from Dropbox (%s) to local path: %s' % (dropbox_path, local_path))
@@ -162,6 +1028,140 @@ def pull_file_from_dropbox(dropbox_path, local_path, client):
         sys.exit(1)
 
 
+def pull_file_ranged(dropbox_path, local_path, token, workers, range_size=DEFAULT_RANGE_SIZE, download_url=DOWNLOAD_URL):
+    '''
+    Downloads a single (large) file over several connections at once.
+
+    The file is split into byte ranges of `range_size`, which are requested with
+    HTTP Range headers from the download endpoint by a pool of `workers` threads.
+    Each range is written straight into its place in a preallocated local file, and
+    a range that fails is retried on its own (from the last byte written).  Finally,
+    the file is checked against the content_hash Dropbox reports for it.
+
+    `dropbox_path` is the resource we are trying to download
+    `local_path` is where the file will be downloaded locally
+    `token` is the Dropbox access token
+    `download_url` is the download endpoint; this only needs to change for testing.
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    headers = {
+        'Authorization': 'Bearer %s' % token,
+        'Dropbox-API-Arg': json.dumps({'path': dropbox_path})
+    }
+
+    started = time.time()
+    stats = TransferStats()
+    metadata = get_download_metadata(session, download_url, headers)
+    file_size = metadata['size']
+    print('Starting ranged download of %s (%d bytes) using %d workers' % (dropbox_path, file_size, workers))
+
+    fd = os.open(local_path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, file_size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for start in range(0, file_size, range_size):
+                end = min(start + range_size, file_size) - 1
+                futures.append(executor.submit(download_range, session, download_url, headers, fd, start, end, stats))
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        os.close(fd)
+
+    record_metric('file', 
+        file=local_path, 
+        direction=DOWNLOAD, 
+        bytes=file_size, 
+        seconds=time.time() - started, 
+        retries=stats.retries
+    )
+
+    content_hash = compute_content_hash(local_path)
+    if content_hash != metadata['content_hash']:
+        raise IOError('Downloaded file %s does not match Dropbox (content_hash %s, expected %s)' 
+            % (local_path, content_hash, metadata['content_hash']))
+    print('Completed file download.  File is available at %s' % local_path)
+
+
+def get_download_metadata(session, download_url, headers):
+    '''
+    Returns the file metadata (as a dict) Dropbox sends in the Dropbox-API-Result
+    header of a download.  Only the first byte of the file is requested.
+    '''
+    probe_headers = dict(headers)
+    probe_headers['Range'] = 'bytes=0-0'
+    response = session.post(download_url, headers=probe_headers, stream=True, timeout=DEFAULT_TIMEOUT)
+    try:
+        response.raise_for_status()
+        return json.loads(response.headers['Dropbox-API-Result'])
+    finally:
+        response.close()
+
+
+def download_range(session, download_url, headers, fd, start, end, stats=None):
+    '''
+    Downloads bytes [start, end] (inclusive, as in HTTP) of a file and writes them at
+    the same position in the open file `fd`.  If the transfer fails part way, the
+    request is repeated for the bytes not yet written, up to RANGE_RETRIES times.
+    Retries are counted in `stats`, if given.
+    '''
+    position = start
+    for attempt in range(RANGE_RETRIES):
+        range_headers = dict(headers)
+        range_headers['Range'] = 'bytes=%d-%d' % (position, end)
+        attempt_start = position
+        started = time.time()
+        disk_seconds = 0
+        error = None
+        try:
+            response = session.post(download_url, headers=range_headers, stream=True, timeout=DEFAULT_TIMEOUT)
+            try:
+                if response.status_code != 206:
+                    raise requests.exceptions.HTTPError('Expected partial content for bytes %d-%d, received status code %d' 
+                        % (position, end, response.status_code), response=response)
+                for block in response.iter_content(READ_BLOCK_SIZE):
+                    write_started = time.time()
+                    view = memoryview(block)
+                    while len(view) > 0:
+                        n = os.pwrite(fd, view, position)
+                        view = view[n:]
+                        position += n
+                    disk_seconds += time.time() - write_started
+            finally:
+                response.close()
+            if position <= end:
+                print('WARN: Range %d-%d ended early at %d' % (start, end, position))
+                error = 'ShortRead'
+        except requests.exceptions.RequestException as ex:
+            print('ERROR: Caught an exception while downloading bytes %d-%d: %s' % (position, end, ex))
+            error = type(ex).__name__
+        seconds = time.time() - started
+        record_metric('range', 
+            offset=attempt_start, 
+            bytes=position - attempt_start, 
+            seconds=seconds,
+            disk_seconds=disk_seconds, 
+            network_seconds=seconds - disk_seconds, 
+            ok=error is None, 
+            error=error
+        )
+        if error is None:
+            return
+        if stats is not None:
+            stats.add(retries=1)
+        if attempt + 1 < RANGE_RETRIES:
+            time.sleep(backoff_delay(attempt + 1))
+    raise IOError('Could not download bytes %d-%d after %d attempts' % (start, end, RANGE_RETRIES))
+
+
 def parse_args():
     main_parser = argparse.ArgumentParser(prog='Dropbox upload/downloader')
     subparsers = main_parser.add_subparsers(help='Subcommand', dest='subcommand')
@@ -173,6 +1173,13 @@ def parse_args():
         If the path arguments contain directories, this will recursively upload those.
         '''
     )
+    sync_parser = subparsers.add_parser(SYNC, 
+        help='Upload only new or changed files to Dropbox',
+        description = '''
+        Like upload, but files whose content already matches the copy in Dropbox
+        (compared by Dropbox content_hash) are skipped, and changed files are overwritten.
+        '''
+    )
     downloader_parser = subparsers.add_parser(DOWNLOAD, 
         help='Download from Dropbox', 
         description='''Downloads a file or folder.  
@@ -184,16 +1191,51 @@ def parse_args():
     )
 
     main_parser.add_argument("-t", "--token", help="The access token for Dropbox", dest='access_token', required=True)
+    main_parser.add_argument("--metrics", help='''Write per-chunk and per-file transfer metrics as JSON lines 
+        to this file ("-" for stdout).''', dest='metrics')
 
     # for uploads, we allow either folders or files in the list of things to upload.  Folders will be recursively transferred.
-    uploader_parser.add_argument("path", help="The paths of the files or folders to transfer", nargs='+')
-    uploader_parser.add_argument("-d", help='The "root" folder in Dropbox where the files/folders will go', dest='dropbox_destination_root', required=True)
+    # sync takes the same arguments.
+    for parser in (uploader_parser, sync_parser):
+        parser.add_argument("path", help="The paths of the files or folders to transfer", nargs='+')
+        parser.add_argument("-d", help='The "root" folder in Dropbox where the files/folders will go', dest='dropbox_destination_root', required=True)
+        parser.add_argument("-w", "--workers", help='''The number of chunks of a large file to send at once.  
+            Values greater than 1 use a concurrent upload session.''', 
+            dest='workers', type=int, default=DEFAULT_WORKERS)
+        parser.add_argument("-n", "--parallel-files", help='''The number of files to upload at once.  
+            Small files are committed to Dropbox in batches.''', 
+            dest='file_workers', type=int, default=DEFAULT_FILE_WORKERS)
+        parser.add_argument("-c", "--chunk-size", help='''The size of each chunk sent to Dropbox, in MB.  
+            Files smaller than this are sent in a single request.  Must be at most %d.''' % (MAX_CHUNK_SIZE // (1024*1024)), 
+            dest='chunk_size', type=int, default=DEFAULT_CHUNK_SIZE // (1024*1024))
+        parser.add_argument("--adaptive", help='''Adjust the chunk size of large files as they are sent, 
+            based on the measured throughput and errors.  The -c chunk size is the starting size.''', 
+            dest='adaptive', action='store_true')
+        parser.add_argument("--memory-cap", help='''The most memory, in MB, used to hold chunks being sent 
+            across all files and workers.  Must be at least the chunk size.''', 
+            dest='memory_cap', type=int, default=DEFAULT_MEMORY_CAP // (1024*1024))
+        parser.add_argument("--session-journal", help='''A file recording chunked uploads in progress, 
+            so an interrupted upload resumes where it stopped.  Default: %s''' % DEFAULT_SESSION_JOURNAL, 
+            dest='session_journal', default=DEFAULT_SESSION_JOURNAL)
+    sync_parser.add_argument("--hash-cache", help='''A file to cache local content hashes in, 
+        so unchanged files are not re-read on the next sync.  Default: %s''' % DEFAULT_HASH_CACHE, 
+        dest='hash_cache', default=DEFAULT_HASH_CACHE)
 
     # for downloads, we either pull entire directories or individual files
     downloader_parser.add_argument("-o", help='''The local path for the file or folder.  
         If you are downloading a folder it will create
         a ZIP archive, so we require that the file extension be "zip".  If a file, it does not matter.''', 
         dest='resource_path', required=True)
+    downloader_parser.add_argument("--no-zip", help='''Download a folder as a directory tree at the -o path 
+        rather than as a ZIP archive.  Files that are already present and unchanged are skipped.''', 
+        dest='no_zip', action='store_true')
+    downloader_parser.add_argument("-w", "--workers", help='''The number of connections used to download a single file.  
+        Values greater than 1 download byte ranges of the file in parallel.''', 
+        dest='workers', type=int, default=DEFAULT_WORKERS)
+    downloader_parser.add_argument("--range-size", help='The size of each byte range for parallel file downloads, in MB.', 
+        dest='range_size', type=int, default=DEFAULT_RANGE_SIZE // (1024*1024))
+    downloader_parser.add_argument("-n", "--parallel-files", help='The number of files to download at once, if not downloading a ZIP.', 
+        dest='file_workers', type=int, default=DEFAULT_FILE_WORKERS)
     group = downloader_parser.add_mutually_exclusive_group(required=True) 
     group.add_argument("-d", help="The folder in Dropbox", dest='dropbox_folder')
     group.add_argument("-f", help="The path of the file in Dropbox", dest='dropbox_file')
@@ -202,12 +1244,35 @@ def parse_args():
     args = main_parser.parse_args()
     params['token'] = args.access_token 
     params['subcommand'] = args.subcommand
+    params['metrics'] = args.metrics
 
-    if params['subcommand'] == UPLOAD:
+    if params['subcommand'] in (UPLOAD, SYNC):
         params['dropbox_destination_root'] = args.dropbox_destination_root
         params['paths'] = args.path
+        params['workers'] = args.workers
+        params['file_workers'] = args.file_workers
+        chunk_size = args.chunk_size * 1024 * 1024
+        if chunk_size <= 0 or chunk_size > MAX_CHUNK_SIZE:
+            print('The chunk size must be between 1 and %d MB.' % (MAX_CHUNK_SIZE // (1024*1024)))
+            sys.exit(1)
+        params['chunk_size'] = chunk_size
+        params['memory_cap'] = args.memory_cap * 1024 * 1024
+        if params['memory_cap'] < chunk_size:
+            print('The memory cap must be at least as large as the chunk size.')
+            sys.exit(1)
+        params['session_journal'] = args.session_journal
+        params['adaptive'] = args.adaptive
+        if params['subcommand'] == SYNC:
+            params['hash_cache'] = args.hash_cache
     elif params['subcommand'] == DOWNLOAD:
         params['resource_path'] = args.resource_path
+        params['no_zip'] = args.no_zip
+        params['file_workers'] = args.file_workers
+        params['workers'] = args.workers
+        params['range_size'] = args.range_size * 1024 * 1024
+        if params['range_size'] <= 0:
+            print('The range size must be at least 1 MB.')
+            sys.exit(1)
         if args.dropbox_file:
             params['is_folder'] = False
             params['dropbox_source'] = args.dropbox_file
@@ -229,35 +1294,42 @@ if __name__ == '__main__':
 
         client = dropbox.dropbox.Dropbox(token, timeout=DEFAULT_TIMEOUT)
 
-        if params['subcommand'] == UPLOAD:
+        if params['metrics']:
+            configure_metrics(params['metrics'])
+
+        if 'memory_cap' in params:
+            UPLOAD_MEMORY = MemoryBudget(params['memory_cap'])
+
+        if params['subcommand'] in (UPLOAD, SYNC):
 
             local_filepaths = params['paths']
             dropbox_directory = params['dropbox_destination_root']
-            skipped_paths = []
-
-            for local_filepath in local_filepaths:
-                local_filepath = os.path.abspath(local_filepath)
-                if os.path.exists(local_filepath):
-                    if os.path.isfile(local_filepath):
-                        send_to_dropbox(local_filepath, 
-                            dropbox_directory, 
-                            client
-                        )
-                    elif os.path.isdir(local_filepath):
-                        # handle a directory.  Will not do anything with empty dirs
-                        for root, dirs, files in os.walk(local_filepath):
-                            for f in files:
-                                full_path = os.path.join(root, f)
-                                send_to_dropbox(full_path, 
-                                    dropbox_directory, 
-                                    client,
-                                    root=os.path.dirname(local_filepath)
-                                )
-                    else:
-                        print('WARN: the following path was not determined to be a file or a directory: %s' % local_filepath)
-                        skipped_paths.append(local_filepath)
-                else: # a path did not exist
-                    skipped_paths.append(local_filepath)
+
+            targets, skipped_paths = collect_upload_targets(local_filepaths)
+            if params['subcommand'] == SYNC:
+                hash_cache = load_json_file(params['hash_cache'])
+                try:
+                    changed_targets = select_changed_targets(targets, 
+                        dropbox_directory, 
+                        client, 
+                        hash_cache, 
+                        file_workers=params['file_workers']
+                    )
+                finally:
+                    save_json_file(hash_cache, params['hash_cache'])
+                print('%d of %d files are new or changed.' % (len(changed_targets), len(targets)))
+                targets = changed_targets
+            results = upload_tree(targets, 
+                dropbox_directory, 
+                client,
+                file_workers=params['file_workers'],
+                workers=params['workers'],
+                chunk_size=params['chunk_size'],
+                overwrite=params['subcommand'] == SYNC,
+                journal=SessionJournal(params['session_journal']),
+                adaptive=params['adaptive']
+            )
+            report_transfer_results(results)
 
             if len(skipped_paths) > 0:
                 print('WARN: The following were skipped- please check the paths exist.')
@@ -265,11 +1337,21 @@ if __name__ == '__main__':
 
         else: # download
             local_path = params['resource_path']
-            if params['is_folder']:
+            if params['is_folder'] and params['no_zip']:
+                results = download_tree(params['dropbox_source'], local_path, client, file_workers=params['file_workers'])
+                report_transfer_results(results, action='downloaded')
+            elif params['is_folder']:
                 if not local_path.endswith(ZIP):
                     local_path = local_path + ZIP
                     print('WARN: The download path did not have the proper zip extension.  Adding it.  The zip archive will be available at %s' % local_path)
-                pull_folder_from_dropbox(params['dropbox_source'], local_path, client)
+                pull_folder_from_dropbox(params['dropbox_source'], local_path, client, file_workers=params['file_workers'])
+            elif params['workers'] > 1:
+                pull_file_ranged(params['dropbox_source'], 
+                    local_path, 
+                    token, 
+                    params['workers'], 
+                    range_size=params['range_size']
+                )
             else: # regular file
                 pull_file_from_dropbox(params['dropbox_source'], local_path, client)
 
@@ -0,0 +1,499 @@
+'''
+Measures the throughput of dropbox_transfer.py against a local, fake Dropbox server,
+so the effect of chunk size, concurrency and buffering settings can be compared
+before using them for real transfers.
+
+The fake server speaks enough of the Dropbox API (uploads, upload sessions,
+batch commits, metadata, folder listing and ranged downloads) for dropbox_transfer.py to
+run unmodified.  Each connection is throttled to a configurable bandwidth, and a
+fixed latency is added to every request, to mimic a real link.
+
+Results are written as JSON lines, one per scenario run.
+'''
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import http.server
+import dropbox
+import dropbox_transfer
+
+DEFAULT_BANDWIDTH = 20 # MB/s, per connection
+DEFAULT_LATENCY = 50 # milliseconds added to each request
+DEFAULT_FILE_SIZE = 64 # MB, for the single-file scenarios
+DEFAULT_NUM_FILES = 200 # for the tree scenarios
+DEFAULT_SMALL_FILE_SIZE = 16 # KB, for the tree scenarios
+DEFAULT_RANGE_SIZE = 8 # MB, for ranged downloads
+DEFAULT_OUTPUT = 'dropbox_transfer_benchmark.jsonl'
+THROTTLE_BLOCK_SIZE = 64*1024 # bytes moved between throttling sleeps
+LIST_PAGE_SIZE = 100 # entries per page of a folder listing, so pagination is exercised
+TIMESTAMP = '2020-01-01T00:00:00Z'
+FAKE_TOKEN = 'benchmark-token'
+BENCHMARK_FOLDER = '/benchmark'
+CONFLICT_ERROR = {'.tag': 'path', 'path': {'.tag': 'conflict', 'conflict': {'.tag': 'file'}}}
+
+
+class FakeDropboxStore(object):
+    '''
+    The state behind the fake server: upload sessions in progress, and committed files.
+    Contents are kept on disk under `root`; only metadata is held in memory.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.files = {}
+        self.list_cursors = {}
+
+    def start_session(self, concurrent):
+        session_id = uuid.uuid4().hex
+        local_path = os.path.join(self.root, 'session-%s' % session_id)
+        open(local_path, 'wb').close()
+        with self.lock:
+            self.sessions[session_id] = {'local_path': local_path, 'size': 0, 'concurrent': concurrent}
+        return session_id
+
+    def write_session(self, session_id, offset, data):
+        '''
+        Writes data into a session.  Returns None, or the correct offset if
+        a serial session was written at the wrong place.
+        '''
+        session = self.sessions[session_id]
+        if not session['concurrent'] and offset != session['size']:
+            return session['size']
+        with open(session['local_path'], 'r+b') as fout:
+            fout.seek(offset)
+            fout.write(data)
+        with self.lock:
+            session['size'] = max(session['size'], offset + len(data))
+        return None
+
+    def commit(self, session_id, path, mode='add'):
+        '''
+        Commits a session as the file at `path`.  Unless `mode` is "overwrite", a different
+        file already there is kept and None returned instead, which Dropbox reports as a conflict.
+        '''
+        session = self.sessions.pop(session_id)
+        existing = self.files.get(path.lower())
+        if (existing is not None and mode != 'overwrite'
+                and existing['content_hash'] != dropbox_transfer.compute_content_hash(session['local_path'])):
+            os.remove(session['local_path'])
+            return None
+        return self.add_file(path, session['local_path'])
+
+    def add_file(self, path, local_path):
+        final_path = os.path.join(self.root, 'file-%s' % hashlib.sha256(path.lower().encode('utf-8')).hexdigest())
+        os.replace(local_path, final_path)
+        entry = {
+            'path_display': path,
+            'local_path': final_path,
+            'size': os.path.getsize(final_path),
+            'content_hash': dropbox_transfer.compute_content_hash(final_path)
+        }
+        with self.lock:
+            self.files[path.lower()] = entry
+        return entry
+
+    def list_folder(self, path):
+        '''
+        Returns the metadata of every file and folder below `path`.
+        '''
+        prefix = path.lower().rstrip('/') + '/'
+        entries = []
+        folders = set()
+        with self.lock:
+            files = [x for x in self.files.values() if x['path_display'].lower().startswith(prefix)]
+        for entry in sorted(files, key=lambda x: x['path_display']):
+            parent = os.path.dirname(entry['path_display'])
+            while parent.lower().startswith(prefix) and parent.lower() not in folders:
+                folders.add(parent.lower())
+                entries.append(folder_metadata(parent))
+                parent = os.path.dirname(parent)
+            entries.append(file_metadata(entry))
+        return entries
+
+
+def file_metadata(entry):
+    return {
+        '.tag': 'file',
+        'name': os.path.basename(entry['path_display']),
+        'id': 'id:%s' % entry['content_hash'][:16],
+        'client_modified': TIMESTAMP,
+        'server_modified': TIMESTAMP,
+        'rev': '0123456789abcdef',
+        'size': entry['size'],
+        'path_lower': entry['path_display'].lower(),
+        'path_display': entry['path_display'],
+        'content_hash': entry['content_hash']
+    }
+
+
+def folder_metadata(path):
+    return {
+        '.tag': 'folder',
+        'name': os.path.basename(path),
+        'id': 'id:%s' % hashlib.sha256(path.lower().encode('utf-8')).hexdigest()[:16],
+        'path_lower': path.lower(),
+        'path_display': path
+    }
+
+
+def write_mode(commit):
+    mode = commit.get('mode', 'add')
+    return mode['.tag'] if isinstance(mode, dict) else mode
+
+
+class FakeDropboxHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Handles the Dropbox API routes used by dropbox_transfer.py.  Routes are
+    dispatched to the method named after them, e.g. files/upload_session/start
+    is handled by route_files_upload_session_start.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        route = self.path.split('?')[0].lstrip('/')
+        if route.startswith('2/'):
+            route = route[2:]
+        handler = getattr(self, 'route_' + route.replace('/', '_'), None)
+        if handler is None:
+            self.read_body()
+            self.send_json(404, {'error_summary': 'unknown route %s' % route})
+        else:
+            handler()
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        blocks = []
+        while length > 0:
+            started = time.time()
+            block = self.rfile.read(min(length, THROTTLE_BLOCK_SIZE))
+            if not block:
+                break
+            blocks.append(block)
+            length -= len(block)
+            self.throttle(len(block), started)
+        return b''.join(blocks)
+
+    def throttle(self, n, started):
+        remaining = n / self.server.bandwidth - (time.time() - started)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def api_arg(self):
+        return json.loads(self.headers['Dropbox-API-Arg'])
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_route_error(self, error):
+        self.send_json(409, {'error_summary': error['.tag'], 'error': error})
+
+    def route_files_upload(self):
+        arg = self.api_arg()
+        data = self.read_body()
+        fd, local_path = tempfile.mkstemp(dir=self.server.store.root)
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(data)
+        self.send_json(200, file_metadata(self.server.store.add_file(arg['path'], local_path)))
+
+    def route_files_upload_session_start(self):
+        arg = self.api_arg()
+        data = self.read_body()
+        session_type = arg.get('session_type') or {}
+        session_id = self.server.store.start_session(session_type.get('.tag') == 'concurrent')
+        self.server.store.write_session(session_id, 0, data)
+        self.send_json(200, {'session_id': session_id})
+
+    def route_files_upload_session_append_v2(self):
+        arg = self.api_arg()
+        data = self.read_body()
+        cursor = arg['cursor']
+        if cursor['session_id'] not in self.server.store.sessions:
+            self.send_route_error({'.tag': 'not_found'})
+            return
+        correct_offset = self.server.store.write_session(cursor['session_id'], cursor['offset'], data)
+        if correct_offset is not None:
+            self.send_route_error({'.tag': 'incorrect_offset', 'correct_offset': correct_offset})
+        else:
+            self.send_json(200, None)
+
+    def route_files_upload_session_finish(self):
+        arg = self.api_arg()
+        data = self.read_body()
+        cursor = arg['cursor']
+        if data:
+            correct_offset = self.server.store.write_session(cursor['session_id'], cursor['offset'], data)
+            if correct_offset is not None:
+                self.send_route_error({'.tag': 'lookup_failed',
+                    'lookup_failed': {'.tag': 'incorrect_offset', 'correct_offset': correct_offset}
+                })
+                return
+        entry = self.server.store.commit(cursor['session_id'], arg['commit']['path'], write_mode(arg['commit']))
+        if entry is None:
+            self.send_route_error(CONFLICT_ERROR)
+        else:
+            self.send_json(200, file_metadata(entry))
+
+    def route_files_upload_session_finish_batch(self):
+        arg = json.loads(self.read_body().decode('utf-8'))
+        entries = []
+        for x in arg['entries']:
+            entry = self.server.store.commit(x['cursor']['session_id'], x['commit']['path'], write_mode(x['commit']))
+            if entry is None:
+                entries.append({'.tag': 'failure', 'failure': CONFLICT_ERROR})
+                continue
+            metadata = file_metadata(entry)
+            metadata['.tag'] = 'success'
+            entries.append(metadata)
+        self.send_json(200, {'.tag': 'complete', 'entries': entries})
+
+    def route_files_get_metadata(self):
+        arg = json.loads(self.read_body().decode('utf-8'))
+        path = arg['path'].rstrip('/')
+        entry = self.server.store.files.get(path.lower())
+        if entry is not None:
+            self.send_json(200, file_metadata(entry))
+        elif len(self.server.store.list_folder(path)) > 0:
+            self.send_json(200, folder_metadata(path))
+        else:
+            self.send_route_error({'.tag': 'path', 'path': {'.tag': 'not_found'}})
+
+    def route_files_list_folder(self):
+        arg = json.loads(self.read_body().decode('utf-8'))
+        entries = self.server.store.list_folder(arg['path'])
+        self.send_list_page(entries)
+
+    def route_files_list_folder_continue(self):
+        arg = json.loads(self.read_body().decode('utf-8'))
+        entries = self.server.store.list_cursors.pop(arg['cursor'])
+        self.send_list_page(entries)
+
+    def send_list_page(self, entries):
+        cursor = uuid.uuid4().hex
+        has_more = len(entries) > LIST_PAGE_SIZE
+        if has_more:
+            self.server.store.list_cursors[cursor] = entries[LIST_PAGE_SIZE:]
+        self.send_json(200, {'entries': entries[:LIST_PAGE_SIZE], 'cursor': cursor, 'has_more': has_more})
+
+    def route_files_download(self):
+        self.read_body()
+        arg = self.api_arg()
+        entry = self.server.store.files.get(arg['path'].lower())
+        if entry is None:
+            self.send_route_error({'.tag': 'path', 'path': {'.tag': 'not_found'}})
+            return
+        start, end = 0, entry['size'] - 1
+        status = 200
+        if 'Range' in self.headers:
+            requested = self.headers['Range'].split('=')[1].split('-')
+            start = int(requested[0])
+            if requested[1]:
+                end = min(end, int(requested[1]))
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Dropbox-API-Result', json.dumps(file_metadata(entry)))
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, entry['size']))
+        self.end_headers()
+        with open(entry['local_path'], 'rb') as fin:
+            fin.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                started = time.time()
+                block = fin.read(min(remaining, THROTTLE_BLOCK_SIZE))
+                self.wfile.write(block)
+                remaining -= len(block)
+                self.throttle(len(block), started)
+
+
+class FakeDropboxServer(http.server.ThreadingHTTPServer):
+    '''
+    A local stand-in for the Dropbox API hosts.  `bandwidth` is in bytes/second
+    per connection and `latency` is in seconds.
+    '''
+    daemon_threads = True
+
+    def __init__(self, root, bandwidth, latency):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), FakeDropboxHandler)
+        self.store = FakeDropboxStore(root)
+        self.bandwidth = bandwidth
+        self.latency = latency
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+class LocalDropbox(dropbox.Dropbox):
+    '''
+    A dropbox.Dropbox client that sends every request to a FakeDropboxServer.
+    '''
+    def __init__(self, base_url, *args, **kwargs):
+        self._base_url = base_url
+        dropbox.Dropbox.__init__(self, *args, **kwargs)
+
+    def _get_route_url(self, hostname, route_name):
+        return '%s/2/%s' % (self._base_url, route_name)
+
+
+def make_file(path, size):
+    '''
+    Writes `size` random bytes to `path`, a block at a time.
+    '''
+    with open(path, 'wb') as fout:
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, 4*1024*1024)
+            fout.write(os.urandom(n))
+            remaining -= n
+
+
+def run_scenario(output, scenario, total_bytes, func, **settings):
+    '''
+    Times func(), which returns whether the transferred data was verified, and writes the result.
+    '''
+    started = time.time()
+    verified = func()
+    seconds = time.time() - started
+    result = {
+        'scenario': scenario,
+        'bytes': total_bytes,
+        'seconds': seconds,
+        'mb_per_second': total_bytes / seconds / (1024*1024),
+        'verified': verified
+    }
+    result.update(settings)
+    output.write(json.dumps(result, sort_keys=True) + '\n')
+    output.flush()
+    print('%s %s: %.2f MB/s' % (scenario, json.dumps(settings, sort_keys=True), result['mb_per_second']))
+    return result
+
+
+def parse_list(value):
+    return [int(x) for x in value.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark dropbox_transfer.py against a local fake Dropbox server.')
+    parser.add_argument('--bandwidth', type=float, default=DEFAULT_BANDWIDTH,
+        help='Bandwidth of each connection to the fake server, in MB/s.  Default: %s' % DEFAULT_BANDWIDTH)
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+        help='Latency added to each request, in milliseconds.  Default: %s' % DEFAULT_LATENCY)
+    parser.add_argument('--file-size', type=int, default=DEFAULT_FILE_SIZE,
+        help='Size of the file for the single-file scenarios, in MB.  Default: %s' % DEFAULT_FILE_SIZE)
+    parser.add_argument('--num-files', type=int, default=DEFAULT_NUM_FILES,
+        help='Number of files for the tree scenarios.  Default: %s' % DEFAULT_NUM_FILES)
+    parser.add_argument('--small-file-size', type=int, default=DEFAULT_SMALL_FILE_SIZE,
+        help='Size of each file for the tree scenarios, in KB.  Default: %s' % DEFAULT_SMALL_FILE_SIZE)
+    parser.add_argument('--chunk-sizes', type=parse_list, default=[8, 32],
+        help='Comma-separated chunk sizes (MB) to try for uploads.  Default: 8,32')
+    parser.add_argument('--workers', type=parse_list, default=[1, 4],
+        help='Comma-separated numbers of workers to try for single-file transfers.  Default: 1,4')
+    parser.add_argument('--range-size', type=int, default=DEFAULT_RANGE_SIZE,
+        help='Size of each byte range for ranged downloads, in MB.  Default: %s' % DEFAULT_RANGE_SIZE)
+    parser.add_argument('--file-workers', type=parse_list, default=[1, 8],
+        help='Comma-separated numbers of parallel files to try for tree transfers.  Default: 1,8')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT,
+        help='Where to write the results, as JSON lines.  Default: %s' % DEFAULT_OUTPUT)
+    parser.add_argument('--metrics',
+        help='Also write the per-chunk/per-file metrics from dropbox_transfer.py to this file.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.metrics:
+        dropbox_transfer.configure_metrics(args.metrics)
+
+    workdir = tempfile.mkdtemp()
+    server_root = os.path.join(workdir, 'server')
+    local_root = os.path.join(workdir, 'local')
+    os.makedirs(server_root)
+    os.makedirs(os.path.join(local_root, 'tree'))
+
+    server = FakeDropboxServer(server_root, args.bandwidth * 1024 * 1024, args.latency / 1000.0)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    client = LocalDropbox(server.url, FAKE_TOKEN, timeout=dropbox_transfer.DEFAULT_TIMEOUT)
+    output = open(args.output, 'a')
+
+    try:
+        big_file = os.path.join(local_root, 'big.bin')
+        make_file(big_file, args.file_size * 1024 * 1024)
+        big_hash = dropbox_transfer.compute_content_hash(big_file)
+        big_size = os.path.getsize(big_file)
+        for i in range(args.num_files):
+            make_file(os.path.join(local_root, 'tree', 'file_%05d.bin' % i), args.small_file_size * 1024)
+        tree_targets, skipped = dropbox_transfer.collect_upload_targets([os.path.join(local_root, 'tree')])
+        tree_size = sum(os.path.getsize(x[0]) for x in tree_targets)
+
+        for chunk_size in args.chunk_sizes:
+            for workers in args.workers:
+                def upload_file():
+                    dropbox_transfer.send_to_dropbox(big_file, BENCHMARK_FOLDER, client,
+                        workers=workers, chunk_size=chunk_size * 1024 * 1024, overwrite=True
+                    )
+                    remote = server.store.files[(BENCHMARK_FOLDER + '/big.bin').lower()]
+                    return remote['content_hash'] == big_hash
+                run_scenario(output, 'upload_file', big_size, upload_file, chunk_size_mb=chunk_size, workers=workers)
+
+            def upload_file_adaptive():
+                dropbox_transfer.send_to_dropbox(big_file, BENCHMARK_FOLDER, client,
+                    chunk_size=chunk_size * 1024 * 1024, overwrite=True, adaptive=True
+                )
+                remote = server.store.files[(BENCHMARK_FOLDER + '/big.bin').lower()]
+                return remote['content_hash'] == big_hash
+            run_scenario(output, 'upload_file_adaptive', big_size, upload_file_adaptive, chunk_size_mb=chunk_size, workers=1)
+
+        for file_workers in args.file_workers:
+            def upload_tree():
+                results = dropbox_transfer.upload_tree(tree_targets, BENCHMARK_FOLDER, client,
+                    file_workers=file_workers, overwrite=True
+                )
+                return all(x is None for x in results.values())
+            run_scenario(output, 'upload_tree', tree_size, upload_tree, file_workers=file_workers, num_files=len(tree_targets))
+
+        for workers in args.workers:
+            download_path = os.path.join(local_root, 'big.download')
+            def download_file():
+                if workers > 1:
+                    dropbox_transfer.pull_file_ranged(BENCHMARK_FOLDER + '/big.bin', download_path, FAKE_TOKEN, workers,
+                        range_size=args.range_size * 1024 * 1024, download_url=server.url + '/2/files/download'
+                    )
+                else:
+                    dropbox_transfer.pull_file_from_dropbox(BENCHMARK_FOLDER + '/big.bin', download_path, client)
+                verified = dropbox_transfer.compute_content_hash(download_path) == big_hash
+                os.remove(download_path)
+                return verified
+            run_scenario(output, 'download_file', big_size, download_file, workers=workers, range_size_mb=args.range_size)
+
+        for file_workers in args.file_workers:
+            download_dir = os.path.join(local_root, 'tree.download')
+            def download_tree():
+                results = dropbox_transfer.download_tree(BENCHMARK_FOLDER + '/tree', download_dir, client,
+                    file_workers=file_workers
+                )
+                shutil.rmtree(download_dir)
+                return len(results) == len(tree_targets) and all(x is None for x in results.values())
+            run_scenario(output, 'download_tree', tree_size, download_tree, file_workers=file_workers, num_files=len(tree_targets))
+    finally:
+        output.close()
+        server.shutdown()
+        shutil.rmtree(workdir)
@@ -0,0 +1,219 @@
+'''
+A shared HTTP client for the CNAP and Cromwell scripts.
+
+Client is a requests session that keeps connections open for re-use, applies a
+default timeout, re-sends failed requests according to a RetryPolicy, and records
+a request counter and latency histogram per endpoint.  Since it is a plain
+requests.Session otherwise, it can be used anywhere a session is.
+
+The counters of every client go to the module's STATS, which can be written as
+JSON when the script exits:
+
+    http_client.configure(timeout=30, stats_path='http_stats.json')
+    client = http_client.Client(pool_size=8)
+    client.get(url)
+'''
+import re
+import sys
+import json
+import time
+import random
+import atexit
+import threading
+import requests
+from urllib.parse import urlsplit
+
+DEFAULT_TIMEOUT = 60 # seconds to wait for a connection, and between bytes of a response
+DEFAULT_POOL_SIZE = 10 # connections kept open per host
+DEFAULT_RETRIES = 3 # how many times a failed request is re-sent
+BACKOFF_BASE = 1 # seconds; retries wait a random time up to this, doubled per failure
+BACKOFF_MAX = 30 # seconds; the most a retry waits
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+# UUIDs and numeric ids in a path, so e.g. every workflow's status call counts as one endpoint
+ID_PATTERN = re.compile(r'/(?:[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|\d+)(?=/|$)')
+
+default_timeout = DEFAULT_TIMEOUT
+
+
+class RetryPolicy(object):
+    '''
+    Which failed requests are re-sent, how many times, and how long to wait in between.
+
+    A request is re-sent after a connection error or a response with one of `statuses`,
+    if its method is one of `methods` (None for any method).  By default only idempotent
+    methods are, since e.g. a re-sent POST may act twice.  Note that a body given as a
+    file object can only be sent once.
+    '''
+    def __init__(self, retries=DEFAULT_RETRIES, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+            statuses=RETRY_STATUSES, methods=IDEMPOTENT_METHODS):
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.statuses = statuses
+        self.methods = methods
+
+    def applies_to(self, method):
+        return self.methods is None or method.upper() in self.methods
+
+    def delay(self, failures):
+        '''
+        Seconds to wait before a retry: random, up to a limit that doubles with each failure
+        '''
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** max(0, failures - 1)))
+
+
+NO_RETRY = RetryPolicy(retries=0)
+
+
+def get_endpoint(method, url):
+    '''
+    Names the endpoint a request went to, as "METHOD host/path" with ids replaced by {id}
+    '''
+    parts = urlsplit(url)
+    return '%s %s%s' % (method.upper(), parts.netloc, ID_PATTERN.sub('/{id}', parts.path))
+
+
+class RequestStats(object):
+    '''
+    Counts requests per endpoint, by outcome, with a histogram of how long each took.
+    Safe to share between threads.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, method, url, status, seconds, retry=False):
+        '''
+        Records one request.  `status` is None if no response was received.
+        '''
+        milliseconds = seconds * 1000
+        endpoint = get_endpoint(method, url)
+        with self.lock:
+            entry = self.endpoints.get(endpoint)
+            if entry is None:
+                entry = {
+                    'requests': 0,
+                    'retries': 0,
+                    'errors': 0,
+                    'statuses': {},
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'histogram': [0] * (len(LATENCY_BUCKETS) + 1)
+                }
+                self.endpoints[endpoint] = entry
+            entry['requests'] += 1
+            if retry:
+                entry['retries'] += 1
+            if status is None:
+                entry['errors'] += 1
+            else:
+                entry['statuses'][str(status)] = entry['statuses'].get(str(status), 0) + 1
+            entry['total_ms'] += milliseconds
+            entry['max_ms'] = max(entry['max_ms'], milliseconds)
+            i = 0
+            while i < len(LATENCY_BUCKETS) and milliseconds > LATENCY_BUCKETS[i]:
+                i += 1
+            entry['histogram'][i] += 1
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+    def to_dict(self):
+        '''
+        Returns the counters per endpoint, with the histogram keyed by bucket ("<=50ms")
+        and the mean latency and approximate percentiles (bucket upper bounds) filled in.
+        '''
+        with self.lock:
+            report = {}
+            for endpoint, entry in self.endpoints.items():
+                labels = ['<=%dms' % x for x in LATENCY_BUCKETS] + ['>%dms' % LATENCY_BUCKETS[-1]]
+                summary = {
+                    'requests': entry['requests'],
+                    'retries': entry['retries'],
+                    'errors': entry['errors'],
+                    'statuses': dict(entry['statuses']),
+                    'mean_ms': round(entry['total_ms'] / entry['requests'], 3),
+                    'max_ms': round(entry['max_ms'], 3),
+                    'histogram': dict((labels[i], n) for i, n in enumerate(entry['histogram']) if n > 0)
+                }
+                for name, fraction in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+                    summary[name] = self._bucket_percentile(entry, fraction)
+                report[endpoint] = summary
+            return report
+
+    def _bucket_percentile(self, entry, fraction):
+        target = fraction * entry['requests']
+        seen = 0
+        for i, n in enumerate(entry['histogram']):
+            seen += n
+            if seen >= target and n > 0:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else round(entry['max_ms'], 3)
+        return None
+
+    def dump(self, path):
+        '''
+        Writes the counters as JSON to `path` ("-" for stderr)
+        '''
+        report = self.to_dict()
+        if path == '-':
+            sys.stderr.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+        else:
+            with open(path, 'w') as fout:
+                json.dump(report, fout, indent=2, sort_keys=True)
+
+
+STATS = RequestStats()
+
+
+def configure(timeout=None, stats_path=None):
+    '''
+    Sets the timeout of clients created from now on, and/or writes STATS to
+    `stats_path` when the script exits.
+    '''
+    global default_timeout
+    if timeout is not None:
+        default_timeout = timeout
+    if stats_path is not None:
+        atexit.register(STATS.dump, stats_path)
+
+
+class Client(requests.Session):
+    '''
+    A requests session that keeps up to `pool_size` connections per host open for
+    re-use.  Every request gets `timeout` unless it passes its own, is retried per
+    `retry` (or a RetryPolicy passed as retry= to the call), and is recorded in `stats`.
+    '''
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=None, retry=None, stats=None):
+        super(Client, self).__init__()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.timeout = default_timeout if timeout is None else timeout
+        self.retry = retry or RetryPolicy()
+        self.stats = STATS if stats is None else stats
+
+    def request(self, method, url, retry=None, **kwargs):
+        retry = retry or self.retry
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        can_retry = retry.applies_to(method)
+        failures = 0
+        while True:
+            started = time.time()
+            try:
+                response = super(Client, self).request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                self.stats.record(method, url, None, time.time() - started, retry=failures > 0)
+                if not can_retry or failures >= retry.retries:
+                    raise
+            else:
+                self.stats.record(method, url, response.status_code, time.time() - started, retry=failures > 0)
+                if not can_retry or failures >= retry.retries or response.status_code not in retry.statuses:
+                    return response
+                response.close()
+            failures += 1
+            time.sleep(retry.delay(failures))
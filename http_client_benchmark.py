@@ -0,0 +1,155 @@
+'''
+Measures the latency that http_client.Client saves by re-using connections, on
+repeated calls to the same host.
+
+The same GET is made over and over, first with a bare requests.get (a new
+connection per call, as the scripts used to do) and then through one Client
+(connections kept alive).  By default the calls go to a local server that adds a
+delay to each new connection, standing in for the TCP and TLS handshakes to a
+remote host; --url points the calls at a real server instead.
+
+Per-call latency percentiles are printed and written as JSON lines, one per scenario.
+'''
+import json
+import time
+import argparse
+import threading
+import http.server
+import requests
+import http_client
+
+DEFAULT_CALLS = 200
+DEFAULT_CONNECT_LATENCY = 30 # milliseconds added to each new connection, e.g. for handshakes
+DEFAULT_LATENCY = 5 # milliseconds added to each request
+DEFAULT_OUTPUT = 'http_client_benchmark.jsonl'
+
+
+class DelayHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Answers every GET with a small JSON body, after the server's latency.  A new
+    connection first waits the server's connect latency.
+    '''
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.server.count_connection()
+        time.sleep(self.server.connect_latency)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DelayServer(http.server.ThreadingHTTPServer):
+    '''
+    A local server with `connect_latency` seconds added per connection and
+    `latency` seconds per request.
+    '''
+    daemon_threads = True
+
+    def __init__(self, connect_latency, latency):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), DelayHandler)
+        self.connect_latency = connect_latency
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.connections = 0
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def reset_connections(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = 0
+        return connections
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def time_calls(get, url, calls):
+    '''
+    Returns the seconds taken by each of `calls` sequential calls to get(url)
+    '''
+    latencies = []
+    for i in range(calls):
+        started = time.time()
+        response = get(url)
+        response.content
+        latencies.append(time.time() - started)
+    return latencies
+
+
+def run_scenario(output, scenario, get, url, calls, server=None):
+    if server is not None:
+        server.reset_connections()
+    latencies = time_calls(get, url, calls)
+    result = {
+        'scenario': scenario,
+        'url': url,
+        'calls': calls,
+        'connections': None if server is None else server.reset_connections(),
+        'latency_mean_ms': 1000 * sum(latencies) / len(latencies),
+        'latency_p50_ms': 1000 * percentile(latencies, 0.5),
+        'latency_p90_ms': 1000 * percentile(latencies, 0.9),
+        'latency_p99_ms': 1000 * percentile(latencies, 0.99),
+        'seconds': sum(latencies)
+    }
+    if server is not None:
+        result['connect_latency_ms'] = server.connect_latency * 1000
+        result['latency_ms'] = server.latency * 1000
+    output.write(json.dumps(result, sort_keys=True) + '\n')
+    output.flush()
+    print('%s: mean %.1f ms, p50 %.1f ms, p99 %.1f ms per call' % (scenario,
+        result['latency_mean_ms'], result['latency_p50_ms'], result['latency_p99_ms']))
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the latency saved by re-using connections in http_client.Client.')
+    parser.add_argument('--url', required=False, help='Call this URL instead of a local server')
+    parser.add_argument('--calls', type=int, default=DEFAULT_CALLS,
+        help='Number of calls made in each scenario.  Default: %s' % DEFAULT_CALLS)
+    parser.add_argument('--connect-latency', type=float, default=DEFAULT_CONNECT_LATENCY,
+        help='Latency the local server adds to each new connection, in milliseconds.  Default: %s' % DEFAULT_CONNECT_LATENCY)
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+        help='Latency the local server adds to each request, in milliseconds.  Default: %s' % DEFAULT_LATENCY)
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT,
+        help='Where to write the results, as JSON lines.  Default: %s' % DEFAULT_OUTPUT)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = None
+    url = args.url
+    if url is None:
+        server = DelayServer(args.connect_latency / 1000.0, args.latency / 1000.0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://%s:%d/' % server.server_address
+
+    output = open(args.output, 'a')
+    try:
+        fresh = run_scenario(output, 'new_connection', requests.get, url, args.calls, server)
+        client = http_client.Client(pool_size=1)
+        pooled = run_scenario(output, 'pooled', client.get, url, args.calls, server)
+        print('Re-using connections saved %.1f ms per call (%.0f%%)' % (
+            fresh['latency_mean_ms'] - pooled['latency_mean_ms'],
+            100 * (1 - pooled['latency_mean_ms'] / fresh['latency_mean_ms'])))
+    finally:
+        output.close()
+        if server is not None:
+            server.shutdown()
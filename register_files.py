@@ -5,6 +5,11 @@ import os
 import subprocess
 import json
 import datetime
+import tempfile
+import shutil
+import time
+import concurrent.futures
+import http_client
 
 
 DOMAIN = 'https://cnap.tm4.org'
@@ -16,6 +21,27 @@ TOKEN = 'token'
 FILES = 'files'
 CNAP_USER = 'cnap_user'
 EXPIRY = 'expiry'
+PARALLEL = 'parallel'
+JOURNAL = 'journal'
+USERS = 'users'
+CACHE = 'cache'
+LISTING_CHUNK = 100 # how many gs:// folders are listed by one gsutil call
+SIZE_BATCH = 1000 # how many streamed paths have their sizes looked up together
+WILDCARD_CHARACTERS = '*?[' # gsutil treats these as wildcards in a path
+DEFAULT_JOURNAL = 'register_files.journal' # records each registered path, so a rerun picks up where the last stopped; removed after a clean run
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.register_files_cache.json') # auth token and user index kept between runs
+TOKEN_TTL = 12*60*60 # seconds a cached auth token is re-used before exchanging the password again
+USER_INDEX_TTL = 24*60*60 # seconds a cached email -> pk index is re-used before fetching the users again
+DEFAULT_MAX_CONCURRENT = 8 # how many registration requests are in flight at once
+PENDING_PER_WORKER = 2 # requests queued per worker; bounds memory however many paths are streamed
+DEFAULT_RETRIES = 4 # how many times a request or registration is re-sent after a server or connection error
+RETRY_BACKOFF_BASE = 1 # seconds; retries wait a random time up to this, doubled per failure
+RETRY_BACKOFF_MAX = 30 # seconds; the most a retry waits
+REQUEST_TIMEOUT = 60 # seconds to wait on the CNAP API before treating a request as failed
+# only GETs are re-sent by the session; a failed POST may still have created the resource (see register_file)
+REQUEST_RETRY = http_client.RetryPolicy(DEFAULT_RETRIES, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX,
+    statuses=[429] + list(range(500, 600)))
+REFUSED_STATUSES = (429, 503) # CNAP turned the request away without acting on it, so it is safe to re-send
 
 # the request payload needs to have the following keys:
 PAYLOAD_TEMPLATE = {
@@ -30,19 +56,196 @@ PAYLOAD_TEMPLATE = {
 }
 
 
+def check_path(f):
+    '''
+    Returns True if f is a gs:// path.  If it is missing the file prefix, warn
+    '''
+    if not f.startswith(GS_PREFIX):
+        print('WARN: File %s does not have the required format, starting with "%s". Skipping.' % (f, GS_PREFIX))
+        return False
+    return True
+
+
 def parse_files(resource_list):
     '''
     Parses the list of files provided.  If they are missing the file prefix, skip and warn
     '''
     final_list = set()
     for f in resource_list:
-        if not f.startswith(GS_PREFIX):
-            print('WARN: File %s does not have the required format, starting with "%s". Skipping.' % (f, GS_PREFIX))
-        else:
+        if check_path(f):
             final_list.add(f)
     return list(final_list)
 
 
+def as_row(item):
+    '''
+    Files to register are passed around as (path, size, owner, expiry) rows, where
+    None means not yet known (size) or the default for the run (owner email, expiry).
+    A plain path is turned into such a row.
+    '''
+    if isinstance(item, tuple):
+        return item
+    return item, None, None, None
+
+
+def iter_manifest(manifest):
+    '''
+    Yields a row for each line of a manifest file ("-" for stdin).  Each line is a path,
+    optionally followed by the owner's email and an expiration date, separated by tabs
+    or commas.  Blank lines and lines starting with # are skipped.
+    '''
+    f = sys.stdin if manifest == '-' else open(manifest)
+    try:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            contents = [x.strip() for x in line.split('\t' if '\t' in line else ',')]
+            contents += [''] * (3 - len(contents))
+            if check_path(contents[0]):
+                yield contents[0], None, contents[1] or None, contents[2] or None
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def iter_prefix(prefix):
+    '''
+    Yields a row for every object under a gs:// prefix, from one recursive listing
+    '''
+    for path, size in iter_object_sizes([prefix.rstrip('/') + '/**']):
+        yield path, size, None, None
+
+
+def iter_resources(resources, manifests, prefixes):
+    '''
+    Chains the rows from the command line, manifests and gs:// prefixes, in that order.
+    '''
+    for f in parse_files(resources):
+        yield as_row(f)
+    for manifest in manifests:
+        for row in iter_manifest(manifest):
+            yield row
+    for prefix in prefixes:
+        if check_path(prefix):
+            for row in iter_prefix(prefix):
+                yield row
+
+
+def buffer_stdin():
+    '''
+    Copies stdin to a temporary file, which is removed when it is closed
+    '''
+    f = tempfile.NamedTemporaryFile(mode='w+', prefix='register_files_stdin.')
+    shutil.copyfileobj(sys.stdin, f)
+    f.flush()
+    return f
+
+
+class ResourceList(object):
+    '''
+    The paths given on the command line, in manifests and under gs:// prefixes.
+    Each iteration streams them afresh (see iter_resources), so they can be checked
+    before they are registered without holding them all in memory.  Stdin can only
+    be read once, so a "-" manifest is copied to a temporary file up front.
+    '''
+    def __init__(self, resources, manifests, prefixes):
+        self.resources = resources
+        self.stdin_copy = None
+        if '-' in manifests:
+            self.stdin_copy = buffer_stdin()
+            manifests = [self.stdin_copy.name if x == '-' else x for x in manifests]
+        self.manifests = manifests
+        self.prefixes = prefixes
+
+    def __iter__(self):
+        return iter_resources(self.resources, self.manifests, self.prefixes)
+
+    def iter_listed(self):
+        '''
+        The rows given explicitly, i.e. without listing the prefixes
+        '''
+        return iter_resources(self.resources, self.manifests, [])
+
+
+def find_problems(files, index, users, owner_pk):
+    '''
+    Checks the rows in `files` (a ResourceList, or a list of rows/paths) before anything
+    is registered.  Returns the paths registered in `index` to someone other than their
+    intended owner, and the owner emails missing from `users`.  Expiration dates are
+    validated too.  Prefixes are matched against the index rather than listed again.
+    '''
+    if isinstance(files, ResourceList):
+        rows = files.iter_listed()
+        prefixes = files.prefixes
+    else:
+        rows = (as_row(x) for x in files)
+        prefixes = []
+    conflicts = set()
+    unknown = set()
+    expiries = set()
+    for path, size, owner, expiry in rows:
+        if owner is not None and owner not in users:
+            unknown.add(owner)
+            continue
+        pk = owner_pk if owner is None else users[owner]
+        if path in index and index[path] != str(pk):
+            conflicts.add(path)
+        if expiry is not None:
+            expiries.add(expiry)
+    for prefix in prefixes:
+        prefix = prefix.rstrip('/') + '/'
+        conflicts.update(x for x in index if x.startswith(prefix) and index[x] != str(owner_pk))
+    for expiry in sorted(expiries):
+        validate_datestring(expiry)
+    return sorted(conflicts), sorted(unknown)
+
+
+class CredentialCache(object):
+    '''
+    A JSON file keeping the auth token and the email -> pk index between runs, per
+    CNAP domain and admin user, each with the time it was fetched.  It holds a token,
+    so it is only readable by its owner.
+    '''
+    def __init__(self, path, username):
+        self.path = path
+        self.key = '%s %s' % (DOMAIN, username)
+        self.entry = self._load().get(self.key, {})
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, name, ttl):
+        '''
+        Returns the cached value, or None if there is none younger than `ttl` seconds
+        '''
+        item = self.entry.get(name)
+        if item is not None and time.time() - item['time'] < ttl:
+            return item['value']
+        return None
+
+    def set(self, name, value):
+        self.entry[name] = {'time': time.time(), 'value': value}
+        self._save()
+
+    def clear(self, name):
+        self.entry.pop(name, None)
+        self._save()
+
+    def _save(self):
+        contents = self._load()
+        contents[self.key] = self.entry
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(contents, f)
+        os.replace(tmp_path, self.path)
+
+
 def get_token(username, password):
     '''
     Exchanges username/pwd for an auth token to make subsequent requests to the API
@@ -50,7 +253,7 @@ def get_token(username, password):
     url = DOMAIN + TOKEN_ENDPOINT
     payload = {'username': username, 'password': password}
     headers = {'Content-Type': 'application/json'}
-    r = requests.post(url, data=json.dumps(payload), headers=headers)
+    r = make_session(1).post(url, data=json.dumps(payload), headers=headers)
     j = r.json()
     try:
         return j['token']
@@ -59,6 +262,78 @@ def get_token(username, password):
         sys.exit(1)
 
 
+def get_cached_token(username, password, cache):
+    '''
+    Returns the auth token from `cache`, exchanging username/pwd only if it is missing or expired
+    '''
+    token = cache.get(TOKEN, TOKEN_TTL)
+    if token is None:
+        token = get_token(username, password)
+        cache.set(TOKEN, token)
+    return token
+
+
+def get_user_index(auth_token):
+    '''
+    Fetches every CNAP user, following the pages of the listing if it is paginated,
+    and returns a dict of email -> pk.  Returns None if the token was refused.
+    '''
+    headers = {}
+    headers['Authorization'] = 'Token %s' % auth_token
+    headers['Content-Type']= 'application/json'
+    session = make_session(1)
+    users = {}
+    url = DOMAIN + USERS_ENDPOINT
+    while url:
+        try:
+            r = session.get(url, headers=headers)
+            if r.status_code == 401:
+                return None
+            j = r.json()
+            # a paginated listing wraps each page as {"next": <url or null>, "results": [...]}
+            if isinstance(j, dict):
+                items = j['results']
+                url = j.get('next')
+            else:
+                items = j
+                url = None
+            for item in items:
+                users[item['email']] = item['id']
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            print('Bad response when requesting users.')
+            sys.exit(1)
+    return users
+
+
+def get_cached_user_index(auth_token, cache, refresh=False):
+    '''
+    Returns the email -> pk index from `cache`, fetching it if it is missing or
+    expired (or `refresh`).  Returns None if the token was refused.
+    '''
+    users = None if refresh else cache.get(USERS, USER_INDEX_TTL)
+    if users is None:
+        users = get_user_index(auth_token)
+        if users is not None:
+            cache.set(USERS, users)
+    return users
+
+
+def refresh_user_index(users, auth_token, cache=None):
+    '''
+    Fetches the email -> pk index again into `users` (in place), and saves it in
+    `cache` if given.  Used when an owner is missing from a cached index, since
+    they may have signed up after it was fetched.
+    '''
+    fresh = get_user_index(auth_token)
+    if fresh is None:
+        print('The auth token was refused when requesting users.')
+        sys.exit(1)
+    users.clear()
+    users.update(fresh)
+    if cache is not None:
+        cache.set(USERS, users)
+
+
 def validate_datestring(date_text):
     '''
     Validates that the date string supplied as an optional commandline arg
@@ -83,20 +358,58 @@ def parse():
     parser.add_argument('-c', '--cnap_user', required=False, help='''The username (email) of the user 
         who will own the files.  If blank, will assign the files to the admin user.''')
     parser.add_argument('-e', '--expiration', required=False, help='The expiration date for the files.')
-    parser.add_argument('resources', nargs='+', help='List of file paths (1 or more) in Google storage')
+    parser.add_argument('-n', '--parallel', type=int, default=DEFAULT_MAX_CONCURRENT,
+        help='The number of registration requests in flight at once.  Default: %d' % DEFAULT_MAX_CONCURRENT)
+    parser.add_argument('-m', '--manifest', action='append', default=[],
+        help='''A file listing gs:// paths, one per line ("-" for stdin).  Each path may be followed
+        by the owner's email and an expiration date, separated by tabs or commas; if not, -c and -e
+        apply.  May be given more than once.''')
+    parser.add_argument('-g', '--prefix', action='append', default=[],
+        help='Register every file under this gs:// prefix.  May be given more than once.')
+    parser.add_argument('-j', '--journal', default=DEFAULT_JOURNAL,
+        help='''Registered paths are recorded in this file, and skipped when the same
+        files are registered again (e.g. after a crash).  It is removed once a run
+        registers every file.  Default: %s''' % DEFAULT_JOURNAL)
+    parser.add_argument('--no-journal', action='store_true', help='Do not read or write the journal.')
+    parser.add_argument('--cache', default=DEFAULT_CACHE,
+        help='The auth token and list of users are cached in this file.  Default: %s' % DEFAULT_CACHE)
+    parser.add_argument('--refresh-cache', action='store_true', help='Fetch a new auth token and list of users.')
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT,
+        help='Seconds to wait on CNAP before a request fails.  Default: %d' % REQUEST_TIMEOUT)
+    parser.add_argument('--http-stats',
+        help='On exit, write request counts and latencies per endpoint as JSON to this file ("-" for stderr).')
+    parser.add_argument('resources', nargs='*', help='List of file paths in Google storage')
 
     args = parser.parse_args()
+    if len(args.resources) == 0 and len(args.manifest) == 0 and len(args.prefix) == 0:
+        parser.error('Give file paths, a --manifest or a --prefix.')
+    http_client.configure(timeout=args.timeout, stats_path=args.http_stats)
     arg_dict = {}
-    token = get_token(args.username, args.password)
+    cache = CredentialCache(args.cache, args.username)
+    if args.refresh_cache:
+        cache.clear(TOKEN)
+    token = get_cached_token(args.username, args.password, cache)
+    users = get_cached_user_index(token, cache, refresh=args.refresh_cache)
+    if users is None:
+        # the cached token was revoked; get a new one
+        cache.clear(TOKEN)
+        token = get_cached_token(args.username, args.password, cache)
+        users = get_cached_user_index(token, cache, refresh=True)
+        if users is None:
+            print('The auth token was refused when requesting users.')
+            sys.exit(1)
     arg_dict[TOKEN] = token
+    arg_dict[USERS] = users
+    arg_dict[CACHE] = cache
 
     if args.cnap_user:
         arg_dict[CNAP_USER] = args.cnap_user
     else:
         arg_dict[CNAP_USER] = args.username
 
-    files = parse_files(args.resources)
-    arg_dict[FILES] = files
+    arg_dict[FILES] = ResourceList(args.resources, args.manifest, args.prefix)
+    arg_dict[PARALLEL] = max(1, args.parallel)
+    arg_dict[JOURNAL] = None if args.no_journal else args.journal
     if args.expiration:
         validate_datestring(args.expiration)
         arg_dict[EXPIRY] = args.expiration
@@ -117,77 +430,374 @@ def check_gsutil():
 
 
 
+def iter_object_sizes(urls):
+    '''
+    Lists the given gs:// folders (or objects, or wildcards) with a single gsutil
+    call.  Yields (path, size) for each object as gsutil prints it, so a long listing
+    is never held in memory.
+    '''
+    cmd = ['gsutil', 'ls', '-l'] + list(urls)
+    with tempfile.TemporaryFile() as errors:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors)
+        listed = 0
+        for line in p.stdout:
+            # object lines look like:   1234  2019-01-01T00:00:00Z  gs://bucket/path
+            contents = line.decode('utf-8').strip().split(None, 2)
+            if len(contents) == 3 and contents[0].isdigit() and contents[2].startswith(GS_PREFIX):
+                listed += 1
+                yield contents[2], int(contents[0])
+        p.wait()
+        # gsutil also fails if any one folder is missing, so only complain if nothing was listed
+        if p.returncode != 0 and listed == 0:
+            errors.seek(0)
+            message = errors.read().decode('utf-8').strip()
+            if 'matched no objects' not in message:
+                print('Error when listing files.  Command was: %s\n%s' % (' '.join(cmd[:3]), message))
+                sys.exit(1)
+
+
+def get_parent_folder(path):
+    return path.rsplit('/', 1)[0] + '/'
+
+
+def get_listing_url(folder, names):
+    '''
+    Returns a gsutil wildcard that lists the files `names` in `folder`, narrowed to
+    their common prefix so only part of a very large folder is listed.
+    '''
+    common = os.path.commonprefix(names)
+    for c in WILDCARD_CHARACTERS:
+        common = common.split(c)[0]
+    return folder + common + '*'
+
+
+def get_filesizes(path_list):
+    '''
+    Returns a dict of path -> size in bytes for each gs:// path that exists.  Paths
+    are grouped by folder and the folders listed LISTING_CHUNK at a time, so the
+    whole list costs a few gsutil calls rather than one per file.
+    '''
+    wanted = set(path_list)
+    folder_to_names = {}
+    for x in wanted:
+        folder = get_parent_folder(x)
+        folder_to_names.setdefault(folder, []).append(x[len(folder):])
+    urls = sorted(get_listing_url(x, folder_to_names[x]) for x in folder_to_names)
+    sizes = {}
+    for start in range(0, len(urls), LISTING_CHUNK):
+        for path, size in iter_object_sizes(urls[start:start + LISTING_CHUNK]):
+            if path in wanted:
+                sizes[path] = size
+    return sizes
+
+
+def iter_with_sizes(rows, batch_size=SIZE_BATCH):
+    '''
+    Fills in the size of each streamed row (None if the file does not exist), looking
+    the sizes up batch_size paths at a time.  Rows that already have a size pass through.
+    '''
+    batch = []
+    for row in rows:
+        if row[1] is not None:
+            yield row
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            sizes = get_filesizes([x[0] for x in batch])
+            for path, size, owner, expiry in batch:
+                yield path, sizes.get(path), owner, expiry
+            batch = []
+    if len(batch) > 0:
+        sizes = get_filesizes([x[0] for x in batch])
+        for path, size, owner, expiry in batch:
+            yield path, sizes.get(path), owner, expiry
+
+
 def get_filesize(filepath):
     '''
     filepath is a gs://... path
     Returns the file size in bytes (int)
     '''
-    cmd = 'gsutil du %s' % filepath
-    p = subprocess.Popen(cmd, shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    if p.returncode != 0:
-        print('Error when requesting file size.  Command was: %s' % cmd)
-        sys.exit(1) 
-    else:
-        s = stdout.decode('utf-8')
-        if len(s) > 0:
-            contents = [x.strip() for x in s.split(' ')]
-            return int(contents[0])
-        else:
-            print('The path (%s) did not exist.  Exiting.' % filepath)
-            sys.exit(1)
+    sizes = get_filesizes([filepath])
+    if filepath not in sizes:
+        print('The path (%s) did not exist.  Exiting.' % filepath)
+        sys.exit(1)
+    return sizes[filepath]
 
 
-def get_owner_pk(username, auth_token):
+def get_owner_pk(username, auth_token, users=None, cache=None):
     '''
-    Returns the user's primary key
+    Returns the user's primary key, from the email -> pk index `users` if given.
+    A user missing from `users` is looked for once more in a freshly fetched
+    index (see refresh_user_index).
     '''
-    headers = {}
-    headers['Authorization'] = 'Token %s' % auth_token
-    headers['Content-Type']= 'application/json'
-    url = DOMAIN + USERS_ENDPOINT
-    r = requests.get(url, headers=headers)
-    j = r.json()
-    try:
-        for item in j:
-            if item['email'] == username:
-                return item['id']
+    if users is None:
+        users = get_user_index(auth_token)
+        if users is None:
+            print('Bad response when requesting users.')
+            sys.exit(1)
+    elif username not in users:
+        refresh_user_index(users, auth_token, cache)
+    if username not in users:
         print('User (%s) not found' % username)
         sys.exit(1)
-    except: 
-        print('Bad response when requesting users.')
+    return users[username]
+
+
+def make_session(pool_size):
+    '''
+    Returns a session (see http_client.Client) that keeps up to `pool_size` connections
+    to CNAP open for re-use, and re-sends GETs after server or connection errors.
+    '''
+    return http_client.Client(pool_size=pool_size, retry=REQUEST_RETRY)
+
+
+def is_registered(session, headers, path):
+    '''
+    Returns True if CNAP's resource listing has `path`
+    '''
+    return any(x['path'] == path for x in iter_registered_resources(session, headers))
+
+
+def register_file(session, url, headers, payload):
+    '''
+    POSTs a single resource.  It is sent again after a 429 or 503, or a failure to
+    connect, since CNAP did not act on it.  After any other server or connection
+    error it may have been created all the same, so it is only sent again if the
+    resource listing does not have it.  Returns None if it was created, or otherwise
+    the reason it was not.
+    '''
+    error = None
+    unsure = False
+    for failures in range(DEFAULT_RETRIES + 1):
+        if failures > 0:
+            time.sleep(REQUEST_RETRY.delay(failures))
+        if unsure:
+            try:
+                if is_registered(session, headers, payload['path']):
+                    return None
+            except (IOError, requests.exceptions.RequestException) as ex:
+                error = 'Could not check whether it was registered: %s' % ex
+                continue
+            unsure = False
+        try:
+            r = session.post(url, data=json.dumps(payload), headers=headers, retry=http_client.NO_RETRY)
+        except requests.exceptions.ConnectTimeout as ex:
+            error = 'Request failed: %s' % ex
+            continue
+        except requests.exceptions.RequestException as ex:
+            error = 'Request failed: %s' % ex
+            unsure = True
+            continue
+        if r.status_code == 201:
+            return None
+        error = 'Return code=%s\n    Reason:%s' % (r.status_code, r.text)
+        if r.status_code >= 500 and r.status_code not in REFUSED_STATUSES:
+            unsure = True
+        elif r.status_code not in REFUSED_STATUSES:
+            return error
+    return error
+
+
+def iter_registered_resources(session, headers):
+    '''
+    Yields every resource registered with CNAP, following the pages of the listing
+    if it is paginated.  Raises IOError if the listing cannot be read.
+    '''
+    url = DOMAIN + RESOURCE_ENDPOINT
+    while url:
+        try:
+            r = session.get(url, headers=headers)
+            j = r.json()
+        except (requests.exceptions.RequestException, ValueError) as ex:
+            raise IOError('Could not list the existing resources: %s' % ex)
+        if r.status_code == 401:
+            raise IOError('The auth token was refused.  If it was revoked, run again with --refresh-cache.')
+        if r.status_code != 200:
+            raise IOError('Could not list the existing resources.  Received status code %d: %s' % (r.status_code, r.text))
+        # a paginated listing wraps each page as {"next": <url or null>, "results": [...]}
+        if isinstance(j, dict):
+            items = j.get('results', [])
+            url = j.get('next')
+        else:
+            items = j
+            url = None
+        for item in items:
+            yield item
+
+
+def get_resource_index(session, headers):
+    '''
+    Fetches every resource registered with CNAP and returns a dict of path -> owner pk (as a string).
+    '''
+    index = {}
+    try:
+        for item in iter_registered_resources(session, headers):
+            owner = item.get('owner')
+            if isinstance(owner, dict):
+                owner = owner.get('id')
+            index[item['path']] = str(owner)
+    except IOError as ex:
+        print(ex)
         sys.exit(1)
+    return index
+
+
+class Journal(object):
+    '''
+    An append-only record of registered files, one "path<TAB>owner" line each,
+    written as soon as each registration succeeds so a crash loses nothing that finished.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    contents = line.rstrip('\n').split('\t')
+                    if len(contents) == 2:
+                        self.done.add((contents[0], contents[1]))
+        self._file = open(path, 'a')
+
+    def is_done(self, path, owner_pk):
+        return (path, str(owner_pk)) in self.done
+
+    def record(self, path, owner_pk):
+        self.done.add((path, str(owner_pk)))
+        self._file.write('%s\t%s\n' % (path, owner_pk))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def report_results(registered, failed, skipped=0):
+    '''
+    Prints a summary of a registration run
+    '''
+    print('Registered %d of %d files.' % (registered, registered + len(failed)))
+    if skipped > 0:
+        print('Skipped %d files that were already registered.' % skipped)
+    if len(failed) > 0:
+        print('The following files were NOT registered:')
+        for p in sorted(failed):
+            print('    %s' % p)
 
 
 def register_files(args, owner_pk):
     '''
-    Makes the request to the API
+    Makes the requests to the API, up to args[PARALLEL] at once over a shared session.
+    args[FILES] is a ResourceList, streamed, or a list of paths or rows (see as_row).
+    Files are owned by owner_pk unless their row names an owner, which is looked up
+    in the email -> pk index args[USERS] (fetched again if an owner is missing).
+
+    The existing resources are fetched first.  If any of the paths belong to another
+    user, or name an unknown owner, they are listed and nothing is registered.  Paths
+    the owner already has, or that args[JOURNAL] records from an earlier run, are
+    skipped without a request.  The journal is removed if every file was registered.
+    Returns the number of files registered and a dict of path -> error for those that were not.
     '''
-    path_list = args[FILES]
     auth_token = args[TOKEN]
+    max_concurrent = args.get(PARALLEL, DEFAULT_MAX_CONCURRENT)
     url = DOMAIN + RESOURCE_ENDPOINT
     headers = {}
     headers['Authorization'] = 'Token %s' % auth_token
     headers['Content-Type']= 'application/json'
-    for p in path_list:
-        payload = PAYLOAD_TEMPLATE.copy()
-        payload['path'] = p
-        name = os.path.basename(p)
-        payload['name'] = name
-        size = get_filesize(p)
-        payload['size'] = size
-        payload['owner'] = owner_pk
-        payload['expiration_date'] = args[EXPIRY]
-        r = requests.post(url, data=json.dumps(payload), headers=headers)
-        if r.status_code != 201:
-            print('ERROR registering %s\n    Return code=%s\n    Reason:%s' % (p, r.status_code, r.text))
-        else:
-            print('Successfully added: %s' % p)
+
+    files = args[FILES]
+    if not isinstance(files, ResourceList):
+        files = list(files)
+    session = make_session(max_concurrent)
+    index = get_resource_index(session, headers)
+    users = args.get(USERS) or {}
+    conflicts, unknown = find_problems(files, index, users, owner_pk)
+    if len(unknown) > 0:
+        # the index may be a cached copy from before these owners signed up
+        refresh_user_index(users, auth_token, args.get(CACHE))
+        conflicts, unknown = find_problems(files, index, users, owner_pk)
+    if len(unknown) > 0:
+        print('The following owners were not found.  Nothing was registered.')
+        for owner in unknown:
+            print('    %s' % owner)
+    if len(conflicts) > 0:
+        print('The following paths are already registered to another user.  Nothing was registered.')
+        for p in conflicts:
+            print('    %s' % p)
+    if len(unknown) > 0 or len(conflicts) > 0:
+        sys.exit(1)
+
+    journal = Journal(args[JOURNAL]) if args.get(JOURNAL) else None
+    registered = 0
+    skipped = 0
+    failed = {}
+    pending = {}
+
+    def iter_new(rows):
+        # drop what is already registered (or repeated) before any sizes are looked up
+        nonlocal skipped
+        for row in rows:
+            path, size, owner, expiry = as_row(row)
+            if owner is not None and owner not in users:
+                failed[path] = 'The owner (%s) was not found.' % owner
+                print('ERROR registering %s\n    %s' % (path, failed[path]))
+                continue
+            pk = owner_pk if owner is None else users[owner]
+            if index.get(path) == str(pk) or (journal and journal.is_done(path, pk)):
+                skipped += 1
+            else:
+                index[path] = str(pk)
+                yield path, size, pk, expiry
+
+    def collect(futures):
+        nonlocal registered
+        for future in futures:
+            p, pk = pending.pop(future)
+            error = future.result()
+            if error is not None:
+                failed[p] = error
+                print('ERROR registering %s\n    %s' % (p, error))
+            else:
+                registered += 1
+                if journal:
+                    journal.record(p, pk)
+                print('Successfully added: %s' % p)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+            for p, size, pk, expiry in iter_with_sizes(iter_new(files)):
+                if size is None:
+                    failed[p] = 'The path did not exist.'
+                    print('ERROR registering %s\n    %s' % (p, failed[p]))
+                    continue
+                if len(pending) >= max_concurrent * PENDING_PER_WORKER:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                payload = PAYLOAD_TEMPLATE.copy()
+                payload['path'] = p
+                name = os.path.basename(p)
+                payload['name'] = name
+                payload['size'] = size
+                payload['owner'] = pk
+                payload['expiration_date'] = expiry or args[EXPIRY]
+                future = executor.submit(register_file, session, url, headers, payload)
+                pending[future] = (p, pk)
+    finally:
+        # the executor has finished whatever was in flight, even if we are stopping early
+        collect(list(pending))
+        if journal:
+            journal.close()
+    if journal and len(failed) == 0:
+        # everything was registered, so there is nothing for a rerun to pick up
+        os.remove(journal.path)
+    report_results(registered, failed, skipped)
+    return registered, failed
 
 
 if __name__ == '__main__':
     check_gsutil()
     args = parse()
     auth_token = args[TOKEN]
-    owner_pk = get_owner_pk(args[CNAP_USER], auth_token)
-    register_files(args, owner_pk)
\ No newline at end of file
+    owner_pk = get_owner_pk(args[CNAP_USER], auth_token, args[USERS], args[CACHE])
+    registered, failed = register_files(args, owner_pk)
+    if len(failed) > 0:
+        sys.exit(1)
\ No newline at end of file
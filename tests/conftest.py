@@ -0,0 +1,159 @@
+'''
+Shared fixtures.  The scripts live at the top of the repository rather than in a
+package, so that directory is put on the import path here.  The fake Dropbox and
+Cromwell servers are the ones the benchmarks use; CNAP is stood in for here.
+'''
+import os
+import sys
+import json
+import threading
+import http.server
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import dropbox_transfer_benchmark
+import cromwell_headless_submit_benchmark
+import register_files
+
+FAKE_CNAP_TOKEN = 'test-token'
+
+
+def serve(server):
+    '''
+    Runs `server` on a daemon thread.  Returns the server, for convenience.
+    '''
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def dropbox_server(tmp_path):
+    '''
+    A FakeDropboxServer with no bandwidth limit or added latency.
+    '''
+    root = tmp_path / 'server'
+    root.mkdir()
+    server = serve(dropbox_transfer_benchmark.FakeDropboxServer(str(root), 1e12, 0))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dropbox_client(dropbox_server):
+    return dropbox_transfer_benchmark.LocalDropbox(dropbox_server.url, dropbox_transfer_benchmark.FAKE_TOKEN)
+
+
+@pytest.fixture
+def cromwell_server():
+    '''
+    A FakeCromwellServer with no added latency or injected errors.
+    '''
+    server = serve(cromwell_headless_submit_benchmark.FakeCromwellServer(0, 0))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FakeCNAPHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Handles the CNAP routes used by register_files.py: the token exchange, and
+    listing users, listing resources and creating resources.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        route = '%s %s' % (method, self.path.split('?')[0])
+        self.server.count(route)
+        if route == 'POST /api-token-auth/':
+            self.send_json(200, {'token': FAKE_CNAP_TOKEN})
+        elif self.headers.get('Authorization') != 'Token %s' % FAKE_CNAP_TOKEN:
+            self.send_json(401, {'detail': 'Invalid token.'})
+        elif route == 'GET /users/':
+            self.send_json(200, [{'email': email, 'id': pk} for email, pk in self.server.users.items()])
+        elif route == 'GET /resources/':
+            self.send_json(200, list(self.server.resources.values()))
+        elif route == 'POST /resources/':
+            payload = json.loads(body.decode('utf-8'))
+            if payload['path'] in self.server.fail_paths:
+                self.send_json(400, {'detail': 'injected error'})
+                return
+            with self.server.lock:
+                flaky = payload['path'] in self.server.flaky_paths
+                self.server.flaky_paths.discard(payload['path'])
+            if flaky:
+                self.send_json(503, {'detail': 'injected error'})
+                return
+            with self.server.lock:
+                self.server.resources[payload['path']] = payload
+                lost = payload['path'] in self.server.lost_paths
+                self.server.lost_paths.discard(payload['path'])
+            if lost:
+                self.send_json(500, {'detail': 'injected error'})
+                return
+            self.send_json(201, payload)
+        else:
+            self.send_json(404, {'detail': 'unknown route %s' % route})
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeCNAPServer(http.server.ThreadingHTTPServer):
+    '''
+    A local stand-in for the CNAP application.  `users` maps email -> pk, `resources`
+    maps path -> resource, and POSTs of the paths in `fail_paths` get a 400 (which is not retried).
+    The first POST of each path in `flaky_paths` gets a 503, and the first of each
+    path in `lost_paths` creates the resource but then gets a 500.
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), FakeCNAPHandler)
+        self.lock = threading.Lock()
+        self.users = {}
+        self.resources = {}
+        self.fail_paths = set()
+        self.flaky_paths = set()
+        self.lost_paths = set()
+        self.request_counts = {}
+
+    def count(self, route):
+        with self.lock:
+            self.request_counts[route] = self.request_counts.get(route, 0) + 1
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+@pytest.fixture
+def cnap_server(monkeypatch):
+    '''
+    A FakeCNAPServer, which register_files.py is pointed at.
+    '''
+    server = serve(FakeCNAPServer())
+    monkeypatch.setattr(register_files, 'DOMAIN', server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
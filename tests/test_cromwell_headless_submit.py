@@ -0,0 +1,309 @@
+import io
+import os
+import gzip
+import json
+import uuid
+import asyncio
+import zipfile
+import threading
+
+import pytest
+
+import cromwell_headless_submit
+
+
+def server_url(server):
+    return cromwell_headless_submit.get_server_url({'ip': server.server_address[0], 'port': server.server_address[1]})
+
+
+def test_metadata_cache_is_kept_only_for_complete_reads(tmp_path, cromwell_server):
+    workflow_id = cromwell_server.store.submit()
+    cromwell_server.store.set_all('Succeeded')
+    session = cromwell_headless_submit.make_session(1)
+    cache_dir = str(tmp_path / 'cache')
+    cache_path = cromwell_headless_submit.get_metadata_cache_path(cache_dir, workflow_id, [])
+
+    # a caller that stops reading part way must not leave a partial document in the cache
+    pieces = cromwell_headless_submit.iter_metadata(session, server_url(cromwell_server), workflow_id, [], cache_dir)
+    for piece in pieces:
+        if piece[1] == 'status':
+            break
+    pieces.close()
+    assert not os.path.exists(cache_path)
+    assert os.listdir(cache_dir) == []
+
+    fetched = list(cromwell_headless_submit.iter_metadata(session, server_url(cromwell_server), workflow_id, [], cache_dir))
+    assert ('workflow', 'status', 'Succeeded') in fetched
+    assert os.path.exists(cache_path)
+    cached = list(cromwell_headless_submit.iter_metadata(session, 'http://127.0.0.1:1', workflow_id, [], cache_dir))
+    assert cached == fetched
+
+
+def test_incomplete_cached_metadata_is_evicted(tmp_path):
+    cache_dir = str(tmp_path)
+    cache_path = cromwell_headless_submit.get_metadata_cache_path(cache_dir, 'abc', [])
+    with gzip.open(cache_path, 'wb') as fout:
+        fout.write(b'{"id": "abc", "status": "Succeeded", "calls": {')
+    with pytest.raises(IOError):
+        list(cromwell_headless_submit.iter_metadata(None, 'http://127.0.0.1:1', 'abc', [], cache_dir))
+    assert not os.path.exists(cache_path)
+
+
+METADATA_DOCUMENTS = [
+    b'{"z": -0.5, "t": false}',
+    b'{"id": "abc", "n": 12.25, "e": 1.5e3, "big": -12E-2, "none": null, "ok": true, "calls": {}}',
+    b'{ "status" : "Succeeded" ,\n "calls" : { "main.a" : [ {"shardIndex": -1, "attempt": 1} , {"shardIndex": 0} ],'
+        b' "main.b": [] }, "inputs": {"x": [1, 2.5, "\xc3\xa9\\"\\u00e9"]}, "end": 0 }',
+    b'{"calls": {"main.sub": [{"subWorkflowMetadata": {"calls": {"sub.t": [{"a": 10}]}}, "shardIndex": 3}]}, "last": 10}'
+]
+
+
+def parse_in_blocks(document, blocks):
+    parser = cromwell_headless_submit.MetadataStreamParser()
+    pieces = []
+    start = 0
+    for end in blocks + [len(document)]:
+        pieces.extend(parser.feed(document[start:end]))
+        start = end
+    pieces.extend(parser.close())
+    assert parser.finished
+    parsed = {}
+    for kind, key, value in pieces:
+        if kind == 'workflow':
+            parsed[key] = value
+        else:
+            parsed.setdefault('calls', {}).setdefault(key, []).append(value)
+    return parsed
+
+
+@pytest.mark.parametrize('document', METADATA_DOCUMENTS, ids=['split-number', 'scalars', 'calls', 'subworkflow'])
+def test_metadata_parser_matches_json_at_every_block_boundary(document):
+    expected = json.loads(document.decode('utf-8'))
+    # calls with no attempts give no pieces, so they cannot be told apart from missing ones
+    expected_calls = dict((k, v) for k, v in expected.get('calls', {}).items() if len(v) > 0)
+    expected = dict(expected, calls=expected_calls) if len(expected_calls) > 0 else \
+        dict((k, v) for k, v in expected.items() if k != 'calls')
+    assert parse_in_blocks(document, list(range(1, len(document)))) == expected
+    for i in range(len(document) + 1):
+        for j in range(i, len(document) + 1, 3):
+            assert parse_in_blocks(document, [i, j]) == expected
+
+
+def test_metadata_parser_rejects_a_truncated_number_at_the_end():
+    parser = cromwell_headless_submit.MetadataStreamParser()
+    assert parser.feed(b'{"z": 12.') == []
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+def timestamp(minutes):
+    return '2020-01-01T%02d:%02d:00.000Z' % divmod(minutes, 60)
+
+
+def timed_call(start, end, shard=-1, **fields):
+    return dict(fields, start=timestamp(start), end=timestamp(end), shardIndex=shard, attempt=1)
+
+
+def test_phase_times_count_overlapping_events_once_for_the_highest_priority_phase():
+    events = [
+        {'description': 'Pending', 'startTime': timestamp(0), 'endTime': timestamp(1)},
+        {'description': 'RunningJob', 'startTime': timestamp(1), 'endTime': timestamp(5)},
+        {'description': 'Localization', 'startTime': timestamp(1), 'endTime': timestamp(2)},
+        {'description': 'UserAction', 'startTime': timestamp(2), 'endTime': timestamp(4)},
+        {'description': 'Delocalization', 'startTime': timestamp(4), 'endTime': timestamp(5)},
+        {'description': 'UpdatingJobStore', 'startTime': timestamp(6)}
+    ]
+    assert cromwell_headless_submit.get_phase_times(events) == {
+        'queued': 60.0, 'localizing': 60.0, 'running': 120.0, 'delocalizing': 60.0
+    }
+
+
+def test_profile_follows_scatters_and_subworkflows_along_the_critical_path(cromwell_server):
+    workflow_id = cromwell_server.store.submit()
+    cromwell_server.store.set_all('Succeeded')
+    cromwell_server.store.calls[workflow_id] = {
+        'main.prep': [timed_call(0, 10, executionEvents=[
+            {'description': 'RunningJob', 'startTime': timestamp(0), 'endTime': timestamp(10)}])],
+        'main.scatter': [timed_call(10, 20, 0), timed_call(10, 40, 1), timed_call(11, 25, 2)],
+        'main.sub': [timed_call(40, 90, subWorkflowId='sub-1', subWorkflowMetadata={'calls': {
+            'sub.align': [timed_call(41, 60, 0), timed_call(41, 70, 1)],
+            'sub.merge': [timed_call(70, 89)]
+        }})]
+    }
+    session = cromwell_headless_submit.make_session(1)
+    result = cromwell_headless_submit.profile_workflow(session, server_url(cromwell_server), workflow_id)
+
+    # the subworkflow call is profiled as the tasks it ran, not as one task
+    assert sorted(result['tasks']) == ['main.prep', 'main.scatter', 'sub.align', 'sub.merge']
+    assert [x['calls'] for x in map(result['tasks'].get, sorted(result['tasks']))] == [1, 3, 2, 1]
+    assert result['tasks']['main.scatter']['wall'] == (10 + 30 + 14) * 60
+    assert result['tasks']['main.prep']['running'] == 600
+    assert [(x[0], x[1]) for x in result['critical_path']] == [
+        ('main.prep', -1), ('main.scatter', 1), ('sub.align', 1), ('sub.merge', -1)
+    ]
+    assert result['tasks']['sub.align']['critical_path_time'] == 29 * 60
+
+
+def test_bulk_status_makes_one_query_per_page(tmp_path, capsys, cromwell_server):
+    num_workflows = cromwell_headless_submit.QUERY_PAGE_SIZE + 500
+    workflow_ids = [cromwell_server.store.submit() for i in range(num_workflows)]
+    cromwell_server.store.set_all('Running')
+    ids_file = tmp_path / 'ids.txt'
+    ids_file.write_text('\n'.join(workflow_ids) + '\n')
+    cromwell_server.reset_counts()
+
+    cromwell_headless_submit.query_bulk_status({
+        'ip': cromwell_server.server_address[0],
+        'port': cromwell_server.server_address[1],
+        'cromwell_ids': [],
+        'ids_file': str(ids_file),
+        'label': [],
+        'status': [],
+        'format': cromwell_headless_submit.JSON_LINES
+    })
+    assert cromwell_server.reset_counts() == {'POST query': 2}
+    printed = [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+    assert sorted(x['id'] for x in printed) == sorted(workflow_ids)
+    assert all(x['status'] == 'Running' for x in printed)
+
+
+def test_nested_imports_are_packaged_across_repeated_submissions(tmp_path, monkeypatch, cromwell_server):
+    calls = {'find_wdl_imports': 0, 'build_dependency_zip': 0}
+
+    def counted(name):
+        func = getattr(cromwell_headless_submit, name)
+
+        def wrapper(*args):
+            calls[name] += 1
+            return func(*args)
+        monkeypatch.setattr(cromwell_headless_submit, name, wrapper)
+
+    counted('find_wdl_imports')
+    counted('build_dependency_zip')
+    wdl_dir = tmp_path / 'wdl'
+    (wdl_dir / 'tasks').mkdir(parents=True)
+    (wdl_dir / 'common').mkdir()
+    (wdl_dir / 'main.wdl').write_text('import "tasks/align.wdl" as align\nworkflow main {}\n')
+    (wdl_dir / 'tasks' / 'align.wdl').write_text('import "common/utils.wdl" as utils\ntask align {}\n')
+    utils = wdl_dir / 'common' / 'utils.wdl'
+    utils.write_text('task utils { command { echo v1 } }\n')
+    input_json = tmp_path / 'inputs.json'
+    input_json.write_text('{}')
+    args = {
+        'ip': cromwell_server.server_address[0],
+        'port': cromwell_server.server_address[1],
+        'input_json': str(input_json),
+        'main_wdl': str(wdl_dir / 'main.wdl'),
+        'dependencies_zip': None,
+        'no_auto_zip': False,
+        'dependency_cache_dir': str(tmp_path / 'zips'),
+        'preflight': False,
+        'zone': 'us-east4-c'
+    }
+
+    def submit():
+        before = set(cromwell_server.store.workflows)
+        cromwell_headless_submit.submit_job(args)
+        workflow_id = (set(cromwell_server.store.workflows) - before).pop()
+        archive = zipfile.ZipFile(io.BytesIO(cromwell_server.store.dependencies[workflow_id]))
+        return dict((x, archive.read(x)) for x in archive.namelist())
+
+    first = submit()
+    assert first == {
+        'tasks/align.wdl': b'import "common/utils.wdl" as utils\ntask align {}\n',
+        'common/utils.wdl': b'task utils { command { echo v1 } }\n'
+    }
+    assert calls == {'find_wdl_imports': 1, 'build_dependency_zip': 1}
+    # while nothing changes, the cached zip is sent without walking the imports or compressing again
+    assert submit() == first
+    assert calls == {'find_wdl_imports': 1, 'build_dependency_zip': 1}
+
+    # a change to a nested import is picked up by the next submission
+    utils.write_text('task utils { command { echo v2 } }\n')
+    stamp = os.stat(str(utils)).st_mtime + 1
+    os.utime(str(utils), (stamp, stamp))
+    assert submit() == dict(first, **{'common/utils.wdl': b'task utils { command { echo v2 } }\n'})
+    assert calls == {'find_wdl_imports': 2, 'build_dependency_zip': 2}
+    assert len([x for x in os.listdir(str(tmp_path / 'zips')) if x.endswith('.zip')]) == 2
+
+
+def test_watch_gives_up_on_unknown_jobs_and_runs_callbacks_off_the_loop(tmp_path, monkeypatch, cromwell_server):
+    monkeypatch.setattr(cromwell_headless_submit, 'POLL_INTERVALS', {})
+    monkeypatch.setattr(cromwell_headless_submit, 'DEFAULT_POLL_INTERVAL', 0)
+    monkeypatch.setattr(cromwell_headless_submit, 'MAX_MISSING_POLLS', 2)
+    known = cromwell_server.store.submit()
+    cromwell_server.store.set_all('Succeeded')
+    unknown = str(uuid.uuid4())
+    cache = cromwell_headless_submit.WorkflowStateCache(str(tmp_path / 'watch.sqlite'))
+    cache.add([known, unknown])
+    events = []
+    threads = []
+
+    def callback(event):
+        events.append(event)
+        threads.append(threading.current_thread())
+
+    watcher = cromwell_headless_submit.WorkflowWatcher(server_url(cromwell_server), cache, [callback])
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.wait_for(watcher.run(loop), 30))
+    finally:
+        watcher.close()
+        loop.close()
+    assert sorted((x['id'], x['status']) for x in events) == sorted([
+        (known, 'Succeeded'),
+        (unknown, cromwell_headless_submit.UNKNOWN_STATUS)
+    ])
+    assert threading.current_thread() not in threads
+    assert cache.next_poll() is None
+
+
+@pytest.mark.parametrize('imported', ['../shared/utils.wdl', 'tasks/../../utils.wdl', '/opt/wdl/utils.wdl'])
+def test_imports_outside_the_zip_root_are_rejected(tmp_path, imported):
+    (tmp_path / 'main.wdl').write_text('import "%s" as utils\nworkflow main {}\n' % imported)
+    with pytest.raises(SystemExit):
+        cromwell_headless_submit.find_wdl_imports(str(tmp_path / 'main.wdl'))
+
+
+def test_imports_that_stay_inside_the_zip_root_are_normalized(tmp_path):
+    (tmp_path / 'tasks').mkdir()
+    (tmp_path / 'tasks' / 'align.wdl').write_text('task align {}\n')
+    (tmp_path / 'main.wdl').write_text('import "common/../tasks/./align.wdl" as align\nworkflow main {}\n')
+    imports = cromwell_headless_submit.find_wdl_imports(str(tmp_path / 'main.wdl'))
+    assert imports == {'tasks/align.wdl': str(tmp_path / 'tasks' / 'align.wdl')}
+
+
+def test_watch_runs_on_its_own_event_loop(tmp_path, monkeypatch, cromwell_server):
+    monkeypatch.setattr(cromwell_headless_submit, 'POLL_INTERVALS', {})
+    monkeypatch.setattr(cromwell_headless_submit, 'DEFAULT_POLL_INTERVAL', 0)
+    workflow_id = cromwell_server.store.submit()
+    cromwell_server.store.set_all('Succeeded')
+    events_path = tmp_path / 'events.jsonl'
+    args = {
+        'ip': cromwell_server.server_address[0],
+        'port': cromwell_server.server_address[1],
+        'cromwell_ids': [workflow_id],
+        'ids_file': None,
+        'label': [],
+        'status': [],
+        'cache': str(tmp_path / 'watch.sqlite'),
+        'events': str(events_path),
+        'hook': None,
+        'concurrency': 2,
+        'discover_interval': 60
+    }
+    errors = []
+
+    def watch():
+        try:
+            cromwell_headless_submit.watch_jobs(args)
+        except Exception as ex:
+            errors.append(ex)
+
+    # a thread other than the main one has no default loop for asyncio.get_event_loop() to hand out
+    thread = threading.Thread(target=watch)
+    thread.start()
+    thread.join(30)
+    assert errors == []
+    events = [json.loads(x) for x in events_path.read_text().splitlines()]
+    assert [(x['id'], x['status']) for x in events] == [(workflow_id, 'Succeeded')]
@@ -0,0 +1,20 @@
+import uuid
+
+import cromwell_headless_submit
+import cromwell_headless_submit_benchmark
+
+
+def test_status_scenarios_count_only_jobs_cromwell_returned(cromwell_server):
+    workflow_ids = [cromwell_server.store.submit(), str(uuid.uuid4())]
+    common_args = {'ip': cromwell_server.server_address[0], 'port': cromwell_server.server_address[1]}
+
+    def query_each():
+        for workflow_id in workflow_ids:
+            cromwell_headless_submit.query_job_status(dict(common_args, cromwell_id=workflow_id))
+
+    def query_bulk():
+        cromwell_headless_submit.query_bulk_status(dict(common_args, cromwell_ids=workflow_ids, ids_file=None,
+            label=[], status=[], format=cromwell_headless_submit.JSON_LINES))
+
+    assert cromwell_headless_submit_benchmark.count_printed_ids(query_each, workflow_ids) == 1
+    assert cromwell_headless_submit_benchmark.count_printed_ids(query_bulk, workflow_ids) == 1
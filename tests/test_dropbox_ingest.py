@@ -0,0 +1,59 @@
+import io
+
+import dropbox_ingest
+import register_files
+
+
+class MemorySink(object):
+    '''
+    A stand-in for GCSSink that keeps each object in memory.  Opening any of
+    `fail_paths` raises IOError, as a failed upload would.
+    '''
+    def __init__(self, fail_paths=()):
+        self.objects = {}
+        self.fail_paths = set(fail_paths)
+
+    def open(self, gs_path):
+        if gs_path in self.fail_paths:
+            raise IOError('injected error')
+        sink = self
+
+        class Writer(io.BytesIO):
+            def close(self):
+                sink.objects[gs_path] = self.getvalue()
+                io.BytesIO.close(self)
+        return Writer()
+
+
+def test_registration_failures_are_reported(dropbox_client):
+    for name in ('a.txt', 'b.txt'):
+        dropbox_client.files_upload(name.encode('utf-8'), '/ingest/%s' % name)
+    sink = MemorySink()
+
+    def registrar(files):
+        return {'gs://bucket/data/b.txt': 'Return code=500'}
+
+    results = dropbox_ingest.ingest('/ingest', 'gs://bucket/data', dropbox_client, sink, registrar, file_workers=2)
+    assert sink.objects == {'gs://bucket/data/a.txt': b'a.txt', 'gs://bucket/data/b.txt': b'b.txt'}
+    assert results['gs://bucket/data/a.txt'] is None
+    assert 'Return code=500' in results['gs://bucket/data/b.txt']
+
+
+def test_only_copied_files_are_registered_with_their_dropbox_sizes(monkeypatch, dropbox_client, cnap_server):
+    cnap_server.users['admin@example.com'] = 1
+    for name, data in (('a.txt', b'aaa'), ('sub/b.txt', b'bbbbb'), ('c.txt', b'c')):
+        dropbox_client.files_upload(data, '/ingest/%s' % name)
+
+    def no_gsutil(paths):
+        raise AssertionError('sizes were looked up with gsutil: %s' % paths)
+
+    monkeypatch.setattr(register_files, 'get_filesizes', no_gsutil)
+    registrar = dropbox_ingest.make_cnap_registrar('admin@example.com', 'password')
+    sink = MemorySink(fail_paths=['gs://bucket/data/c.txt'])
+    results = dropbox_ingest.ingest('/ingest', 'gs://bucket/data', dropbox_client, sink, registrar, file_workers=2)
+    assert results['gs://bucket/data/a.txt'] is None and results['gs://bucket/data/sub/b.txt'] is None
+    assert 'injected error' in results['gs://bucket/data/c.txt']
+    assert dict((x['path'], x['size']) for x in cnap_server.resources.values()) == {
+        'gs://bucket/data/a.txt': 3,
+        'gs://bucket/data/sub/b.txt': 5
+    }
@@ -0,0 +1,335 @@
+import os
+import hashlib
+import sys
+import time
+import subprocess
+
+import pytest
+import requests
+
+import dropbox_transfer
+import dropbox_transfer_benchmark
+from conftest import REPO_ROOT, serve
+
+MB = 1024*1024
+RANGE_SIZE = 4*MB
+
+# Uploads a file with a given memory cap and prints how much the peak RSS grew.
+# It runs in its own process so the peak is not the test runner's (or the fake server's).
+UPLOAD_SCRIPT = '''
+import sys
+sys.path.insert(0, %r)
+import dropbox_transfer, dropbox_transfer_benchmark
+
+def peak_rss():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmHWM'):
+            return int(line.split()[1]) * 1024
+
+url, path, cap, chunk_size, workers = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5])
+dropbox_transfer.UPLOAD_MEMORY = dropbox_transfer.MemoryBudget(cap)
+client = dropbox_transfer_benchmark.LocalDropbox(url, dropbox_transfer_benchmark.FAKE_TOKEN)
+with open('/proc/self/clear_refs', 'w') as fout:
+    fout.write('5')
+before = peak_rss()
+dropbox_transfer.send_to_dropbox(path, '/rss', client, workers=workers, chunk_size=chunk_size, overwrite=True)
+sys.stderr.write('%%d\\n' %% (peak_rss() - before))
+''' % REPO_ROOT
+
+
+def test_memory_budget_refuses_chunks_larger_than_the_cap():
+    budget = dropbox_transfer.MemoryBudget(4*MB)
+    with pytest.raises(ValueError):
+        budget.acquire(4*MB + 1)
+    assert budget.acquire(4*MB) == 4*MB
+
+
+def test_upload_with_chunks_larger_than_the_cap_fails(tmp_path, monkeypatch, dropbox_client):
+    monkeypatch.setattr(dropbox_transfer, 'UPLOAD_MEMORY', dropbox_transfer.MemoryBudget(4*MB))
+    path = str(tmp_path / 'big.bin')
+    dropbox_transfer_benchmark.make_file(path, 16*MB)
+    with pytest.raises(ValueError):
+        dropbox_transfer.send_to_dropbox(path, '/cap', dropbox_client, workers=1, chunk_size=8*MB)
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/clear_refs'), reason='needs Linux /proc to reset the peak RSS')
+def test_upload_peak_rss_stays_within_memory_cap(tmp_path, dropbox_server):
+    '''
+    Uploads a 2GB sparse file with 8 workers, 4MB chunks and a 16MB cap.  Without the
+    cap, the chunks read ahead of the workers would grow RSS towards the file size.
+    MALLOC_MMAP_THRESHOLD_ is fixed so that glibc returns each freed chunk to the OS,
+    rather than keeping a chunk-sized free block per thread.  That way RSS follows
+    the chunks that are alive, and the bound can be the cap plus one chunk.
+    '''
+    path = str(tmp_path / 'sparse.bin')
+    with open(path, 'wb') as fout:
+        fout.truncate(2*1024*MB)
+    cap = 16*MB
+    env = dict(os.environ, MALLOC_MMAP_THRESHOLD_=str(MB))
+    p = subprocess.run([sys.executable, '-c', UPLOAD_SCRIPT, dropbox_server.url, path, str(cap), str(4*MB), '8'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    assert p.returncode == 0, p.stderr.decode('utf-8')
+    growth = int(p.stderr.decode('utf-8').split()[-1])
+    assert growth < cap + 4*MB
+    remote = dropbox_server.store.files['/rss/sparse.bin']
+    try:
+        assert remote['size'] == 2*1024*MB
+        assert remote['content_hash'] == dropbox_transfer.compute_content_hash(path)
+    finally:
+        # the fake server keeps what it receives, which unlike the local file is not sparse
+        os.remove(remote['local_path'])
+
+
+def test_resumed_upload_corrects_offset_rejected_by_finish(tmp_path, dropbox_server, dropbox_client):
+    path = str(tmp_path / 'resume.bin')
+    dropbox_transfer_benchmark.make_file(path, 12*MB)
+    with open(path, 'rb') as fin:
+        session_id = dropbox_client.files_upload_session_start(fin.read(8*MB)).session_id
+    # the journal is behind what Dropbox has, so the finish that resumes the upload
+    # fails with an incorrect offset wrapped in UploadSessionFinishError.lookup_failed
+    journal = dropbox_transfer.SessionJournal(str(tmp_path / 'journal.json'))
+    journal.start(path, '/resume/resume.bin', session_id, dropbox_transfer.SERIAL_SESSION, offset=4*MB)
+    dropbox_transfer.send_to_dropbox(path, '/resume', dropbox_client, workers=1, chunk_size=8*MB, journal=journal)
+    remote = dropbox_server.store.files['/resume/resume.bin']
+    assert remote['content_hash'] == dropbox_transfer.compute_content_hash(path)
+
+
+def test_concurrent_upload_is_faster_and_reassembles_exactly(tmp_path):
+    root = tmp_path / 'server'
+    root.mkdir()
+    # each connection is limited to 32MB/s, so only parallel chunks can go faster
+    server = serve(dropbox_transfer_benchmark.FakeDropboxServer(str(root), 32*MB, 0.01))
+    try:
+        client = dropbox_transfer_benchmark.LocalDropbox(server.url, dropbox_transfer_benchmark.FAKE_TOKEN)
+        path = str(tmp_path / 'big.bin')
+        dropbox_transfer_benchmark.make_file(path, 32*MB + 12345)
+        seconds = {}
+        for workers in (1, 4):
+            started = time.time()
+            dropbox_transfer.send_to_dropbox(path, '/workers%d' % workers, client, workers=workers, chunk_size=4*MB)
+            seconds[workers] = time.time() - started
+            remote = server.store.files['/workers%d/big.bin' % workers]
+            with open(path, 'rb') as local, open(remote['local_path'], 'rb') as uploaded:
+                assert uploaded.read() == local.read()
+        assert seconds[4] < seconds[1] / 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+
+class RangeRecordingHandler(dropbox_transfer_benchmark.FakeDropboxHandler):
+    '''
+    Records the Range header of each download, and cuts the first response for the
+    range starting at `server.break_at` off after `server.break_after` bytes.
+    '''
+    def route_files_download(self):
+        requested = self.headers.get('Range')
+        self.server.ranges.append(requested)
+        if requested == 'bytes=%d-%d' % (self.server.break_at, self.server.break_at + RANGE_SIZE - 1) and not self.server.broken:
+            self.server.broken = True
+            self.read_body()
+            entry = self.server.store.files[self.api_arg()['path'].lower()]
+            self.send_response(206)
+            self.send_header('Content-Length', str(RANGE_SIZE))
+            self.end_headers()
+            with open(entry['local_path'], 'rb') as fin:
+                fin.seek(self.server.break_at)
+                self.wfile.write(fin.read(self.server.break_after))
+            self.close_connection = True
+            return
+        dropbox_transfer_benchmark.FakeDropboxHandler.route_files_download(self)
+
+
+def test_ranged_download_reassembles_and_retries_a_broken_range(tmp_path, dropbox_server, dropbox_client):
+    dropbox_server.RequestHandlerClass = RangeRecordingHandler
+    dropbox_server.ranges = []
+    dropbox_server.break_at = RANGE_SIZE
+    dropbox_server.break_after = RANGE_SIZE // 2
+    dropbox_server.broken = False
+    path = str(tmp_path / 'big.bin')
+    size = 4*RANGE_SIZE + 12345
+    dropbox_transfer_benchmark.make_file(path, size)
+    with open(path, 'rb') as fin:
+        dropbox_client.files_upload(fin.read(), '/ranged/big.bin')
+
+    download_path = str(tmp_path / 'big.download')
+    dropbox_transfer.pull_file_ranged('/ranged/big.bin', download_path, dropbox_transfer_benchmark.FAKE_TOKEN, 4,
+        range_size=RANGE_SIZE, download_url=dropbox_server.url + '/2/files/download')
+    with open(path, 'rb') as local, open(download_path, 'rb') as downloaded:
+        assert downloaded.read() == local.read()
+    assert dropbox_server.broken
+    for start in range(0, size, RANGE_SIZE):
+        assert 'bytes=%d-%d' % (start, min(start + RANGE_SIZE, size) - 1) in dropbox_server.ranges
+    # the broken range is requested again from the first byte that was not written
+    assert 'bytes=%d-%d' % (RANGE_SIZE + RANGE_SIZE // 2, 2*RANGE_SIZE - 1) in dropbox_server.ranges
+
+
+def test_upload_tree_reports_each_entry_of_a_batch_commit(tmp_path, monkeypatch, dropbox_server, dropbox_client):
+    monkeypatch.setattr(dropbox_transfer, 'BATCH_FINISH_LIMIT', 2)
+    tree = tmp_path / 'tree'
+    (tree / 'sub').mkdir(parents=True)
+    small = ['a.txt', 'b.txt', 'sub/c.txt', 'sub/d.txt', 'sub/e.txt']
+    for name in small:
+        (tree / name).write_text('contents of %s\n' % name)
+    dropbox_transfer_benchmark.make_file(str(tree / 'big.bin'), 9*MB)
+    # without overwrite, committing a different file over this one fails, and only that entry
+    dropbox_client.files_upload(b'already there\n', '/up/tree/sub/d.txt')
+
+    targets, skipped = dropbox_transfer.collect_upload_targets([str(tree)])
+    results = dropbox_transfer.upload_tree(targets, '/up', dropbox_client, file_workers=3, chunk_size=4*MB)
+    conflict = str(tree / 'sub' / 'd.txt')
+    assert sorted(results) == sorted(str(tree / x) for x in small + ['big.bin'])
+    assert 'conflict' in results.pop(conflict)
+    assert set(results.values()) == {None}
+    for local_path in results:
+        remote = dropbox_server.store.files['/up/tree/%s' % os.path.relpath(local_path, str(tree))]
+        with open(local_path, 'rb') as local, open(remote['local_path'], 'rb') as uploaded:
+            assert uploaded.read() == local.read()
+    with open(dropbox_server.store.files['/up/tree/sub/d.txt']['local_path'], 'rb') as kept:
+        assert kept.read() == b'already there\n'
+
+
+def test_content_hash_is_computed_over_4mb_blocks(tmp_path):
+    path = str(tmp_path / 'blocks.bin')
+    dropbox_transfer_benchmark.make_file(path, 9*MB + 123)
+    with open(path, 'rb') as fin:
+        data = fin.read()
+    block_hashes = b''.join(hashlib.sha256(data[i:i + 4*MB]).digest() for i in range(0, len(data), 4*MB))
+    assert dropbox_transfer.compute_content_hash(path) == hashlib.sha256(block_hashes).hexdigest()
+    assert dropbox_transfer.compute_content_hash(path) != hashlib.sha256(data).hexdigest()
+
+
+def test_sync_only_selects_files_that_differ_from_dropbox(tmp_path, monkeypatch, dropbox_client):
+    tree = tmp_path / 'tree'
+    tree.mkdir()
+    dropbox_transfer_benchmark.make_file(str(tree / 'same.bin'), 9*MB + 123)
+    (tree / 'same.txt').write_text('unchanged\n')
+    (tree / 'changed.txt').write_text('new contents\n')
+    (tree / 'new.txt').write_text('not in Dropbox yet\n')
+    for name in ('same.bin', 'same.txt'):
+        with open(str(tree / name), 'rb') as fin:
+            dropbox_client.files_upload(fin.read(), '/sync/tree/%s' % name)
+    dropbox_client.files_upload(b'old contents\n', '/sync/tree/changed.txt')
+
+    targets, skipped = dropbox_transfer.collect_upload_targets([str(tree)])
+    hash_cache = {}
+    changed = dropbox_transfer.select_changed_targets(targets, '/sync', dropbox_client, hash_cache)
+    assert sorted(os.path.basename(x[0]) for x in changed) == ['changed.txt', 'new.txt']
+    # only the files Dropbox already has were hashed
+    assert sorted(os.path.basename(x) for x in hash_cache) == ['changed.txt', 'same.bin', 'same.txt']
+
+    # a second pass takes the hashes of unchanged files from the cache
+    hashed = []
+    compute_content_hash = dropbox_transfer.compute_content_hash
+    monkeypatch.setattr(dropbox_transfer, 'compute_content_hash', lambda x: hashed.append(x) or compute_content_hash(x))
+    assert dropbox_transfer.select_changed_targets(targets, '/sync', dropbox_client, hash_cache) == changed
+    assert hashed == []
+
+
+def test_download_tree_follows_pages_and_skips_unchanged_files(tmp_path, monkeypatch, dropbox_client):
+    monkeypatch.setattr(dropbox_transfer_benchmark, 'LIST_PAGE_SIZE', 3)
+    remote = {
+        'a.txt': b'a\n',
+        'b.txt': b'b\n',
+        'sub/c.txt': b'c\n',
+        'sub/deeper/d.txt': b'd\n',
+        'sub/deeper/e.txt': b'e\n',
+        'other/f.txt': b'f\n'
+    }
+    for name, data in remote.items():
+        dropbox_client.files_upload(data, '/down/%s' % name)
+    calls = {'files_list_folder_continue': 0, 'files_download_to_file': []}
+    list_continue = dropbox_client.files_list_folder_continue
+    download = dropbox_client.files_download_to_file
+
+    def counted_list_continue(cursor):
+        calls['files_list_folder_continue'] += 1
+        return list_continue(cursor)
+
+    def recorded_download(local_path, dropbox_path):
+        calls['files_download_to_file'].append(dropbox_path)
+        return download(local_path, dropbox_path)
+
+    monkeypatch.setattr(dropbox_client, 'files_list_folder_continue', counted_list_continue)
+    monkeypatch.setattr(dropbox_client, 'files_download_to_file', recorded_download)
+
+    local_dir = tmp_path / 'local'
+    results = dropbox_transfer.download_tree('/down', str(local_dir), dropbox_client, file_workers=3)
+    assert results == dict((str(local_dir / x), None) for x in remote)
+    for name, data in remote.items():
+        assert (local_dir / name).read_bytes() == data
+    # 6 files and 3 folders, 3 entries a page
+    assert calls['files_list_folder_continue'] == 2
+    assert len(calls['files_download_to_file']) == len(remote)
+
+    # a rerun fetches only what is missing or differs locally
+    (local_dir / 'sub' / 'deeper' / 'd.txt').write_bytes(b'changed\n')
+    (local_dir / 'other' / 'f.txt').unlink()
+    calls['files_download_to_file'] = []
+    results = dropbox_transfer.download_tree('/down', str(local_dir), dropbox_client, file_workers=3)
+    assert set(results.values()) == {None}
+    assert sorted(calls['files_download_to_file']) == ['/down/other/f.txt', '/down/sub/deeper/d.txt']
+    assert (local_dir / 'sub' / 'deeper' / 'd.txt').read_bytes() == b'd\n'
+
+
+def test_chunk_size_follows_throughput_and_errors_in_4mb_steps():
+    # 80MB/s aims for 800MB chunks, but the size at most doubles per chunk
+    sizer = dropbox_transfer.AdaptiveChunkSizer(8*MB, max_chunk_size=64*MB)
+    sizes = []
+    for i in range(4):
+        sizer.record(sizer.chunk_size, sizer.chunk_size / (80.0*MB), True)
+        sizes.append(sizer.chunk_size)
+    assert sizes == [16*MB, 32*MB, 64*MB, 64*MB]
+
+    # 1.6MB/s aims for 16MB, then each recent error halves that, down to MIN_CHUNK_SIZE
+    sizer = dropbox_transfer.AdaptiveChunkSizer(32*MB)
+    sizer.record(32*MB, 20, True)
+    sizes = [sizer.chunk_size]
+    for i in range(3):
+        sizer.record(0, 0, False)
+        sizes.append(sizer.chunk_size)
+    assert sizes == [16*MB, 8*MB, 4*MB, dropbox_transfer.MIN_CHUNK_SIZE]
+
+    # 10MB in 7s aims for about 14.3MB, rounded down to a multiple of 4MB
+    sizer = dropbox_transfer.AdaptiveChunkSizer(8*MB)
+    sizer.record(10*MB, 7, True)
+    assert sizer.chunk_size == 12*MB
+
+    fixed = dropbox_transfer.AdaptiveChunkSizer(8*MB, adaptive=False)
+    fixed.record(8*MB, 0.01, True)
+    fixed.record(0, 0, False)
+    assert fixed.chunk_size == 8*MB
+
+
+def test_backoff_delay_is_jittered_up_to_a_doubling_limit(monkeypatch):
+    delays = [dropbox_transfer.backoff_delay(3) for i in range(200)]
+    assert all(0 <= x <= 4 * dropbox_transfer.BACKOFF_BASE for x in delays)
+    assert len(set(delays)) > 1
+    monkeypatch.setattr(dropbox_transfer.random, 'uniform', lambda low, high: high)
+    limits = [dropbox_transfer.backoff_delay(x) for x in range(1, 10)]
+    assert limits == [min(dropbox_transfer.BACKOFF_MAX, dropbox_transfer.BACKOFF_BASE * 2**x) for x in range(9)]
+
+
+def test_adaptive_serial_upload_grows_chunks_and_recovers_from_a_dropped_connection(tmp_path, monkeypatch,
+        dropbox_server, dropbox_client):
+    monkeypatch.setattr(dropbox_transfer, 'backoff_delay', lambda failures: 0)
+    path = str(tmp_path / 'adaptive.bin')
+    dropbox_transfer_benchmark.make_file(path, 64*MB + 12345)
+    appended = []
+    append = dropbox_client.files_upload_session_append_v2
+
+    def flaky_append(data, cursor):
+        appended.append(len(data))
+        if len(appended) == 3:
+            raise requests.exceptions.ConnectionError('injected')
+        return append(data, cursor)
+
+    monkeypatch.setattr(dropbox_client, 'files_upload_session_append_v2', flaky_append)
+    dropbox_transfer.send_to_dropbox(path, '/adaptive', dropbox_client, workers=1, chunk_size=4*MB, adaptive=True)
+    # the local server is fast enough that each chunk is twice the last, even with one
+    # recent error, and the dropped chunk's bytes are sent again from the same offset
+    assert appended[:4] == [4*MB, 8*MB, 16*MB, 32*MB]
+    assert all(x % (4*MB) == 0 for x in appended)
+    remote = dropbox_server.store.files['/adaptive/adaptive.bin']
+    assert remote['content_hash'] == dropbox_transfer.compute_content_hash(path)
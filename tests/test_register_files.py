@@ -0,0 +1,91 @@
+import io
+import os
+
+import register_files
+from conftest import FAKE_CNAP_TOKEN
+
+
+def test_stdin_manifest_can_be_read_twice(monkeypatch):
+    monkeypatch.setattr('sys.stdin', io.StringIO('gs://bucket/a.txt\ngs://bucket/b.txt\tuser@example.com\n'))
+    files = register_files.ResourceList([], ['-'], [])
+    expected = [
+        ('gs://bucket/a.txt', None, None, None),
+        ('gs://bucket/b.txt', None, 'user@example.com', None)
+    ]
+    assert list(files.iter_listed()) == expected
+    assert list(files) == expected
+
+
+def test_owner_missing_from_cached_index_is_fetched_again(tmp_path, cnap_server):
+    cnap_server.users['new@example.com'] = 7
+    cache = register_files.CredentialCache(str(tmp_path / 'cache.json'), 'admin@example.com')
+    users = {'admin@example.com': 1}
+    assert register_files.get_owner_pk('new@example.com', FAKE_CNAP_TOKEN, users, cache) == 7
+    assert cache.get(register_files.USERS, register_files.USER_INDEX_TTL)['new@example.com'] == 7
+
+
+def test_manifest_owner_missing_from_cached_index_is_fetched_again(cnap_server):
+    cnap_server.users.update({'admin@example.com': 1, 'new@example.com': 7})
+    args = {
+        register_files.TOKEN: FAKE_CNAP_TOKEN,
+        register_files.FILES: [('gs://bucket/new.txt', 10, 'new@example.com', None)],
+        register_files.EXPIRY: None,
+        register_files.USERS: {'admin@example.com': 1}
+    }
+    registered, failed = register_files.register_files(args, 1)
+    assert (registered, failed) == (1, {})
+    assert cnap_server.resources['gs://bucket/new.txt']['owner'] == 7
+
+
+def test_journal_is_kept_after_failures_and_removed_after_a_clean_run(tmp_path, cnap_server):
+    cnap_server.fail_paths.add('gs://bucket/b.txt')
+    journal = str(tmp_path / 'register_files.journal')
+    args = {
+        register_files.TOKEN: FAKE_CNAP_TOKEN,
+        register_files.FILES: [('gs://bucket/a.txt', 10, None, None), ('gs://bucket/b.txt', 20, None, None)],
+        register_files.EXPIRY: None,
+        register_files.JOURNAL: journal
+    }
+    registered, failed = register_files.register_files(args, 1)
+    assert registered == 1 and list(failed) == ['gs://bucket/b.txt']
+    with open(journal) as fin:
+        assert fin.read() == 'gs://bucket/a.txt\t1\n'
+
+    # the rerun only sends what failed, and nothing is left to resume afterwards
+    cnap_server.fail_paths.clear()
+    del cnap_server.resources['gs://bucket/a.txt']
+    registered, failed = register_files.register_files(args, 1)
+    assert (registered, failed) == (1, {})
+    assert 'gs://bucket/a.txt' not in cnap_server.resources
+    assert not os.path.exists(journal)
+
+
+def test_concurrent_registration_retries_server_errors(cnap_server):
+    rows = [('gs://bucket/file_%03d.txt' % i, i, None, None) for i in range(100)]
+    cnap_server.resources['gs://bucket/file_000.txt'] = {'path': 'gs://bucket/file_000.txt', 'owner': 1}
+    cnap_server.flaky_paths.update(x[0] for x in rows[1:11])
+    args = {
+        register_files.TOKEN: FAKE_CNAP_TOKEN,
+        register_files.FILES: rows,
+        register_files.EXPIRY: None,
+        register_files.PARALLEL: 8
+    }
+    registered, failed = register_files.register_files(args, 1)
+    assert (registered, failed) == (99, {})
+    assert sorted(cnap_server.resources) == [x[0] for x in rows]
+    # the existing resources are listed once, and each new file is sent once plus once per 503
+    assert cnap_server.request_counts == {'GET /resources/': 1, 'POST /resources/': 99 + 10}
+
+
+def test_registration_that_failed_after_creating_the_resource_is_not_sent_again(cnap_server):
+    cnap_server.lost_paths.add('gs://bucket/lost.txt')
+    args = {
+        register_files.TOKEN: FAKE_CNAP_TOKEN,
+        register_files.FILES: [('gs://bucket/lost.txt', 10, None, None)],
+        register_files.EXPIRY: None
+    }
+    registered, failed = register_files.register_files(args, 1)
+    assert (registered, failed) == (1, {})
+    assert list(cnap_server.resources) == ['gs://bucket/lost.txt']
+    # the 500 is followed by a look at the listing, which has the resource, rather than a second POST
+    assert cnap_server.request_counts == {'GET /resources/': 2, 'POST /resources/': 1}